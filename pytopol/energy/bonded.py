@@ -0,0 +1,335 @@
+"""
+Vectorized bonded energies of a topology.
+
+The terms of a PSFSystem (CHARMM parameters) or of a GroTop are collected
+into flat arrays - one row per term and one column per atom - and the
+energies are evaluated over all the rows at once. The coordinates may be one
+frame (natoms, 3) or a stack of frames (nframes, natoms, 3).
+
+All the terms are stored in the CHARMM form, so that
+
+    bonds     : k (r - b0)^2
+    angles    : k (theta - theta0)^2 + kub (s - s0)^2
+    dihedrals : k (1 + cos(n phi - delta))
+    impropers : k (psi - psi0)^2
+
+i.e. the force constants of GROMACS are halved. The units are the ones of the
+source: kcal/mol and A for 'charmm', kJ/mol and nm for 'gromacs'.
+
+"""
+
+import logging
+import numpy as np
+from pytopol.parsers import blocks
+from pytopol.parsers.utils import build_index_array
+
+module_logger = logging.getLogger('mainapp.bonded')
+
+kcal2kj = 4.184
+
+term_classes = ('bonds', 'angles', 'dihedrals', 'impropers')
+
+# the parameters of each term class (besides the indices)
+term_params = {
+    'bonds'    : ('k', 'b0'),
+    'angles'   : ('k', 'theta0', 'kub', 's0'),
+    'dihedrals': ('k', 'n', 'delta'),
+    'impropers': ('k', 'psi0'),
+}
+
+
+
+class BondedTerms(object):
+    def __init__(self, units, natoms):
+        """ Bonded terms of a whole system as arrays.
+
+        Args:
+            units  : 'charmm' (kcal/mol, A) or 'gromacs' (kJ/mol, nm)
+            natoms : int, number of atoms in the system
+
+        Attributes:
+            bonds, angles, dihedrals, impropers : dict of arrays, 'indices'
+                     is (n, k) zero-based atom indices of the system and
+                     the parameters are (n,) arrays (see term_params), the
+                     angles are in radians. A multi-term dihedral has one
+                     row for each term.
+
+        """
+
+        assert units in ('charmm', 'gromacs')
+        self.units  = units
+        self.natoms = natoms
+
+        for kind in term_classes:
+            natoms_term = 2 if kind == 'bonds' else 3 if kind == 'angles' else 4
+            terms = {'indices': np.zeros((0, natoms_term), dtype=np.int64)}
+            for p in term_params[kind]:
+                terms[p] = np.zeros(0)
+            setattr(self, kind, terms)
+
+
+    def __repr__(self):
+        return 'BondedTerms (%s) with %d bonds, %d angles, %d dihedrals and %d impropers' % (
+            self.units, len(self.bonds['indices']), len(self.angles['indices']),
+            len(self.dihedrals['indices']), len(self.impropers['indices']))
+
+
+    def energies(self, coords, units=None):
+        """ Per-term-class energies.
+
+        Args:
+            coords : (natoms, 3) or (nframes, natoms, 3) array, in A for
+                     'charmm' and nm for 'gromacs'
+            units  : 'kcal/mol' or 'kJ/mol', default is the units of the terms
+
+        Returns:
+            dict of term class : total energy (a float, or an (nframes,)
+            array for a stack of frames)
+
+        """
+
+        coords = np.asarray(coords, dtype=np.float64)
+        if coords.shape[-2:] != (self.natoms, 3):
+            raise ValueError('expected coordinates for %d atoms, got shape %s' % (
+                self.natoms, coords.shape))
+
+        native = 'kcal/mol' if self.units == 'charmm' else 'kJ/mol'
+        units  = units or native
+        if units not in ('kcal/mol', 'kJ/mol'):
+            raise ValueError('unknown units: %s' % units)
+
+        factor = 1.0
+        if units != native:
+            factor = kcal2kj if native == 'kcal/mol' else 1.0 / kcal2kj
+
+        result = {}
+        for kind in term_classes:
+            e = term_energies[kind](coords, getattr(self, kind))
+            total = e.sum(axis=-1) * factor
+            result[kind] = float(total) if total.ndim == 0 else total
+
+        return result
+
+
+
+# =====================================================================
+# geometry
+# =====================================================================
+
+def _at(coords, indices, j):
+    # positions of the j-th atom of all the terms
+    return coords[..., indices[:, j], :]
+
+def _norm(v):
+    return np.sqrt(np.einsum('...i,...i->...', v, v))
+
+def distances(coords, indices):
+    return _norm(_at(coords, indices, 1) - _at(coords, indices, 0))
+
+def angles(coords, indices):
+    # in radians
+    v1 = _at(coords, indices, 0) - _at(coords, indices, 1)
+    v2 = _at(coords, indices, 2) - _at(coords, indices, 1)
+    cos = np.einsum('...i,...i->...', v1, v2) / (_norm(v1) * _norm(v2))
+    return np.arccos(np.clip(cos, -1.0, 1.0))
+
+def dihedrals(coords, indices):
+    # IUPAC dihedral angles in radians, in (-pi, pi]
+    b1 = _at(coords, indices, 1) - _at(coords, indices, 0)
+    b2 = _at(coords, indices, 2) - _at(coords, indices, 1)
+    b3 = _at(coords, indices, 3) - _at(coords, indices, 2)
+    n1 = np.cross(b1, b2)
+    n2 = np.cross(b2, b3)
+    y = _norm(b2) * np.einsum('...i,...i->...', b1, n2)
+    x = np.einsum('...i,...i->...', n1, n2)
+    return np.arctan2(y, x)
+
+def _periodic(d):
+    # wraps an angle difference to [-pi, pi)
+    return (d + np.pi) % (2 * np.pi) - np.pi
+
+
+
+# =====================================================================
+# energies of each term - (n,) or (nframes, n) arrays
+# =====================================================================
+
+def bond_energies(coords, t):
+    r = distances(coords, t['indices'])
+    return t['k'] * (r - t['b0'])**2
+
+def angle_energies(coords, t):
+    theta = angles(coords, t['indices'])
+    e = t['k'] * (theta - t['theta0'])**2
+
+    ub = t['kub'] != 0
+    if np.any(ub):
+        s = distances(coords, t['indices'][ub][:, [0, 2]])
+        eub = t['kub'][ub] * (s - t['s0'][ub])**2
+        e[..., ub] += eub
+    return e
+
+def dihedral_energies(coords, t):
+    phi = dihedrals(coords, t['indices'])
+    return t['k'] * (1 + np.cos(t['n'] * phi - t['delta']))
+
+def improper_energies(coords, t):
+    psi = dihedrals(coords, t['indices'])
+    return t['k'] * _periodic(psi - t['psi0'])**2
+
+term_energies = {
+    'bonds'    : bond_energies,
+    'angles'   : angle_energies,
+    'dihedrals': dihedral_energies,
+    'impropers': improper_energies,
+}
+
+
+
+# =====================================================================
+# building the terms
+# =====================================================================
+
+def _lookup(types, indices, table, kind):
+    # assigns the values of table (types tuple : list of value tuples) to the
+    # terms, one lookup for each distinct combination of atom types.
+    # returns (term, values) - the term of each row and an (m, p) array
+    names, codes = np.unique(types, return_inverse=True)
+    names = names.tolist()
+    if len(indices) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 0))
+
+    uniq, inverse = np.unique(codes.reshape(-1)[indices], axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    ustart = np.zeros(len(uniq), dtype=np.int64)
+    ucount = np.zeros(len(uniq), dtype=np.int64)
+    rows = []
+    for u, row in enumerate(uniq.tolist()):
+        key = tuple(names[c] for c in row)
+        values = table.get(key) or table.get(key[::-1])
+        if not values:
+            raise ValueError('no parameters for %s %s' % (kind, '-'.join(key)))
+        ustart[u] = len(rows)
+        ucount[u] = len(values)
+        rows.extend(values)
+
+    count = ucount[inverse]
+    term = np.repeat(np.arange(len(indices)), count)
+    offset = np.arange(len(term)) - np.repeat(np.cumsum(count) - count, count)
+    values = np.array(rows, dtype=np.float64)[np.repeat(ustart[inverse], count) + offset]
+    return term, values
+
+
+def terms_from_psf(system):
+    """ Bonded terms of a PSFSystem with CHARMM parameters.
+
+    The parameters come from system.bondtypes, angletypes, ... as added by
+    CharmmPar.add_params_to_system; the atoms of system.molecules are
+    numbered in order.
+
+    """
+
+    mols = system.molecules
+    natoms = sum(len(m.atoms) for m in mols)
+    terms = BondedTerms('charmm', natoms)
+
+    types = [a.get_atomtype() for m in mols for a in m.atoms]
+    offsets = np.cumsum([0] + [len(m.atoms) for m in mols])
+
+    deg = np.pi / 180.0
+    tables = {
+        'bonds'    : dict(((t.atype1, t.atype2), [(t.charmm['param']['kb'], t.charmm['param']['b0'])])
+                          for t in system.bondtypes),
+        'angles'   : dict(((t.atype1, t.atype2, t.atype3),
+                           [(t.charmm['param']['ktetha'], t.charmm['param']['tetha0'] * deg,
+                             t.charmm['param']['kub'] or 0, t.charmm['param']['s0'] or 0)])
+                          for t in system.angletypes),
+        'dihedrals': dict(((t.atype1, t.atype2, t.atype3, t.atype4),
+                           [(p['kchi'], p['n'], p['delta'] * deg) for p in t.charmm['param']])
+                          for t in system.dihedraltypes),
+        'impropers': dict(((t.atype1, t.atype2, t.atype3, t.atype4),
+                           [(p['kpsi'], p['psi0'] * deg) for p in t.charmm['param']])
+                          for t in system.impropertypes),
+    }
+
+    for kind in term_classes:
+        indices = [build_index_array(m, kind) + off for m, off in zip(mols, offsets) if len(getattr(m, kind))]
+        if len(indices) == 0:
+            continue
+        indices = np.concatenate(indices)
+
+        term, values = _lookup(types, indices, tables[kind], kind)
+        t = {'indices': indices[term]}
+        for j, p in enumerate(term_params[kind]):
+            t[p] = values[:, j]
+        setattr(terms, kind, t)
+
+    return terms
+
+
+def terms_from_grotop(top):
+    """ Bonded terms of all the molecules of a GroTop.
+
+    The parameters are resolved with GroTop.get_parameters for each
+    moleculetype and repeated for all its molecules.
+
+    """
+
+    natoms = top.molecules.total('atoms')
+    terms = BondedTerms('gromacs', natoms)
+
+    deg = np.pi / 180.0
+    collected = dict((kind, []) for kind in term_classes)
+
+    offset = 0
+    for mol, count in top.molecules.iter_blocks():
+        nat = len(mol.atoms)
+        starts = offset + nat * np.arange(count)
+        offset += nat * count
+
+        for kind in term_classes:
+            if len(getattr(mol, kind)) == 0:
+                continue
+
+            res = top.get_parameters(mol, kind)
+            func, p = res['func'], res['params']
+            indices = build_index_array(mol, kind)[res['term']]
+
+            if kind == 'bonds':
+                values = (0.5 * p[:, 1], p[:, 0])
+            elif kind == 'angles':
+                ub = func == 5
+                kub = np.where(ub, 0.5 * p[:, 3] if p.shape[1] > 3 else 0, 0)
+                s0  = np.where(ub, p[:, 2] if p.shape[1] > 3 else 0, 0)
+                values = (0.5 * p[:, 1], p[:, 0] * deg, kub, s0)
+            elif kind == 'dihedrals':
+                if np.any(~np.isin(func, (1, 9))):
+                    raise NotImplementedError('dihedrals with function type %d are not supported' % (
+                        func[~np.isin(func, (1, 9))][0]))
+                values = (p[:, 1], p[:, 2], p[:, 0] * deg)
+            elif kind == 'impropers':
+                if np.any(func != 2):
+                    raise NotImplementedError('impropers with function type %d are not supported' % (
+                        func[func != 2][0]))
+                values = (0.5 * p[:, 1], p[:, 0] * deg)
+
+            # the same terms for each copy of the moleculetype
+            indices = (indices[None, :, :] + starts[:, None, None]).reshape(-1, indices.shape[1])
+            values = [np.tile(v, count) for v in values]
+            collected[kind].append((indices, values))
+
+    for kind, parts in collected.items():
+        if len(parts) == 0:
+            continue
+        t = {'indices': np.concatenate([ind for ind, v in parts])}
+        for j, p in enumerate(term_params[kind]):
+            t[p] = np.concatenate([v[j] for ind, v in parts])
+        setattr(terms, kind, t)
+
+    return terms
+
+
+def psf_coords(system, model=0):
+    '''Returns the coordinates of the atoms of system.molecules as an (natoms, 3) array'''
+    return np.array([a.coords[model] for m in system.molecules for a in m.atoms], dtype=np.float64)
@@ -0,0 +1,212 @@
+"""
+CMAP (phi/psi cross-term) energies by bicubic interpolation.
+
+A CMAP grid has 24 x 24 energies over phi (rows) and psi (columns), both
+from -180 to 165 degrees. Like CHARMM, the derivatives at the grid points
+come from periodic cubic splines, and each of the 24 x 24 cells is
+interpolated by a bicubic patch that matches the values and derivatives at
+its corners. The 16 coefficients of all the patches are computed once for
+each distinct grid and cached.
+
+"""
+
+import hashlib
+import logging
+import numpy as np
+from pytopol.parsers.utils import build_index_array
+from pytopol.energy.bonded import dihedrals, kcal2kj
+
+module_logger = logging.getLogger('mainapp.cmap')
+
+grid_size = 24
+grid_step = 360.0 / grid_size
+
+# content hash of a grid : (24, 24, 4, 4) coefficients
+_cache = {}
+
+# cubic Hermite basis: [p(0), p(1), p'(0), p'(1)] -> polynomial coefficients
+_hermite = np.array([
+    [ 1,  0,  0,  0],
+    [ 0,  0,  1,  0],
+    [-3,  3, -2, -1],
+    [ 2, -2,  1,  1],
+], dtype=np.float64)
+
+
+
+def _spline_slopes(values, axis):
+    # derivatives (per grid step) of the periodic cubic spline along axis:
+    #   m[i-1] + 4 m[i] + m[i+1] = 3 (y[i+1] - y[i-1])
+    n = values.shape[axis]
+    y = np.moveaxis(values, axis, 0)
+    circ = 4 * np.eye(n) + np.roll(np.eye(n), 1, axis=1) + np.roll(np.eye(n), -1, axis=1)
+    rhs = 3 * (np.roll(y, -1, axis=0) - np.roll(y, 1, axis=0))
+    slopes = np.linalg.solve(circ, rhs.reshape(n, -1)).reshape(y.shape)
+    return np.moveaxis(slopes, 0, axis)
+
+
+def cmap_coefficients(grid):
+    """ Bicubic coefficients of a CMAP grid.
+
+    Args:
+        grid : 576 values (like CMapType.charmm['param']) or a (24, 24) array,
+               phi-major
+
+    Returns:
+        (24, 24, 4, 4) array, c[i, j] are the coefficients of the cell that
+        starts at grid point (i, j): E = sum c[i, j, k, l] u^k v^l with u, v
+        in [0, 1) the fractions of a grid step along phi and psi
+
+    """
+
+    grid = np.asarray(grid, dtype=np.float64).reshape(grid_size, grid_size)
+    key = hashlib.sha1(grid.tobytes()).hexdigest()
+    if key in _cache:
+        return _cache[key]
+
+    f   = grid
+    fx  = _spline_slopes(f, 0)
+    fy  = _spline_slopes(f, 1)
+    fxy = _spline_slopes(fx, 1)
+
+    def _corners(a):
+        # values at the (0,0), (1,0), (0,1), (1,1) corners of each cell
+        a10 = np.roll(a, -1, axis=0)
+        return a, a10, np.roll(a, -1, axis=1), np.roll(a10, -1, axis=1)
+
+    f00, f10, f01, f11 = _corners(f)
+    x00, x10, x01, x11 = _corners(fx)
+    y00, y10, y01, y11 = _corners(fy)
+    c00, c10, c01, c11 = _corners(fxy)
+
+    F = np.array([
+        [f00, f01, y00, y01],
+        [f10, f11, y10, y11],
+        [x00, x01, c00, c01],
+        [x10, x11, c10, c11],
+    ])                                          # (4, 4, 24, 24)
+    coeffs = np.einsum('ka,abij,lb->ijkl', _hermite, F, _hermite)
+
+    _cache[key] = coeffs
+    return coeffs
+
+
+def _cells(phi, psi):
+    # the cell (i, j) of the angles (radians) and their fractions (u, v) in it
+    u = (np.degrees(phi) + 180.0) / grid_step
+    v = (np.degrees(psi) + 180.0) / grid_step
+    i = np.floor(u)
+    j = np.floor(v)
+    return i.astype(np.int64) % grid_size, j.astype(np.int64) % grid_size, u - i, v - j
+
+
+def _patch_energies(u, v, c):
+    # bicubic patches c (..., 4, 4) at the fractions u, v
+    pu = np.stack([np.ones_like(u), u, u*u, u*u*u], axis=-1)
+    pv = np.stack([np.ones_like(v), v, v*v, v*v*v], axis=-1)
+    return np.einsum('...k,...kl,...l->...', pu, c, pv)
+
+
+def cmap_energies(phi, psi, coeffs):
+    """ Interpolated energies of one CMAP grid.
+
+    Args:
+        phi, psi : arrays of the angles in radians
+        coeffs   : (24, 24, 4, 4) coefficients from cmap_coefficients
+
+    """
+
+    i, j, u, v = _cells(phi, psi)
+    return _patch_energies(u, v, coeffs[i, j])
+
+
+
+class CMapTerms(object):
+    def __init__(self, system, cmappars=None):
+        """ The CMAP terms of a PSFSystem.
+
+        Args:
+            system   : PSFSystem, the atoms of system.molecules are numbered in order
+            cmappars : ParType with the grids (CharmmPar.cmappars), default is
+                       system.cmaptypes (as added by CharmmPar.add_params_to_system)
+
+        Attributes:
+            indices : (n, 8) zero-based atom indices, phi = atoms 1-4, psi = atoms 5-8
+            grid    : (n,) index of the grid of each term
+            coeffs  : (ngrids, 24, 24, 4, 4) bicubic coefficients
+
+        """
+
+        self.lgr = logging.getLogger('mainapp.cmap.CMapTerms')
+        self.units = 'charmm'
+
+        mols = system.molecules
+        self.natoms = sum(len(m.atoms) for m in mols)
+        offsets = np.cumsum([0] + [len(m.atoms) for m in mols])
+
+        indices = [build_index_array(m, 'cmaps') + off for m, off in zip(mols, offsets) if len(m.cmaps)]
+        self.indices = np.concatenate(indices) if indices else np.zeros((0, 8), dtype=np.int64)
+
+        if cmappars is None:
+            tables = dict((tuple(getattr(t, 'atype%d' % (k+1)) for k in range(8)), t.charmm['param'])
+                          for t in system.cmaptypes)
+            _get = tables.get
+        else:
+            _get = lambda key: (cmappars.get_parameter(key) or [None])[0]
+
+        types = np.array([a.get_atomtype() for m in mols for a in m.atoms])
+        keys = [tuple(row) for row in types[self.indices].tolist()]
+        distinct = sorted(set(keys))
+        grids = []
+        for key in distinct:
+            grid = _get(key)
+            if grid is None:
+                raise ValueError('no cmap parameters for %s' % '-'.join(key))
+            if len(grid) != grid_size * grid_size:
+                raise ValueError('cmap grid for %s has %d values (expecting %d)' % (
+                    '-'.join(key), len(grid), grid_size * grid_size))
+            grids.append(cmap_coefficients(grid))
+
+        index = dict((key, i) for i, key in enumerate(distinct))
+        self.grid = np.array([index[key] for key in keys], dtype=np.int64)
+        self.coeffs = np.array(grids).reshape(-1, grid_size, grid_size, 4, 4)
+
+
+    def __repr__(self):
+        return 'CMapTerms with %d cross-terms and %d grids' % (len(self.indices), len(self.coeffs))
+
+
+    def term_energies(self, coords):
+        '''Returns the energy of each term, (n,) or (nframes, n) for a stack of frames'''
+        phi = dihedrals(coords, self.indices[:, :4])
+        psi = dihedrals(coords, self.indices[:, 4:])
+
+        i, j, u, v = _cells(phi, psi)
+        return _patch_energies(u, v, self.coeffs[self.grid, i, j])
+
+
+    def energies(self, coords, units=None):
+        """ Total CMAP energy.
+
+        Args:
+            coords : (natoms, 3) or (nframes, natoms, 3) array, in A
+            units  : 'kcal/mol' (default) or 'kJ/mol'
+
+        Returns:
+            dict with 'cmaps'
+
+        """
+
+        coords = np.asarray(coords, dtype=np.float64)
+        if coords.shape[-2:] != (self.natoms, 3):
+            raise ValueError('expected coordinates for %d atoms, got shape %s' % (
+                self.natoms, coords.shape))
+
+        units = units or 'kcal/mol'
+        if units not in ('kcal/mol', 'kJ/mol'):
+            raise ValueError('unknown units: %s' % units)
+
+        total = self.term_energies(coords).sum(axis=-1)
+        if units == 'kJ/mol':
+            total = total * kcal2kj
+        return {'cmaps': float(total) if total.ndim == 0 else total}
@@ -0,0 +1,294 @@
+"""
+Analytic forces of the bonded terms and a finite-difference check.
+
+The derivative of each term with respect to its internal coordinate is
+multiplied by the gradient of that coordinate for all the terms at once,
+and the per-term forces are scatter-added to the atoms. The forces are in
+the units of the terms: kcal/mol/A for 'charmm' and kJ/mol/nm for 'gromacs'.
+
+"""
+
+import logging
+import numpy as np
+from pytopol.energy import bonded
+from pytopol.energy.bonded import kcal2kj
+from pytopol.energy.cmap import CMapTerms, _cells, grid_step
+from pytopol.parsers.utils import _sorted_isin
+
+module_logger = logging.getLogger('mainapp.forces')
+
+
+
+def _scatter(natoms, indices, grads):
+    # sums the (n, k, 3) per-term forces on the atoms of the terms
+    f = np.zeros((natoms, 3))
+    np.add.at(f, indices.ravel(), grads.reshape(-1, 3))
+    return f
+
+
+def _dot(a, b):
+    return np.einsum('ij,ij->i', a, b)
+
+
+def distance_gradients(coords, indices):
+    '''Returns r and dr/dx (n, 2, 3) of the pairs of atoms in indices'''
+    d = coords[indices[:, 1]] - coords[indices[:, 0]]
+    r = np.sqrt(_dot(d, d))
+    u = d / r[:, None]
+    return r, np.stack([-u, u], axis=1)
+
+
+def angle_gradients(coords, indices):
+    '''Returns theta (radians) and dtheta/dx (n, 3, 3) of the angles i-j-k in indices'''
+    v1 = coords[indices[:, 0]] - coords[indices[:, 1]]
+    v2 = coords[indices[:, 2]] - coords[indices[:, 1]]
+    n1 = np.sqrt(_dot(v1, v1))
+    n2 = np.sqrt(_dot(v2, v2))
+    cos = np.clip(_dot(v1, v2) / (n1 * n2), -1.0, 1.0)
+    sin = np.maximum(np.sqrt(1.0 - cos * cos), 1e-8)
+
+    gi = -(v2 / (n1 * n2)[:, None] - cos[:, None] * v1 / (n1 * n1)[:, None]) / sin[:, None]
+    gk = -(v1 / (n1 * n2)[:, None] - cos[:, None] * v2 / (n2 * n2)[:, None]) / sin[:, None]
+    return np.arccos(cos), np.stack([gi, -gi - gk, gk], axis=1)
+
+
+def dihedral_gradients(coords, indices):
+    '''Returns phi (radians, as bonded.dihedrals) and dphi/dx (n, 4, 3) of the dihedrals in indices'''
+    F = coords[indices[:, 0]] - coords[indices[:, 1]]
+    G = coords[indices[:, 1]] - coords[indices[:, 2]]
+    H = coords[indices[:, 3]] - coords[indices[:, 2]]
+    A = np.cross(F, G)
+    B = np.cross(H, G)
+    a2 = _dot(A, A)
+    b2 = _dot(B, B)
+    g = np.sqrt(_dot(G, G))
+
+    phi = bonded.dihedrals(coords, indices)
+
+    ga = (g / a2)[:, None] * A
+    gb = (g / b2)[:, None] * B
+    fg = (_dot(F, G) / (a2 * g))[:, None] * A
+    hg = (_dot(H, G) / (b2 * g))[:, None] * B
+
+    gi = -ga
+    gl = gb
+    gj = ga + fg - hg
+    gk = -gb - fg + hg
+    return phi, np.stack([gi, gj, gk, gl], axis=1)
+
+
+def bonded_forces(terms, coords):
+    """ Forces of each term class of a BondedTerms.
+
+    Args:
+        terms  : BondedTerms
+        coords : (natoms, 3) array
+
+    Returns:
+        dict of term class : (natoms, 3) forces
+
+    """
+
+    coords = np.asarray(coords, dtype=np.float64)
+    n = terms.natoms
+    result = {}
+
+    t = terms.bonds
+    r, dr = distance_gradients(coords, t['indices'])
+    de = 2 * t['k'] * (r - t['b0'])
+    result['bonds'] = _scatter(n, t['indices'], -de[:, None, None] * dr)
+
+    t = terms.angles
+    theta, dtheta = angle_gradients(coords, t['indices'])
+    de = 2 * t['k'] * (theta - t['theta0'])
+    f = _scatter(n, t['indices'], -de[:, None, None] * dtheta)
+    ub = t['kub'] != 0
+    if np.any(ub):
+        ends = t['indices'][ub][:, [0, 2]]
+        s, ds = distance_gradients(coords, ends)
+        de = 2 * t['kub'][ub] * (s - t['s0'][ub])
+        f += _scatter(n, ends, -de[:, None, None] * ds)
+    result['angles'] = f
+
+    t = terms.dihedrals
+    phi, dphi = dihedral_gradients(coords, t['indices'])
+    de = -t['k'] * t['n'] * np.sin(t['n'] * phi - t['delta'])
+    result['dihedrals'] = _scatter(n, t['indices'], -de[:, None, None] * dphi)
+
+    t = terms.impropers
+    psi, dpsi = dihedral_gradients(coords, t['indices'])
+    de = 2 * t['k'] * bonded._periodic(psi - t['psi0'])
+    result['impropers'] = _scatter(n, t['indices'], -de[:, None, None] * dpsi)
+
+    return result
+
+
+def cmap_forces(terms, coords):
+    '''Returns {'cmaps': (natoms, 3) forces} of a CMapTerms'''
+    coords = np.asarray(coords, dtype=np.float64)
+    phi, dphi = dihedral_gradients(coords, terms.indices[:, :4])
+    psi, dpsi = dihedral_gradients(coords, terms.indices[:, 4:])
+
+    i, j, u, v = _cells(phi, psi)
+    c = terms.coeffs[terms.grid, i, j]
+    pu  = np.stack([np.ones_like(u), u, u*u, u*u*u], axis=-1)
+    pv  = np.stack([np.ones_like(v), v, v*v, v*v*v], axis=-1)
+    dpu = np.stack([np.zeros_like(u), np.ones_like(u), 2*u, 3*u*u], axis=-1)
+    dpv = np.stack([np.zeros_like(v), np.ones_like(v), 2*v, 3*v*v], axis=-1)
+
+    # per grid step to per radian
+    scale = np.degrees(1.0) / grid_step
+    de_phi = np.einsum('ik,ikl,il->i', dpu, c, pv) * scale
+    de_psi = np.einsum('ik,ikl,il->i', pu, c, dpv) * scale
+
+    f = _scatter(terms.natoms, terms.indices[:, :4], -de_phi[:, None, None] * dphi)
+    f += _scatter(terms.natoms, terms.indices[:, 4:], -de_psi[:, None, None] * dpsi)
+    return {'cmaps': f}
+
+
+def forces(terms, coords):
+    '''Returns the forces of a BondedTerms or CMapTerms as a dict of term class : (natoms, 3)'''
+    if isinstance(terms, CMapTerms):
+        return cmap_forces(terms, coords)
+    return bonded_forces(terms, coords)
+
+
+def _term_tables(terms):
+    # kind : dict of the (n, ...) arrays of the terms, with 'indices'
+    if isinstance(terms, CMapTerms):
+        return {'cmaps': {'indices': terms.indices, 'grid': terms.grid}}
+    return dict((kind, getattr(terms, kind)) for kind in bonded.term_classes)
+
+
+def _select_terms(terms, atoms):
+    # the terms with any of atoms, renumbered over the atoms that they use;
+    # returns (terms, the indices of those atoms in terms)
+    atoms = np.unique(atoms)
+    tables = {}
+    for kind, t in _term_tables(terms).items():
+        keep = _sorted_isin(t['indices'].ravel(), atoms).reshape(t['indices'].shape).any(axis=1)
+        tables[kind] = dict((k, v[keep]) for k, v in t.items())
+
+    used = np.unique(np.concatenate([t['indices'].ravel() for t in tables.values()] + [atoms]))
+    for t in tables.values():
+        t['indices'] = np.searchsorted(used, t['indices'])
+
+    if isinstance(terms, CMapTerms):
+        sub = object.__new__(CMapTerms)
+        sub.__dict__.update(terms.__dict__)
+        sub.indices, sub.grid = tables['cmaps']['indices'], tables['cmaps']['grid']
+        sub.natoms = len(used)
+    else:
+        sub = bonded.BondedTerms(terms.units, len(used))
+        for kind, t in tables.items():
+            setattr(sub, kind, t)
+    return sub, used
+
+
+def check_forces(terms, coords, atoms=32, delta=None, tolerance=1e-3, seed=0):
+    """ Compares the analytic forces with central finite differences.
+
+    Args:
+        terms     : BondedTerms or CMapTerms
+        coords    : (natoms, 3) array
+        atoms     : list of the atom indices to check, or the number of
+                    random atoms among the ones with terms
+        delta     : float, the displacement (default 1e-5 A or 1e-6 nm)
+        tolerance : float, the largest accepted error relative to the
+                    largest force component of the term class (or absolute
+                    below 1)
+
+    Returns:
+        dict of term class : {'max_error', 'max_force', 'passed'};
+        the errors are also logged
+
+    """
+
+    coords = np.asarray(coords, dtype=np.float64)
+    if delta is None:
+        delta = 1e-5 if terms.units == 'charmm' else 1e-6
+
+    if np.ndim(atoms) == 0:
+        used = [terms.indices] if isinstance(terms, CMapTerms) else \
+               [getattr(terms, kind)['indices'] for kind in bonded.term_classes]
+        used = np.unique(np.concatenate([u.ravel() for u in used]))
+        rng = np.random.RandomState(seed)
+        atoms = rng.choice(used, min(atoms, len(used)), replace=False) if len(used) else used
+    atoms = np.asarray(atoms, dtype=np.int64)
+
+    # the energies of the terms of each atom, displaced by (+x, -x, +y, ...),
+    # over the atoms of those terms only
+    selected, used = _select_terms(terms, atoms)
+    step = np.array([delta, -delta])
+    energies = dict((kind, np.zeros((len(atoms), 3, 2))) for kind in _term_tables(terms))
+    for k, ai in enumerate(atoms):
+        sub, sub_used = _select_terms(selected, np.searchsorted(used, [ai]))
+        frames = np.repeat(coords[used[sub_used]][None], 6, axis=0)
+        a = np.searchsorted(sub_used, np.searchsorted(used, ai))
+        for dim in range(3):
+            frames[2*dim:2*dim + 2, a, dim] += step
+        for kind, e in sub.energies(frames).items():
+            energies[kind][k] = np.asarray(e).reshape(3, 2)
+
+    # the forces on the atoms are from their terms only
+    analytic = forces(selected, coords[used])
+    local = np.searchsorted(used, atoms)
+
+    report = {}
+    for kind, e in energies.items():
+        numeric = -(e[:, :, 0] - e[:, :, 1]) / (2 * delta)
+        f = analytic[kind][local]
+
+        max_error = float(np.abs(numeric - f).max()) if len(atoms) else 0.0
+        max_force = float(np.abs(f).max()) if len(atoms) else 0.0
+        passed = max_error <= tolerance * max(max_force, 1.0)
+        report[kind] = {'max_error': max_error, 'max_force': max_force, 'passed': passed}
+
+        msg = 'forces of %s: max error %.3g for max force %.3g over %d atoms' % (
+            kind, max_error, max_force, len(atoms))
+        if passed:
+            module_logger.debug(msg)
+        else:
+            module_logger.warning(msg + ' - above the tolerance')
+
+    return report
+
+
+def compare_forces(terms1, terms2, coords, tolerance=1e-3):
+    """ Compares the forces of two representations of the same system, like
+    the terms of a PSFSystem and of the GroTop converted from it.
+
+    Args:
+        terms1, terms2 : BondedTerms or CMapTerms
+        coords         : (natoms, 3) array in A, converted to nm for the
+                         terms with 'gromacs' units
+        tolerance      : float, the largest accepted difference in kcal/mol/A
+                         relative to the largest force (or absolute below 1)
+
+    Returns:
+        dict of term class : {'max_error', 'max_force', 'passed'} for the
+        classes in both, in kcal/mol/A
+
+    """
+
+    coords = np.asarray(coords, dtype=np.float64)
+
+    def _forces(terms):
+        if terms.units == 'gromacs':
+            return dict((k, v / (kcal2kj * 10)) for k, v in forces(terms, coords * 0.1).items())
+        return forces(terms, coords)
+
+    f1 = _forces(terms1)
+    f2 = _forces(terms2)
+
+    report = {}
+    for kind in sorted(set(f1) & set(f2)):
+        max_error = float(np.abs(f1[kind] - f2[kind]).max()) if len(coords) else 0.0
+        max_force = float(np.abs(f1[kind]).max()) if len(coords) else 0.0
+        passed = max_error <= tolerance * max(max_force, 1.0)
+        report[kind] = {'max_error': max_error, 'max_force': max_force, 'passed': passed}
+        if not passed:
+            module_logger.warning('forces of %s differ by %.3g kcal/mol/A (max force %.3g)' % (
+                kind, max_error, max_force))
+
+    return report
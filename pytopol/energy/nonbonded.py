@@ -0,0 +1,401 @@
+"""
+Nonbonded (Lennard-Jones and Coulomb) energies with a cell-list search.
+
+The atoms are binned into columns of cells and sorted by z in each column
+(see cell_candidates), and the candidate pairs of all the atoms with one
+neighbor column are generated and evaluated at once, so the cost grows
+linearly with the number of atoms.
+
+The 1-2 and 1-3 pairs (bonds, angles and Molecule.exclusions) are excluded
+- or, with nrexcl, the atoms up to nrexcl bonds apart as in GROMACS - and
+the 1-4 pairs (Molecule.pairs) are computed separately, with the 1-4 LJ
+parameters and a scaled Coulomb, without cutoff.
+
+"""
+
+import logging
+import numpy as np
+from pytopol.parsers.utils import build_index_array, bond_graph, exclusion_lists, _sorted_isin
+
+module_logger = logging.getLogger('mainapp.nonbonded')
+
+# Coulomb constants of NAMD (kcal/mol A e^-2) and GROMACS (kJ/mol nm e^-2)
+coulomb_constants = {
+    'charmm' : 332.0636,
+    'gromacs': 138.935458,
+}
+
+
+
+class NonbondedTerms(object):
+    def __init__(self, mol, atomtypes, interactiontypes=(), scale14=None, scale14_lj=None, nrexcl=None,
+                 defaults=None):
+        """ Nonbonded parameters of the atoms of a Molecule.
+
+        Args:
+            mol              : blocks.Molecule with atoms (atomtype, charge), bonds,
+                               angles, pairs and exclusions
+            atomtypes        : list of AtomType, all 'charmm' or all 'gromacs'
+            interactiontypes : list of InteractionType, NBFIX for 'charmm'
+                               or pairtypes for 'gromacs'
+            scale14          : float, scaling of the 1-4 Coulomb (fudgeQQ), default
+                               from defaults or 1.0
+            scale14_lj       : float, scaling of the 1-4 LJ without explicit
+                               1-4 parameters (fudgeLJ), default from defaults or 1.0
+            nrexcl           : int or None, if given the atoms up to nrexcl bonds
+                               apart are excluded instead of the bonds and angles
+                               (see utils.exclusion_lists)
+            defaults         : dict like GroTop.defaults, the comb-rule (1, 2 or 3,
+                               default 2), gen-pairs and fudgeLJ/fudgeQQ of a
+                               'gromacs' topology
+
+        Attributes:
+            units   : 'charmm' (kcal/mol, A) or 'gromacs' (kJ/mol, nm)
+            charges : (natoms,) array
+            types   : (natoms,) index of the atom types
+            A, B    : (ntypes, ntypes) LJ coefficients, E = A/r^12 - B/r^6
+            A14, B14: the same for the 1-4 pairs
+            pairs   : (n, 2) 1-4 pairs
+            excluded: sorted int64 keys i*natoms+j (i<j) of the excluded pairs
+
+        """
+
+        self.lgr = logging.getLogger('mainapp.nonbonded.NonbondedTerms')
+
+        formats = set(at.format for at in atomtypes)
+        if len(formats) != 1:
+            raise ValueError('expected the atom types in one format, got: %s' % ', '.join(formats))
+        self.units = formats.pop()
+
+        defaults = defaults or {}
+        if scale14 is None:
+            scale14 = defaults.get('fudgeQQ') or 1.0
+        if scale14_lj is None:
+            scale14_lj = defaults.get('fudgeLJ') or 1.0
+
+        self.natoms  = len(mol.atoms)
+        self.scale14 = scale14
+        self.charges = np.array([a.charge for a in mol.atoms], dtype=np.float64)
+
+        names = [at.atype for at in atomtypes]
+        type_index = dict((name, i) for i, name in enumerate(names))
+        missing = set(a.atomtype for a in mol.atoms) - set(type_index)
+        if missing:
+            raise ValueError('no nonbonded parameters for the atom types: %s' % ' '.join(sorted(missing)))
+        self.types = np.array([type_index[a.atomtype] for a in mol.atoms], dtype=np.int64)
+
+        self.A, self.B, self.A14, self.B14 = self._lj_tables(atomtypes, interactiontypes, type_index,
+                                                             scale14_lj, defaults)
+
+        self.pairs = self._indices(mol, 'pairs')
+        self.excluded = self._exclusions(mol, nrexcl)
+
+        # without gen-pairs, all the 1-4 pairs need pairtypes
+        if self.units == 'gromacs' and str(defaults.get('gen-pairs', 'yes')).lower() == 'no':
+            missing = np.isnan(self.A14[self.types[self.pairs[:, 0]], self.types[self.pairs[:, 1]]])
+            if missing.any():
+                i, j = self.pairs[np.argmax(missing)]
+                raise ValueError('gen-pairs is no and there is no pairtype for %s %s' % (
+                    mol.atoms[i].atomtype, mol.atoms[j].atomtype))
+
+
+    def __repr__(self):
+        return 'NonbondedTerms (%s) with %d atoms, %d 1-4 pairs and %d exclusions' % (
+            self.units, self.natoms, len(self.pairs), len(self.excluded))
+
+
+    @staticmethod
+    def _indices(mol, kind):
+        if len(getattr(mol, kind)) == 0:
+            return np.zeros((0, 2), dtype=np.int64)
+        return build_index_array(mol, kind)
+
+
+    def _exclusions(self, mol, nrexcl=None):
+        # the 1-2, 1-3 (or up to nrexcl bonds) and 1-4 pairs, and the explicit exclusions
+        bonds = self._indices(mol, 'bonds')
+        parts = [self.pairs]
+        if nrexcl is not None:
+            excl_offsets, excluded = exclusion_lists(*bond_graph(bonds, self.natoms), nrexcl=nrexcl)
+            parts.append(np.stack([np.repeat(np.arange(self.natoms), np.diff(excl_offsets)), excluded], axis=1))
+        else:
+            parts.append(bonds)
+            if len(mol.angles):
+                parts.append(build_index_array(mol, 'angles')[:, [0, 2]])
+
+        if len(mol.exclusions):
+            index = dict((atom, i) for i, atom in enumerate(mol.atoms))
+            parts.append(np.array([(index[ex.main_atom], index[other])
+                                   for ex in mol.exclusions for other in ex.other_atoms],
+                                  dtype=np.int64).reshape(-1, 2))
+
+        pairs = np.concatenate(parts)
+        return np.unique(self._keys(pairs[:, 0], pairs[:, 1]))
+
+
+    def _keys(self, i, j):
+        return np.minimum(i, j) * self.natoms + np.maximum(i, j)
+
+
+    def _lj_tables(self, atomtypes, interactiontypes, type_index, scale14_lj, defaults):
+        # (ntypes, ntypes) tables of the A and B coefficients
+        if self.units == 'charmm':
+            # E = eps [(Rmin/r)^12 - 2 (Rmin/r)^6], eps_ij = sqrt(eps_i eps_j), Rmin_ij = Rmin/2_i + Rmin/2_j
+            eps  = np.array([abs(at.charmm['param']['lje']) for at in atomtypes])
+            rmin = np.array([at.charmm['param']['ljl'] for at in atomtypes])
+            eps14  = np.array([abs(at.charmm['param']['lje14']) if at.charmm['param']['lje14'] is not None
+                               else abs(at.charmm['param']['lje']) for at in atomtypes])
+            rmin14 = np.array([at.charmm['param']['ljl14'] if at.charmm['param']['ljl14'] is not None
+                               else at.charmm['param']['ljl'] for at in atomtypes])
+
+            def _table(e, r):
+                e_ij = np.sqrt(np.outer(e, e))
+                r_ij = r[:, None] + r[None, :]
+                return e_ij, r_ij
+
+            e_ij, r_ij = _table(eps, rmin)
+            e14_ij, r14_ij = _table(eps14, rmin14)
+
+            # NBFIX replaces the combined parameters, also for the 1-4 pairs
+            for it in interactiontypes:
+                i, j = type_index.get(it.atype1), type_index.get(it.atype2)
+                if i is None or j is None:
+                    continue
+                e, r = abs(it.charmm['param']['lje']), it.charmm['param']['ljl']
+                for tab_e, tab_r in ((e_ij, r_ij), (e14_ij, r14_ij)):
+                    tab_e[i, j] = tab_e[j, i] = e
+                    tab_r[i, j] = tab_r[j, i] = r
+
+            A, B = e_ij * r_ij**12, 2 * e_ij * r_ij**6
+            A14, B14 = e14_ij * r14_ij**12, 2 * e14_ij * r14_ij**6
+
+        else:
+            # comb-rule 1: E = C12/r^12 - C6/r^6 with the geometric mean of C6 (ljl) and
+            # C12 (lje); 2 and 3: E = 4 eps [(sig/r)^12 - (sig/r)^6] with the geometric
+            # mean of eps and the arithmetic (2) or geometric (3) mean of sig
+            rule = defaults.get('comb-rule') or 2
+            if rule not in (1, 2, 3):
+                raise ValueError('unknown combination rule: %s' % rule)
+
+            def _coefficients(e, s):
+                if rule == 1:
+                    return e, s
+                return 4 * e * s**12, 4 * e * s**6
+
+            lje = np.array([at.gromacs['param']['lje'] for at in atomtypes])
+            ljl = np.array([at.gromacs['param']['ljl'] for at in atomtypes])
+            e_ij = np.sqrt(np.outer(lje, lje))
+            if rule == 2:
+                l_ij = 0.5 * (ljl[:, None] + ljl[None, :])
+            else:
+                l_ij = np.sqrt(np.outer(ljl, ljl))
+            A, B = _coefficients(e_ij, l_ij)
+
+            # the generated 1-4 pairs are scaled by fudgeLJ, without gen-pairs
+            # they are missing (nan) unless given by the pairtypes
+            if str(defaults.get('gen-pairs', 'yes')).lower() == 'no':
+                A14, B14 = np.full_like(A, np.nan), np.full_like(B, np.nan)
+            else:
+                A14, B14 = A * scale14_lj, B * scale14_lj
+
+            # pairtypes
+            for it in interactiontypes:
+                i, j = type_index.get(it.atype1), type_index.get(it.atype2)
+                if i is None or j is None:
+                    continue
+                a, b = _coefficients(it.gromacs['param']['lje14'], it.gromacs['param']['ljl14'])
+                A14[i, j] = A14[j, i] = a
+                B14[i, j] = B14[j, i] = b
+
+        return A, B, A14, B14
+
+
+    def energies(self, coords, cutoff=None, shift=False, units=None):
+        """ LJ and Coulomb energies.
+
+        Args:
+            coords : (natoms, 3) array, in A for 'charmm' and nm for 'gromacs';
+                     or (nframes, natoms, 3), evaluated frame by frame
+            cutoff : float, default 12 A or 1.2 nm
+            shift  : bool, shift the LJ and Coulomb potentials to zero at the
+                     cutoff (the 1-4 pairs are not shifted)
+            units  : 'kcal/mol' or 'kJ/mol', default is the units of the terms
+
+        Returns:
+            dict with 'lj', 'coulomb', 'lj14' and 'coulomb14' (floats, or
+            (nframes,) arrays for a stack of frames)
+
+        """
+
+        coords = np.asarray(coords, dtype=np.float64)
+        if coords.ndim == 3:
+            frames = [self.energies(x, cutoff, shift, units) for x in coords]
+            return dict((k, np.array([e[k] for e in frames])) for k in ('lj', 'coulomb', 'lj14', 'coulomb14'))
+
+        if coords.shape != (self.natoms, 3):
+            raise ValueError('expected coordinates for %d atoms, got shape %s' % (
+                self.natoms, coords.shape))
+
+        if cutoff is None:
+            cutoff = 12.0 if self.units == 'charmm' else 1.2
+
+        native = 'kcal/mol' if self.units == 'charmm' else 'kJ/mol'
+        units  = units or native
+        if units not in ('kcal/mol', 'kJ/mol'):
+            raise ValueError('unknown units: %s' % units)
+        factor = 1.0
+        if units != native:
+            factor = 4.184 if native == 'kcal/mol' else 1.0 / 4.184
+
+        kc = coulomb_constants[self.units]
+        cut2 = cutoff * cutoff
+        ic6 = 1.0 / cut2**3
+        nt = len(self.A)
+        A, B = self.A.ravel(), self.B.ravel()
+
+        # all the pairs within the cutoff, the atoms in the order of the cells
+        order, columns = cell_candidates(coords, cutoff)
+        xs, ys, zs = [coords[order, j].copy() for j in range(3)]
+        qs = self.charges[order] * kc
+        ts = self.types[order]
+        tn = ts * nt
+
+        e_lj, e_coul = 0.0, 0.0
+        for count, b in columns:
+            d = np.repeat(xs, count) - xs[b]
+            r2 = d * d
+            d = np.repeat(ys, count) - ys[b]
+            r2 += d * d
+            d = np.repeat(zs, count) - zs[b]
+            r2 += d * d
+
+            # the pairs within the cutoff that are not excluded
+            within = r2 < cut2
+            w = np.flatnonzero(within)
+            keys = self._keys(np.repeat(order, count)[w], order[b[w]])
+            within[w[_sorted_isin(keys, self.excluded)]] = False
+
+            ir2 = np.zeros_like(r2)
+            np.divide(1.0, r2, out=ir2, where=within)
+            ir6 = ir2 * ir2 * ir2
+            t = np.repeat(tn, count) + ts[b]
+            a_t, b_t = A[t], B[t]
+            qq = np.repeat(qs, count) * qs[b]
+
+            e_lj += ((a_t * ir6 - b_t) * ir6).sum()
+            e_coul += (qq * np.sqrt(ir2)).sum() / kc
+            if shift:
+                e_lj -= ((a_t * ic6 - b_t) * within).sum() * ic6
+                e_coul -= (qq * within).sum() / kc / cutoff
+
+        # 1-4 pairs
+        i, j = self.pairs[:, 0], self.pairs[:, 1]
+        lj14, coul14 = self._pair_energies(coords, i, j, self.A14.ravel(), self.B14.ravel(), kc)
+
+        return {
+            'lj'       : float(e_lj) * factor,
+            'coulomb'  : float(e_coul) * factor,
+            'lj14'     : float(lj14.sum()) * factor,
+            'coulomb14': float(coul14.sum()) * self.scale14 * factor,
+        }
+
+
+    @staticmethod
+    def _distances2(coords, i, j):
+        d = coords[i] - coords[j]
+        return np.einsum('ij,ij->i', d, d)
+
+
+    def _pair_energies(self, coords, i, j, A, B, kc):
+        # LJ and Coulomb of each (i, j) pair, without cutoff
+        r2 = self._distances2(coords, i, j)
+        t = self.types[i] * len(self.A) + self.types[j]
+        ir6 = 1.0 / r2**3
+        return (A[t] * ir6 - B[t]) * ir6, kc * self.charges[i] * self.charges[j] / np.sqrt(r2)
+
+
+
+def cell_candidates(coords, cutoff, ncells=3):
+    """ Cell-list search of the candidate neighbors of the atoms.
+
+    The x-y plane is divided into square cells with an edge of cutoff/ncells
+    and the atoms of each column of cells are sorted by z, so the candidate
+    neighbors of an atom in a column are one contiguous range, narrowed by
+    the lateral distance to the column. Only the columns in one half-plane
+    are visited to find each pair once.
+
+    Returns:
+        (order, columns) - order sorts the atoms by column and z, columns
+        yields (count, b) for each neighbor column: the k-th atom in that
+        order has the candidates b[sum(count[:k]):sum(count[:k+1])], also
+        indices in that order. The candidates include all the pairs closer
+        than cutoff and some farther ones; there are no periodic images.
+
+    """
+
+    coords = np.asarray(coords, dtype=np.float64)
+    natoms = len(coords)
+
+    w = float(cutoff) / ncells
+    lo = coords.min(axis=0) if natoms else np.zeros(3)
+    cell = np.floor((coords[:, :2] - lo[:2]) / w).astype(np.int64) + ncells   # empty columns around
+    dims = cell.max(axis=0) + ncells + 1 if natoms else np.ones(2, dtype=np.int64)
+    column = cell[:, 0] * dims[1] + cell[:, 1]
+
+    # sorted by column and z: key = column * span + z
+    z = coords[:, 2] - lo[2] + cutoff
+    span = (z.max() if natoms else 0) + 2 * cutoff
+    key = column * span + z
+    order = np.argsort(key, kind='stable')
+
+    def _columns():
+        k, xy, c, col, zz = key[order], coords[order, :2] - lo[:2], cell[order], column[order], z[order]
+        cut2 = cutoff * cutoff
+        atoms = np.arange(natoms)
+        for dx in range(0, ncells+1):
+            for dy in range(-ncells, ncells+1):
+                if dx == 0 and dy < 0:
+                    continue
+
+                # lateral distance to the cells of the neighbor column
+                gap_x = np.maximum(0.0, np.maximum((c[:, 0] + dx - ncells) * w - xy[:, 0],
+                                                   xy[:, 0] - (c[:, 0] + dx + 1 - ncells) * w))
+                gap_y = np.maximum(0.0, np.maximum((c[:, 1] + dy - ncells) * w - xy[:, 1],
+                                                   xy[:, 1] - (c[:, 1] + dy + 1 - ncells) * w))
+                h2 = cut2 - gap_x**2 - gap_y**2
+                h = np.sqrt(np.maximum(h2, 0.0))
+
+                base = (col + dx * dims[1] + dy) * span + zz
+                if dx == 0 and dy == 0:
+                    first = atoms + 1
+                else:
+                    first = np.searchsorted(k, base - h)
+                last = np.searchsorted(k, base + h, side='right')
+                count = np.where(h2 > 0, np.maximum(last - first, 0), 0)
+
+                total = count.sum()
+                if total == 0:
+                    continue
+                b = np.arange(total) + np.repeat(first - (np.cumsum(count) - count), count)
+                yield count, b
+
+    return order, _columns()
+
+
+def neighbor_pairs(coords, cutoff):
+    """ All the pairs of atoms closer than cutoff (see cell_candidates).
+
+    Yields (i, j, r2) arrays for each neighbor column, r2 the squared distance.
+
+    """
+
+    coords = np.asarray(coords, dtype=np.float64)
+    order, columns = cell_candidates(coords, cutoff)
+    x = coords[order]
+    atoms = np.arange(len(coords))
+    for count, b in columns:
+        a = np.repeat(atoms, count)
+        d = x[a] - x[b]
+        r2 = np.einsum('ij,ij->i', d, d)
+        within = np.flatnonzero(r2 < cutoff * cutoff)
+        yield order[a[within]], order[b[within]], r2[within]
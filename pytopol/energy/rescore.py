@@ -0,0 +1,108 @@
+"""
+Energy rescoring of an ensemble of frames.
+
+The frames (like the models of a multi-model PDB file) are read in batches
+of (nframes, natoms, 3) arrays and every batch goes through the vectorized
+kernels of all the term objects (BondedTerms, CMapTerms, NonbondedTerms).
+The batches are scored by a pool of worker threads - NumPy releases the
+GIL in its kernels - while the next batches are being read.
+
+"""
+
+import collections
+import logging
+import multiprocessing
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+module_logger = logging.getLogger('mainapp.rescore')
+
+
+
+def pdb_frames(pdb, batch_size=16):
+    """ The models of a PDBSystem in batches.
+
+    Args:
+        pdb        : PDBSystem, pdb.coords has the coordinates of all the models
+        batch_size : int, number of models in a batch
+
+    Yields:
+        (nframes, natoms, 3) views of pdb.coords, in A
+
+    """
+
+    for start in range(0, len(pdb.coords), batch_size):
+        yield pdb.coords[start:start + batch_size]
+
+
+def rescore(frames, terms, units='kcal/mol', workers=None):
+    """ Per-frame energies of each term.
+
+    Args:
+        frames  : iterable of (nframes, natoms, 3) batches in A (see pdb_frames)
+        terms   : list of the term objects, the coordinates are converted to
+                  nm for the ones with 'gromacs' units
+        units   : 'kcal/mol' or 'kJ/mol'
+        workers : int, number of worker threads (default: number of CPUs),
+                  1 to score the batches in this thread
+
+    Returns:
+        dict of column : (nframes,) array, with 'frame', one column for each
+        term (like 'bonds' or 'lj') and 'total'
+
+    """
+
+    def _score(batch):
+        result = {}
+        for t in terms:
+            x = batch * 0.1 if t.units == 'gromacs' else batch
+            for k, v in t.energies(x, units=units).items():
+                if k in result:
+                    raise ValueError('the term %s is evaluated twice' % k)
+                result[k] = np.atleast_1d(v)
+        return len(batch), result
+
+    columns = {}
+    nframes = [0]
+
+    def _collect(scored):
+        n, result = scored
+        nframes[0] += n
+        for k, v in result.items():
+            columns.setdefault(k, []).append(v)
+
+    if workers == 1:
+        for batch in frames:
+            _collect(_score(np.asarray(batch, dtype=np.float64)))
+    else:
+        # at most two batches per worker are in flight, so the frames are streamed
+        workers = workers or multiprocessing.cpu_count()
+        pool = ThreadPool(workers)
+        pending = collections.deque()
+        try:
+            for batch in frames:
+                pending.append(pool.apply_async(_score, (np.asarray(batch, dtype=np.float64),)))
+                if len(pending) >= 2 * workers:
+                    _collect(pending.popleft().get())
+            while pending:
+                _collect(pending.popleft().get())
+        finally:
+            pool.close()
+            pool.join()
+
+    nframes = nframes[0]
+    table = dict((k, np.concatenate(v)) for k, v in columns.items())
+    table['total'] = sum(table.values()) if table else np.zeros(0)
+    table['frame'] = np.arange(nframes)
+    module_logger.debug('rescored %d frames' % nframes)
+    return table
+
+
+def write_table(table, fname, units='kcal/mol'):
+    '''Writes the table of rescore as text, one line per frame'''
+    terms = sorted(k for k in table if k not in ('frame', 'total')) + ['total']
+    with open(fname, 'w') as f:
+        f.write('# energies in %s\n' % units)
+        f.write('{:>7s}'.format('frame') + ''.join('{:>16s}'.format(k) for k in terms) + '\n')
+        for i, frame in enumerate(table['frame']):
+            f.write('{:7d}'.format(frame) + ''.join('{:16.6f}'.format(table[k][i]) for k in terms) + '\n')
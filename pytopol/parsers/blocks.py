@@ -1,3 +1,5 @@
+import bisect
+import numpy as np
 
 
 class System(object):
@@ -19,6 +21,222 @@ class System(object):
 
 
 
+class MoleculeBlocks(object):
+    """ Run-length list of molecules, as in the [ molecules ] section.
+
+    Holds (Molecule, count) blocks instead of one reference per copy. It can be
+    used like a tuple of molecules (len, iteration, indexing) - the copies are
+    expanded lazily and never stored.
+
+        blocks  = list of [Molecule, int], only changed by add
+    """
+
+    def __init__(self):
+        self.blocks = []
+        self._ends  = []    # cumulative counts: the molecules of block k end at _ends[k]
+
+    def add(self, mol, count):
+        if count == 0:
+            return
+        if len(self.blocks) > 0 and self.blocks[-1][0] is mol:
+            self.blocks[-1][1] += count
+            self._ends[-1] += count
+        else:
+            self.blocks.append([mol, count])
+            self._ends.append(len(self) + count)
+
+    def __len__(self):
+        return self._ends[-1] if self._ends else 0
+
+    def __iter__(self):
+        for mol, n in self.blocks:
+            for i in range(n):
+                yield mol
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return tuple(self[k] for k in range(*i.indices(len(self))))
+
+        if i < 0:
+            i += len(self)
+        if 0 <= i < len(self):
+            return self.blocks[bisect.bisect_right(self._ends, i)][0]
+
+        raise IndexError('molecule index out of range')
+
+    def __repr__(self):
+        return 'MoleculeBlocks(%s)' % ', '.join('%s x %d' % (m.name, n) for m, n in self.blocks)
+
+    def iter_blocks(self):
+        '''Yields (Molecule, count) for each block'''
+        for mol, n in self.blocks:
+            yield mol, n
+
+    def iter_offsets(self):
+        '''Yields (Molecule, index of its first atom in the system) for every copy'''
+        offset = 0
+        for mol, n in self.blocks:
+            natoms = len(mol.atoms)
+            for i in range(n):
+                yield mol, offset
+                offset += natoms
+
+    def total(self, kind='atoms'):
+        '''Total number of atoms, bonds, angles, ... in the system'''
+        return sum(len(getattr(mol, kind)) * n for mol, n in self.blocks)
+
+
+
+class TermArray(object):
+    """ Bonded terms of a Molecule stored as arrays.
+
+    Behaves like the list of term objects (len, iteration, indexing), but the
+    objects are only built when they are accessed.
+
+        indices = (n, k) int array, zero-based atom indices
+        func    = (n,) int array, function types
+        params  = (n, p) float array, parameters given on the term lines (nan if missing)
+    """
+
+    def __init__(self, cls, format, atoms, atom_names, indices, func, params=None):
+        self.cls        = cls          # like BondType
+        self.format     = format
+        self.atoms      = atoms        # Molecule.atoms
+        self.atom_names = atom_names   # like ('atom1', 'atom2')
+
+        self.indices = indices
+        self.func    = func
+        self.params  = params
+
+        self._objects = None
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __getitem__(self, i):
+        return self.tolist()[i]
+
+    def tolist(self):
+        '''Builds (once) and returns the list of term objects'''
+        if self._objects is None:
+            objects = []
+            atoms = self.atoms
+            for row, fu in zip(self.indices.tolist(), self.func.tolist()):
+                t = self.cls(self.format)
+                for name, ai in zip(self.atom_names, row):
+                    setattr(t, name, atoms[ai])
+                getattr(t, self.format)['func'] = fu
+                objects.append(t)
+            self._objects = objects
+
+        return self._objects
+
+
+
+class ResidueArray(object):
+    """ Residues and chains of a Molecule stored as run-length arrays.
+
+    Behaves like the list of Residue objects (len, iteration, indexing), but the
+    Residue and Chain objects are only built when they are accessed. Building
+    them also sets atom.residue and residue.chain. The atoms keep a reference
+    to their ResidueArray, so atom.residue also builds them on first access.
+
+        names, numbers, chain_names = (nres,) arrays
+        offsets       = (nres+1,) int array, residue i has atoms[offsets[i]:offsets[i+1]]
+        chain_offsets = (nchains+1,) int array, chain j has residues[chain_offsets[j]:chain_offsets[j+1]]
+    """
+
+    def __init__(self, atoms, names, numbers, chain_names, offsets, chain_offsets):
+        self.atoms       = atoms        # Molecule.atoms
+        self.names       = names
+        self.numbers     = numbers
+        self.chain_names = chain_names
+
+        self.offsets       = offsets
+        self.chain_offsets = chain_offsets
+
+        self._objects = None
+        self._chains  = None
+
+        # the residues of an earlier ResidueArray of the atoms are replaced
+        for a in atoms:
+            d = a.__dict__
+            d['_residues'] = self
+            if 'residue' in d:
+                del d['residue']
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __getitem__(self, i):
+        return self.tolist()[i]
+
+    def atom_residues(self):
+        '''Returns the index of the residue of each atom'''
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    def tolist(self):
+        '''Builds (once) and returns the list of Residue objects'''
+        if self._objects is None:
+            objects = []
+            atoms = self.atoms
+            offsets = self.offsets.tolist()
+            for i, (name, numb, chain_name) in enumerate(zip(
+                    self.names.tolist(), self.numbers.tolist(), self.chain_names.tolist())):
+                R = Residue()
+                R.name = name
+                R.number = numb
+                R.chain_name = chain_name
+                R.atoms = list(atoms[offsets[i]:offsets[i+1]])
+                for a in R.atoms:
+                    a.residue = R
+                objects.append(R)
+
+            chains = []
+            offsets = self.chain_offsets.tolist()
+            for j in range(len(offsets) - 1):
+                C = Chain()
+                C.residues = objects[offsets[j]:offsets[j+1]]
+                C.name = C.residues[0].chain_name
+                for R in C.residues:
+                    R.chain = C
+                chains.append(C)
+
+            self._objects = objects
+            self._chains  = chains
+
+        return self._objects
+
+    def chains(self):
+        '''Builds (once) and returns the list of Chain objects'''
+        self.tolist()
+        return self._chains
+
+
+
+class ChainArray(object):
+    '''The chains of a ResidueArray, built with the residues when they are accessed'''
+
+    def __init__(self, residues):
+        self.residues = residues
+
+    def __len__(self):
+        return len(self.residues.chain_offsets) - 1
+
+    def __iter__(self):
+        return iter(self.residues.chains())
+
+    def __getitem__(self, i):
+        return self.residues.chains()[i]
+
+
+
 class Molecule(object):
 
     def __init__(self):
@@ -127,11 +345,25 @@ class Atom(object):
 
     """
 
-    def __init__(self):
-
-        self.coords = []        # a list of coordinates (x,y,z) of models
-        self.altlocs= []        # a list of (altloc_name, (x,y,z), occup, bfactor)
-
+    # the lists that are created on first access (see __getattr__), so the
+    # parsers build one object per atom:
+    #   coords  : coordinates (x,y,z) of the models, (nmodels, 3) view into PDBSystem.coords
+    #   altlocs : a list of (altloc_name, (x,y,z), occup, bfactor)
+    _lazy_lists = ('coords', 'altlocs')
+
+
+    def __getattr__(self, name):
+        if name in self._lazy_lists:
+            value = self.__dict__[name] = []
+            return value
+
+        # atom.residue is built by the ResidueArray of the atom on first access
+        if name == 'residue':
+            residues = self.__dict__.get('_residues')
+            if residues is not None:
+                residues.tolist()
+                return self.__dict__['residue']
+        raise AttributeError(name)
 
 
 
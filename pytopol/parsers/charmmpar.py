@@ -2,7 +2,7 @@
 import os, logging, time
 from pytopol.parsers.psf import PSFSystem
 from pytopol.parsers.par import ParType
-import blocks
+from pytopol.parsers import blocks
 
 
 module_logger = logging.getLogger('mainapp.charmmpar')
@@ -0,0 +1,240 @@
+"""
+A minimal C-preprocessor for GROMACS topologies.
+
+Supports the directives that grompp understands: #include, #define, #undef,
+#ifdef, #ifndef, #else and #endif. Included files are cached by the hash of
+their content, so force-field files shared by many topologies are read and
+tokenized only once per process.
+
+"""
+
+import os
+import re
+import hashlib
+import logging
+import numpy as np
+
+module_logger = logging.getLogger('mainapp.cpp')
+
+_comment_re = re.compile(';.*')
+
+
+def lines_starting_with(lines, chars):
+    """ Indices of the lines whose first character is one of chars.
+
+    Args:
+        lines : list of non-empty str without newlines (like Preprocessor.lines)
+        chars : str of ascii characters
+
+    Returns:
+        list of int
+
+    """
+    if len(lines) == 0:
+        return []
+
+    # the first bytes of the lines in the joined text
+    data = np.frombuffer('\n'.join(lines).encode('utf-8'), dtype=np.uint8)
+    first = data[np.concatenate(([0], np.flatnonzero(data == 10) + 1))]
+
+    found = np.zeros(len(first), dtype=bool)
+    for c in chars:
+        found |= first == ord(c)
+    return np.flatnonzero(found).tolist()
+
+
+
+class Preprocessor(object):
+
+    # content hash : tuple of cleaned lines - shared by all instances
+    cache = {}
+
+    max_depth = 32
+
+    def __init__(self, include_dirs=None, defines=None):
+        """ Constructor.
+
+        Args:
+            include_dirs : list of directories to search for the included files,
+                           after the directory of the including file. The
+                           directories in GMXLIB are searched last.
+            defines      : dict of initial macros (name : value or '')
+
+        Attributes:
+            lgr          : logging.Logger
+            include_dirs : list of str
+            defines      : dict, the current macros
+            included     : list of paths of all the included files
+
+        """
+
+        self.lgr = logging.getLogger('mainapp.cpp.Preprocessor')
+
+        self.include_dirs = list(include_dirs) if include_dirs else []
+        gmxlib = os.environ.get('GMXLIB', '')
+        self.include_dirs += [d for d in gmxlib.split(os.pathsep) if d]
+
+        self.defines  = dict(defines) if defines else {}
+        self.included = []
+
+
+    @classmethod
+    def clear_cache(cls):
+        cls.cache.clear()
+
+
+    def lines(self, fname):
+        '''Returns the processed lines of fname (no comments, no directives, macros expanded)'''
+        if not os.path.exists(fname):
+            raise IOError("the '%s' topology file doesn't exist" % fname)
+
+        with open(fname, 'rb') as f:
+            data = f.read()
+
+        result = []
+        self._process(self._clean(data), fname, 0, result)
+        return result
+
+
+    def _read(self, fname):
+        # cleaned lines of an included file, from the cache if possible
+        with open(fname, 'rb') as f:
+            data = f.read()
+
+        key = hashlib.sha1(data).hexdigest()
+        if key not in self.cache:
+            self.cache[key] = self._clean(data)
+        else:
+            self.lgr.debug("using cached include file: %s" % fname)
+
+        return self.cache[key]
+
+
+    @staticmethod
+    def _clean(data):
+        # strips the comments and empty lines and joins the continued lines
+        text = data.decode('utf-8', 'replace')
+
+        if '\\' in text:
+            lines = text.splitlines()
+            joined = []
+            cont = ''
+            for line in lines:
+                line = line.split(';', 1)[0].rstrip()
+                if line.endswith('\\'):
+                    cont += line[:-1] + ' '
+                else:
+                    joined.append(cont + line)
+                    cont = ''
+            joined.append(cont)
+            lines = joined
+
+        else:
+            if ';' in text:
+                text = _comment_re.sub('', text)
+            lines = text.splitlines()
+
+        return tuple(filter(None, map(str.strip, lines)))
+
+
+    def _find_include(self, name, current):
+        if name.startswith('"') and name.endswith('"'):
+            dirs = [os.path.dirname(os.path.abspath(current))] + self.include_dirs
+        elif name.startswith('<') and name.endswith('>'):
+            dirs = self.include_dirs
+        else:
+            raise ValueError('bad #include in %s: %s' % (current, name))
+
+        name = name[1:-1]
+        for d in dirs:
+            path = os.path.join(d, name)
+            if os.path.exists(path):
+                return path
+
+        raise IOError("the included file '%s' (from %s) was not found in: %s" % (
+            name, current, ', '.join(dirs)))
+
+
+    def _expand(self, lines):
+        # replaces the macros that have a value
+        macros = dict((k, v) for k, v in self.defines.items() if v)
+        if len(macros) == 0:
+            return lines
+
+        names = set(macros)
+        result = []
+        for line in lines:
+            fields = line.split()
+            if not names.isdisjoint(fields):
+                line = ' '.join(macros.get(f, f) for f in fields)
+            result.append(line)
+        return result
+
+
+    def _process(self, lines, fname, depth, result):
+        # appends the active data lines of lines to result
+        if depth > self.max_depth:
+            raise ValueError('#include nested too deeply in %s' % fname)
+
+        # one (active, seen_else) item for each open #ifdef/#ifndef
+        stack  = []
+        active = True
+
+        directives = lines_starting_with(lines, '#')
+        directives.append(len(lines))
+
+        start = 0
+        for i in directives:
+            # the data lines before this directive
+            if active and i > start:
+                result.extend(self._expand(lines[start:i]))
+            start = i + 1
+
+            if i == len(lines):
+                break
+
+            line = lines[i]
+            fields = line[1:].split(None, 2)
+            directive = fields[0] if fields else ''
+
+            if directive in ('ifdef', 'ifndef'):
+                if len(fields) < 2:
+                    raise ValueError('#%s without a macro name in %s' % (directive, fname))
+                stack.append((active, False))
+                defined = fields[1] in self.defines
+                active = active and (defined if directive == 'ifdef' else not defined)
+
+            elif directive == 'else':
+                if len(stack) == 0 or stack[-1][1]:
+                    raise ValueError('unexpected #else in %s' % fname)
+                parent, seen_else = stack[-1]
+                stack[-1] = (parent, True)
+                active = parent and not active
+
+            elif directive == 'endif':
+                if len(stack) == 0:
+                    raise ValueError('unexpected #endif in %s' % fname)
+                active = stack.pop()[0]
+
+            elif not active:
+                continue
+
+            elif directive == 'define':
+                if len(fields) < 2:
+                    raise ValueError('#define without a macro name in %s' % fname)
+                self.defines[fields[1]] = fields[2] if len(fields) == 3 else ''
+
+            elif directive == 'undef':
+                self.defines.pop(fields[1], None)
+
+            elif directive == 'include':
+                path = self._find_include(' '.join(fields[1:]), fname)
+                self.included.append(path)
+                self.lgr.debug("including: %s" % path)
+                self._process(self._read(path), path, depth+1, result)
+
+            else:
+                raise ValueError('unsupported preprocessor directive in %s: %s' % (fname, line))
+
+        if len(stack) != 0:
+            raise ValueError('missing #endif in %s' % fname)
@@ -0,0 +1,243 @@
+"""
+NAMD/CHARMM DCD trajectories.
+
+A DCD file is a sequence of Fortran records (each one between two int32
+lengths): a header with the 20 control integers, the title, the number of
+atoms and - with fixed atoms - the indices of the free atoms. Each frame then
+has an optional unit cell record (6 float64) and one float32 record for each
+of X, Y and Z. With fixed atoms only the first frame has all the atoms, the
+others have the free atoms only.
+
+The file is memory-mapped and the X, Y, Z records of a frame are exposed as
+one (natoms, 3) strided view, so that reading a frame copies nothing.
+
+"""
+
+import os
+import struct
+import logging
+import numpy as np
+
+module_logger = logging.getLogger('mainapp.dcd')
+
+
+
+class DCDFrames(object):
+    def __init__(self, dcdfile):
+        """ Memory-mapped reader of a DCD trajectory.
+
+            dcd = DCDFrames('run.dcd')
+            dcd[10]          # (natoms, 3) view of the frame 10, in A
+            dcd[::100]       # (n, natoms, 3) view of every 100th frame
+            for x in dcd: ...
+
+        Args:
+            dcdfile : str, path to the dcd file
+
+        Attributes:
+            natoms  : int, number of atoms
+            nframes : int, number of complete frames in the file
+            istart, nsavc, delta : first step, steps between frames and the
+                      time step (AKMA units) from the header
+            title   : list of str, the title lines
+            free    : array of the zero-based indices of the free atoms, or
+                      None without fixed atoms
+            cells   : (nframes, 6) view of the unit cells (A, gamma, B, beta,
+                      alpha, C as written by the MD code) or None
+
+        """
+
+        self.lgr = logging.getLogger('mainapp.dcd.DCDFrames')
+
+        if not os.path.exists(dcdfile):
+            raise IOError("the dcd file '%s' doesn't exist" % dcdfile)
+
+        self.dcdfile = dcdfile
+        size = os.path.getsize(dcdfile)
+        with open(dcdfile, 'rb') as f:
+            self._read_header(f)
+            start = f.tell()
+
+        order = self._order
+        self._data = np.memmap(dcdfile, dtype=np.uint8, mode='r')
+
+        # the layout of a frame: [cell] X Y Z [W], each record with its two lengths
+        cell = 4 + 48 + 4 if self._has_cell else 0
+        naxes = 4 if self._has_4d else 3
+
+        def _frame_size(n):
+            return cell + naxes * (4 + 4 * n + 4)
+
+        first = _frame_size(self.natoms)
+        nfree = self.natoms if self.free is None else len(self.free)
+        self._first  = start
+        self._step   = _frame_size(nfree)
+        self._nfree  = nfree
+        self._rest   = start + first
+        self._coords_dtype = np.dtype(order + 'f4')
+
+        self.nframes = 0
+        if size >= start + first:
+            self.nframes = 1 + (size - start - first) // self._step
+        if self.nframes != self._nset:
+            self.lgr.warning("the header of %s has %d frames, the file has %d" % (
+                dcdfile, self._nset, self.nframes))
+
+        self.cells = None
+        if self._has_cell and self.nframes:
+            # the first frame may be longer than the others
+            cells = [self._view(start + 4, (1, 6), (0, 8), order + 'f8')]
+            if self.nframes > 1:
+                cells.append(self._view(self._rest + 4, (self.nframes - 1, 6), (self._step, 8), order + 'f8'))
+            self.cells = cells[0] if len(cells) == 1 else np.concatenate(cells)
+
+        self._fixed_frame = None
+        self.lgr.debug("%d frames of %d atoms in %s" % (self.nframes, self.natoms, dcdfile))
+
+
+    def _read_header(self, f):
+        head = f.read(4)
+        for order in ('<', '>'):
+            if len(head) == 4 and struct.unpack(order + 'i', head)[0] == 84:
+                break
+        else:
+            raise ValueError("%s is not a DCD file" % self.dcdfile)
+        self._order = order
+
+        def _record():
+            n = struct.unpack(order + 'i', f.read(4))[0]
+            data = f.read(n)
+            if len(data) != n or struct.unpack(order + 'i', f.read(4))[0] != n:
+                raise ValueError("%s: truncated dcd header" % self.dcdfile)
+            return data
+
+        f.seek(0)
+        data = _record()
+        if data[:4] != b'CORD':
+            raise ValueError("%s is not a DCD coordinate file" % self.dcdfile)
+        icntrl = struct.unpack(order + '20i', data[4:84])
+        self._nset  = icntrl[0]
+        self.istart = icntrl[1]
+        self.nsavc  = icntrl[2]
+        namnf       = icntrl[8]
+        self.delta  = struct.unpack(order + 'f', data[40:44])[0]
+        charmm = icntrl[19] != 0
+        self._has_cell = charmm and icntrl[10] != 0
+        self._has_4d   = charmm and icntrl[11] != 0
+
+        data = _record()
+        ntitle = struct.unpack(order + 'i', data[:4])[0]
+        self.title = [data[4 + 80*k:4 + 80*(k+1)].decode('ascii', 'replace').rstrip()
+                      for k in range(ntitle)]
+
+        self.natoms = struct.unpack(order + 'i', _record())[0]
+
+        self.free = None
+        if namnf:
+            free = np.frombuffer(_record(), dtype=order + 'i4')
+            if len(free) != self.natoms - namnf:
+                raise ValueError("%s: %d free atoms for %d atoms and %d fixed" % (
+                    self.dcdfile, len(free), self.natoms, namnf))
+            self.free = free.astype(np.int64) - 1
+
+
+    def _view(self, offset, shape, strides, dtype):
+        return np.ndarray(shape, dtype=dtype, buffer=self._data, offset=offset, strides=strides)
+
+
+    def _frame_view(self, offset, n, nframes=None, step=None):
+        # X, Y and Z of n atoms as an (n, 3) view, or (nframes, n, 3) every step bytes
+        offset += (56 if self._has_cell else 0) + 4
+        axis = 4 + 4 * n + 4
+        if nframes is None:
+            return self._view(offset, (n, 3), (4, axis), self._coords_dtype)
+        return self._view(offset, (nframes, n, 3), (step, 4, axis), self._coords_dtype)
+
+
+    def __len__(self):
+        return self.nframes
+
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, stride = key.indices(self.nframes)
+            indices = range(start, stop, stride)
+            if self.free is None and len(indices):
+                # all the frames have the same layout: one strided view
+                return self._frame_view(self._first + start * self._step, self.natoms,
+                                        len(indices), stride * self._step)
+            out = np.empty((len(indices), self.natoms, 3), dtype=self._coords_dtype)
+            for k, i in enumerate(indices):
+                out[k] = self[i]
+            return out
+
+        i = int(key)
+        if i < 0:
+            i += self.nframes
+        if not 0 <= i < self.nframes:
+            raise IndexError("frame %d out of range (%d frames)" % (key, self.nframes))
+
+        if i == 0:
+            return self._frame_view(self._first, self.natoms)
+        offset = self._rest + (i - 1) * self._step
+        if self.free is None:
+            return self._frame_view(offset, self.natoms)
+
+        # the fixed atoms are only in the first frame
+        if self._fixed_frame is None:
+            self._fixed_frame = np.array(self[0])
+        frame = self._fixed_frame.copy()
+        frame[self.free] = self._frame_view(offset, self._nfree)
+        return frame
+
+
+    def __iter__(self):
+        for i in range(self.nframes):
+            yield self[i]
+
+
+    def __repr__(self):
+        return "DCDFrames with %d frames of %d atoms" % (self.nframes, self.natoms)
+
+
+
+def write_dcd(fname, frames, cells=None, free=None, delta=1.0, istart=0, nsavc=1):
+    """ Writes a DCD file in the NAMD layout, in the byte order of this machine.
+
+    Args:
+        frames : (nframes, natoms, 3) array, in A
+        cells  : (nframes, 6) array of the unit cells, optional
+        free   : zero-based indices of the free atoms, optional; the other
+                 atoms are fixed and only written in the first frame
+
+    """
+
+    frames = np.asarray(frames, dtype=np.float32)
+    nframes, natoms = frames.shape[:2]
+    namnf = 0 if free is None else natoms - len(free)
+
+    def _record(f, data):
+        f.write(struct.pack('i', len(data)))
+        f.write(data)
+        f.write(struct.pack('i', len(data)))
+
+    icntrl = [0] * 20
+    icntrl[0], icntrl[1], icntrl[2], icntrl[3] = nframes, istart, nsavc, istart + nsavc * nframes
+    icntrl[8]  = namnf
+    icntrl[10] = 1 if cells is not None else 0
+    icntrl[19] = 24
+    header = b'CORD' + struct.pack('9i', *icntrl[:9]) + struct.pack('f', delta) + struct.pack('10i', *icntrl[10:])
+
+    with open(fname, 'wb') as f:
+        _record(f, header)
+        _record(f, struct.pack('i', 1) + b'written by pytopol'.ljust(80))
+        _record(f, struct.pack('i', natoms))
+        if namnf:
+            _record(f, (np.asarray(free, dtype=np.int32) + 1).tobytes())
+
+        for k in range(nframes):
+            if cells is not None:
+                _record(f, np.asarray(cells[k], dtype=np.float64).tobytes())
+            x = frames[k] if k == 0 or namnf == 0 else frames[k][free]
+            for axis in range(3):
+                _record(f, np.ascontiguousarray(x[:, axis]).tobytes())
@@ -0,0 +1,137 @@
+"""
+Writing GROMACS .gro coordinate files.
+
+The fixed-width lines (%5d%-5s%5s%5d%8.3f%8.3f%8.3f) are built as one
+(natoms, 45) byte array per chunk of atoms: the numbers are converted to
+digits with integer arithmetic over whole columns, so no per-atom string
+formatting is needed. Atom and residue numbers wrap at 100000.
+
+"""
+
+import logging
+import numpy as np
+
+module_logger = logging.getLogger('mainapp.gro')
+
+_space = 32
+_zero  = 48
+
+
+
+def format_fixed(values, width, decimals=0):
+    """ Right-aligned fixed-point text of numbers, like '%{width}.{decimals}f'.
+
+    Args:
+        values   : (n,) array
+        width    : int, number of characters
+        decimals : int, 0 for integers (no decimal point)
+
+    Returns:
+        (n, width) uint8 array of ASCII characters
+
+    """
+
+    # rounded like printf: the scaling by 10**decimals is exact in extended
+    # precision (up to 3 decimals), so values like 70.3715 nm - which are a bit
+    # below the half in binary - are rounded down
+    values = np.asarray(values, dtype=np.float64)
+    a = np.rint(np.abs(values).astype(np.longdouble) * 10**decimals).astype(np.int64)
+    neg = np.signbit(values)
+
+    ndigits = np.ones(len(a), dtype=np.int64)
+    for p in range(1, 19):
+        ndigits += a >= 10**p
+    ndigits = np.maximum(ndigits, decimals + 1)     # at least one digit before the point
+
+    used = ndigits + neg + (decimals > 0)
+    if len(used) and used.max() > width:
+        raise ValueError("%g does not fit in %d characters" % (values[used.argmax()], width))
+
+    out = np.full((len(a), width), _space, dtype=np.uint8)
+    dot = 1 if decimals else 0
+    if decimals:
+        out[:, width - 1 - decimals] = ord('.')
+
+    # d-th digit from the right, then the sign after the last digit
+    for d in range(width - dot):
+        col = width - 1 - d - (dot if d >= decimals else 0)
+        has = d < ndigits
+        out[has, col] = _zero + (a[has] // 10**d) % 10
+        out[neg & (d == ndigits), col] = ord('-')
+
+    return out
+
+
+def format_names(names, width, left=True):
+    '''Returns the (n, width) uint8 text of names, truncated to width and left or right aligned'''
+    text = np.array([str(n)[:width] for n in names], dtype='S%d' % width)
+    text = np.char.ljust(text, width) if left else np.char.rjust(text, width)
+    return np.frombuffer(text.tobytes(), dtype=np.uint8).reshape(len(names), width)
+
+
+def box_vectors(cell):
+    """ The GROMACS box line (nm) of a unit cell.
+
+    Args:
+        cell : (a, b, c, alpha, beta, gamma) in A and degrees (cosines are
+               accepted for the angles)
+
+    Returns:
+        3 numbers for a rectangular box, 9 for a triclinic one
+        (v1x v2y v3z v1y v1z v2x v2z v3x v3y)
+
+    """
+
+    a, b, c = [x * 0.1 for x in cell[:3]]
+    angles = np.array(cell[3:], dtype=np.float64)
+    if np.all(np.abs(angles) <= 1):
+        angles = np.degrees(np.arccos(angles))
+    alpha, beta, gamma = np.radians(angles)
+
+    if np.allclose(angles, 90.0):
+        return [a, b, c]
+
+    v2x = b * np.cos(gamma)
+    v2y = b * np.sin(gamma)
+    v3x = c * np.cos(beta)
+    v3y = c * (np.cos(alpha) - np.cos(beta) * np.cos(gamma)) / np.sin(gamma)
+    v3z = np.sqrt(c*c - v3x*v3x - v3y*v3y)
+    return [a, v2y, v3z, 0.0, 0.0, v2x, 0.0, v3x, v3y]
+
+
+def write_gro(fname, coords, resnumbs, resnames, atomnames, box, title='', chunk_size=100000):
+    """ Writes a .gro file.
+
+    Args:
+        coords     : (natoms, 3) array, in nm
+        resnumbs   : (natoms,) residue numbers
+        resnames, atomnames : lists of str
+        box        : 3 or 9 numbers, in nm
+        title      : str, the first line
+        chunk_size : int, number of atoms formatted at once
+
+    """
+
+    coords = np.asarray(coords)
+    natoms = len(coords)
+    resnumbs = np.asarray(resnumbs, dtype=np.int64)
+
+    with open(fname, 'wb') as f:
+        f.write(('%s\n%5d\n' % (title or 'Generated by pytopol', natoms)).encode('ascii'))
+
+        for start in range(0, natoms, chunk_size):
+            stop = min(start + chunk_size, natoms)
+            n = stop - start
+            line = np.empty((n, 45), dtype=np.uint8)
+            line[:,  0: 5] = format_fixed(resnumbs[start:stop] % 100000, 5)
+            line[:,  5:10] = format_names(resnames[start:stop], 5, left=True)
+            line[:, 10:15] = format_names(atomnames[start:stop], 5, left=False)
+            line[:, 15:20] = format_fixed(np.arange(start + 1, stop + 1) % 100000, 5)
+            for k in range(3):
+                line[:, 20+8*k:28+8*k] = format_fixed(coords[start:stop, k], 8, 3)
+            line[:, 44] = ord('\n')
+            f.write(line.tobytes())
+
+        f.write((''.join('%10.5f' % x for x in box) + '\n').encode('ascii'))
+
+    module_logger.debug("wrote %d atoms to %s" % (natoms, fname))
@@ -1,18 +1,92 @@
 
 
+import os
+import re
 import logging
+import math
+import hashlib
+import collections
+import numpy as np
 from pytopol.parsers import blocks
+from pytopol.parsers.par import GroParType
+from pytopol.parsers.cpp import Preprocessor, lines_starting_with
+from pytopol.parsers.gro import write_gro, box_vectors
+from pytopol.parsers.utils import repartition_hydrogen_mass, build_index_array, is_hydrogen, water_resnames
+from pytopol.parsers.utils import bond_graph, exclusion_lists
 
 module_logger = logging.getLogger('mainapp.grotop')
 
 
+def _lazy_getattr(owner, top, name):
+    # loads the pending section that defines the attribute `name` of owner
+    pending = owner.__dict__.get('_pending')
+    if pending and top is not None:
+        for sec in list(pending.keys()):
+            if name in GroTop.lazy_sections[sec]:
+                top._load(owner, sec)
+                return getattr(owner, name)
+
+    raise AttributeError(name)
+
+
+
+class _LazyMolecule(blocks.Molecule):
+    # a Molecule with sections that are parsed on first access (see GroTop lazy)
+    def __init__(self, top):
+        super(_LazyMolecule, self).__init__()
+        self._top = top
+        self._pending = {}
+
+    def __getattr__(self, name):
+        return _lazy_getattr(self, self.__dict__.get('_top'), name)
+
+
+
+def _copy_types(types):
+    # copies of the parameter types (AtomType, BondType, ...) of section_cache:
+    # the attributes are scalars but for the format dicts, {'param': dict or
+    # list of dicts, ...}
+    result = []
+    for t in types:
+        c = object.__new__(type(t))
+        d = c.__dict__
+        d.update(t.__dict__)
+        for fmt in ('charmm', 'gromacs'):
+            f = d.get(fmt)
+            if f is not None:
+                p = f['param']
+                f = d[fmt] = f.copy()
+                f['param'] = p.copy() if isinstance(p, dict) else [x.copy() for x in p]
+        result.append(c)
+    return result
+
+
+
 class GroTop(blocks.System):
-    def __init__(self, fname):
+    def __init__(self, fname, include_dirs=None, defines=None, lazy=False):
+        """ GROMACS topology parser.
+
+        Args:
+            fname        : str, path to the top file
+            include_dirs : list of directories for #include (e.g. the gromacs
+                           share/top directory)
+            defines      : dict of macros, like the -D flags of grompp
+            lazy         : bool, only index the sections on the first pass and
+                           parse each of them the first time it is accessed
+                           (e.g. mol.bonds or top.bondtypes)
+
+        The parameter types (atomtypes, bondtypes, ...) are cached by the hash
+        of their preprocessed lines, so a force field included by many
+        topologies is parsed once per set of defines. Each GroTop gets its own
+        copies of the cached types (see section_cache and clear_cache).
+
+        """
 
         super(GroTop, self).__init__()
 
         self.lgr = logging.getLogger('mainapp.grotop.GroTop')
         self.fname = fname
+        self.preprocessor = Preprocessor(include_dirs, defines)
 
         self.defaults = {
             'nbfunc': None, 'comb-rule':None, 'gen-pairs':None, 'fudgeLJ':None, 'fudgeQQ':None,
@@ -22,11 +96,47 @@ class GroTop(blocks.System):
         self.found_sections   = []
         self.forcefield       = 'gromacs'
 
-        self.molecules = []
+        self.molecules = blocks.MoleculeBlocks()
+
+        self.lazy     = lazy
+        self._pending = {}     # section : spans, for the sections not parsed yet
+        self._source  = None   # the bytes or lines that the spans refer to
+        self._mol     = None   # the current moleculetype
+        self._rows    = {}     # section : lines of the bonded terms of the current moleculetype
+
+        self._par_index = {}   # kind : GroParType, see get_parameters
+        self._resolved  = {}   # (moleculetype name, kind) : resolved parameters
+
+        self._line_handlers = {
+            'defaults'       : self._defaults_line,
+            'atomtypes'      : self._atomtypes_line,
+            'moleculetype'   : self._moleculetype_line,
+            'pairtypes'      : self._pairtypes_line,
+            'pairs_nb'       : self._pairs_nb_line,
+            'bondtypes'      : self._bondtypes_line,
+            'angletypes'     : self._angletypes_line,
+            'dihedraltypes'  : self._dihedraltypes_line,
+            'cmaptypes'      : self._cmaptypes_line,
+            'constrainttypes': self._constrainttypes_line,
+            'settles'        : self._settles_line,
+            'exclusions'     : self._exclusions_line,
+            'system'         : self._system_line,
+            'molecules'      : self._molecules_line,
+        }
+
+        # these get all the lines of the section at once
+        self._section_handlers = {
+            'atoms'          : self._atoms_section,
+        }
+
         self._parse(fname)
-        self.molecules = tuple(self.molecules)
+
+    def __getattr__(self, name):
+        return _lazy_getattr(self, self, name)
 
     def __repr__(self):
+        self.load_all()
+
         moltypenames = list(self.dict_molname_mol.keys())
         moltypenames.sort()
 
@@ -74,540 +184,814 @@ class GroTop(blocks.System):
 
 
 
+    # sections with bonded terms, parsed in bulk at the end of each moleculetype:
+    #   section : (number of atoms, supported function types)
+    term_sections = {
+        'pairs'      : (2, (1,)),
+        'bonds'      : (2, (1,)),
+        'angles'     : (3, (1, 5)),
+        'dihedrals'  : (4, (1, 2, 3, 4, 9)),
+        'cmap'       : (5, (1,)),
+        'constraints': (2, (1, 2)),
+    }
+
+    skipped_sections = ('position_restraints', 'distance_restraints', 'dihedral_restraints',
+                        'orientation_restraints', 'angle_restraints', 'angle_restraints_z',
+                        'implicit_genborn_params')
+
+
+    # sections that are parsed on first access in lazy mode : the attributes they fill
+    lazy_sections = {
+        'atoms'          : ('atoms',),
+        'pairs'          : ('pairs',),
+        'bonds'          : ('bonds',),
+        'angles'         : ('angles',),
+        'dihedrals'      : ('dihedrals', 'impropers'),
+        'cmap'           : ('cmaps',),
+        'constraints'    : ('constraints',),
+        'settles'        : ('settles',),
+        'exclusions'     : ('exclusions',),
+        'atomtypes'      : ('atomtypes',),
+        'pairtypes'      : ('pairtypes',),
+        'bondtypes'      : ('bondtypes',),
+        'angletypes'     : ('angletypes',),
+        'dihedraltypes'  : ('dihedraltypes', 'impropertypes'),
+        'constrainttypes': ('constrainttypes',),
+        'cmaptypes'      : ('cmaptypes',),
+    }
+
+    molecule_sections = ('atoms', 'pairs', 'bonds', 'angles', 'dihedrals', 'cmap',
+                         'constraints', 'settles', 'exclusions')
+
+    # sections of parameter types that are cached, see _type_section
+    type_sections = ('atomtypes', 'pairtypes', 'bondtypes', 'angletypes', 'dihedraltypes',
+                     'constrainttypes')
+
+    # (section, hash of its lines) : lists of the parsed types, copied in and out,
+    # the least recently used sections are dropped beyond section_cache_size
+    section_cache = collections.OrderedDict()
+    section_cache_size = 32
+
+    _header_re    = re.compile(br'\[[ \t]*([^\]\s;]+)[ \t]*\]')
+    _directive_re = re.compile(br'^[ \t]*#', re.M)
+
+
     def _parse(self, fname):
 
+        for sec, span in self._index_sections(fname):
+            self.found_sections.append(sec)
+
+            if self.lazy and sec in self.lazy_sections:
+                owner = self._mol if sec in self.molecule_sections else self
+                self._defer(owner, sec, span)
+            else:
+                self._parse_section(sec, self._section_lines(span))
+
+        self._finish_moleculetype()
+        self._mol = None
+
+        if not self.lazy:
+            self._source = None
+
+
+    def _index_sections(self, fname):
+        # returns (section, span) for the sections of the topology, a span is a
+        # byte range of the file (lazy mode without preprocessor directives) or
+        # a range of the preprocessed lines
         _find_section = lambda line: line.strip('[').strip(']').strip()
 
-        def _add_info(sys_or_mol, section, container):
-            # like (mol, 'atomtypes', mol.atomtypes)
-            if sys_or_mol.information.get(section, False) is False:
-                sys_or_mol.information[section] = container
+        if self.lazy:
+            if not os.path.exists(fname):
+                raise IOError("the '%s' topology file doesn't exist" % fname)
 
-        mol        = None   # to hold the current mol
-        curr_sec   = None
-        cmap_lines = []
+            with open(fname, 'rb') as f:
+                data = f.read()
 
-        with open(fname) as f:
-            for i_line, line in enumerate(f):
+            if b'#' not in data or self._directive_re.search(data) is None:
+                self._source = data
 
-                # trimming
-                if ';' in line:
-                    line = line[0:line.index(';')]
-                line = line.strip()
+                # only the headers at the beginning of a line (not in comments)
+                headers = [m for m in self._header_re.finditer(data)
+                           if data[data.rfind(b'\n', 0, m.start())+1:m.start()].strip() == b'']
+                ends = [m.start() for m in headers[1:]] + [len(data)]
+                return [(m.group(1).decode('ascii'), (m.end(), end)) for m, end in zip(headers, ends)]
 
-                if line == '':
-                    continue
+        # comments, #includes, #ifdefs and macros are handled by the preprocessor
+        lines = self.preprocessor.lines(fname)
 
-                if line[0] == '*':
-                    continue
+        headers = lines_starting_with(lines, '[*')
+        if any(lines[i][0] == '*' for i in headers):
+            lines = [line for line in lines if line[0] != '*']
+            headers = lines_starting_with(lines, '[')
 
-                # the topology must be stand-alone (i.e. no includes)
-                if line.startswith('#include'):
-                    msg = 'The topology file has "#include" statements.'
-                    msg+= ' You must provide a processed topology file that grompp creates.'
-                    raise ValueError(msg)
+        self._source = lines
 
-                # find sections
-                if line[0] == '[':
-                    curr_sec = _find_section(line)
-                    self.found_sections.append(curr_sec)
-                    continue
+        sections = []
+        if len(headers) == 0 or headers[0] != 0:
+            sections.append((None, (0, headers[0] if headers else len(lines))))
 
-                fields = line.split()
+        ends = headers[1:] + [len(lines)]
+        for i, j in zip(headers, ends):
+            sections.append((_find_section(lines[i]), (i+1, j)))
 
-                if curr_sec == 'defaults':
-                    '''
-                    # ; nbfunc        comb-rule       gen-pairs       fudgeLJ fudgeQQ
-                    #1               2               yes             0.5     0.8333
-                    '''
+        return sections
 
-                    assert len(fields) == 5
 
-                    self.defaults['nbfunc']    = fields[0]
-                    self.defaults['comb-rule'] = int(fields[1])
-                    self.defaults['gen-pairs'] = fields[2]
-                    self.defaults['fudgeLJ']   = float(fields[3])
-                    self.defaults['fudgeQQ']   = float(fields[4])
+    def _section_lines(self, span):
+        i, j = span
+        if isinstance(self._source, list):
+            return self._source[i:j]
 
-                elif curr_sec == 'atomtypes':
-                    '''
-                    # ;name               at.num    mass         charge    ptype  sigma   epsilon
-                    # ; name  bond_type   at.num    mass         charge    ptype  sigma    epsilon
-                    '''
+        lines = Preprocessor._clean(self._source[i:j])
+        return [line for line in lines if line[0] != '*']
 
-                    if len(fields) not in (7,8):
-                        print('skipping atomtype line with neither 7 or 8 fields: \n %s' % line)
-                        continue
 
-                    shift = 0 if len(fields) == 7 else 1
-                    at = blocks.AtomType('gromacs')
-                    at.atype = fields[0]
-                    at.mass  = float(fields[2+shift])
-                    at.charge= float(fields[3+shift])
+    def _parse_section(self, sec, lines):
+        if sec in self.term_sections:
+            self._rows.setdefault(sec, []).extend(lines)
 
-                    particletype = fields[4+shift]
-                    assert particletype in ('A', 'S', 'V', 'D')
-                    if particletype not in ('A',):
-                        print('warning: non-atom particletype: "%s"' % line)
+        elif sec in self.type_sections:
+            self._type_section(sec, lines)
 
-                    sig = float(fields[5+shift])
-                    eps = float(fields[6+shift])
+        elif sec in self._section_handlers:
+            self._section_handlers[sec](lines)
 
-                    at.gromacs= {'param': {'lje':eps, 'ljl':sig, 'lje14':None, 'ljl14':None} }
+        elif sec in self._line_handlers:
+            handler = self._line_handlers[sec]
+            for line in lines:
+                handler(line.split(), line)
 
-                    self.atomtypes.append(at)
+        elif sec not in self.skipped_sections and len(lines) > 0:
+            print('Uknown section in topology: %s' % sec)
 
-                    _add_info(self, curr_sec, self.atomtypes)
 
+    def _type_section(self, sec, lines):
+        # parses the lines of a parameter type section, or copies the types from
+        # section_cache if the same lines were parsed before
+        attrs = self.lazy_sections[sec]
+        key = (sec, hashlib.sha1('\n'.join(lines).encode('utf-8')).hexdigest())
+        cache = self.section_cache
 
-                # extend system.molecules
-                elif curr_sec == 'moleculetype':
-                    assert len(fields) == 2
+        cached = cache.pop(key, None)
+        if cached is None:
+            containers = [getattr(self, attr) for attr in attrs]
+            before = [len(c) for c in containers]
+            handler = self._line_handlers[sec]
+            for line in lines:
+                handler(line.split(), line)
+            cache[key] = [_copy_types(c[n:]) for c, n in zip(containers, before)]
+            while len(cache) > self.section_cache_size:
+                cache.popitem(last=False)
+            return
 
-                    mol = blocks.Molecule()
+        self.lgr.debug("using cached section: %s" % sec)
+        cache[key] = cached
+        for attr, types in zip(attrs, cached):
+            if len(types) > 0:
+                getattr(self, attr).extend(_copy_types(types))
+                self._add_info(self, sec, getattr(self, attr))
 
-                    mol.name = fields[0]
-                    mol.exclusion_numb = int(fields[1])
 
-                    self.dict_molname_mol[mol.name] = mol
+    @classmethod
+    def clear_cache(cls):
+        '''Clears the cached parameter types and the cached include files'''
+        cls.section_cache.clear()
+        Preprocessor.clear_cache()
 
 
-                elif curr_sec == 'atoms':
-                    '''
-                    #id    at_type     res_nr  residu_name at_name  cg_nr  charge   mass  typeB    chargeB      massB
-                    # 1       OC          1       OH          O1       1      -1.32
-                    '''
+    def _defer(self, owner, sec, span):
+        # remove the attributes of the section, so they are loaded on first access
+        if sec not in owner._pending:
+            owner._pending[sec] = []
+            for attr in self.lazy_sections[sec]:
+                owner.__dict__.pop(attr, None)
 
-                    aserial = int(fields[0])
-                    atype   = fields[1]
-                    resnumb = int(fields[2])
-                    resname = fields[3]
-                    aname   = fields[4]
-                    cgnr    = int(fields[5])
-                    charge  = float(fields[6])
-                    rest = fields[7:]
+        owner._pending[sec].append(span)
 
-                    atom         = blocks.Atom()
-                    atom.name    = aname
-                    atom.atomtype= atype
-                    atom.number  = aserial
-                    atom.resname = resname
-                    atom.resnumb = resnumb
-                    atom.charge  = charge
 
-                    if len(rest) >= 1:
-                        mass = float(rest[0])
-                        atom.mass = mass
+    def _load(self, owner, sec):
+        # parses a pending section of owner (a molecule or the GroTop itself)
+        spans = owner._pending.pop(sec)
+        self.lgr.debug("loading section %s" % sec)
 
-                    mol.atoms.append(atom)
+        is_mol = owner is not self
+        if is_mol and sec != 'atoms':
+            owner.atoms   # the other sections refer to the atoms
 
-                    _add_info(mol, curr_sec, mol.atoms)
+        for attr in self.lazy_sections[sec]:
+            setattr(owner, attr, [])
 
-                elif curr_sec in ('pairtypes', 'pairs', 'pairs_nb'):
-                    '''
-                    section     #at     fu      #param
-                    ---------------------------------
-                    pairs       2       1       V,W
-                    pairs       2       2       fudgeQQ, qi, qj, V, W
-                    pairs_nb    2       1       qi, qj, V, W
+        self._mol  = owner if is_mol else None
+        self._rows = {}
+        for span in spans:
+            self._parse_section(sec, self._section_lines(span))
+        self._finish_moleculetype()
+        self._mol = None
 
-                    '''
 
-                    ai, aj = fields[:2]
-                    fu     = int(fields[2])
-                    assert fu in (1,2)
+    def load_all(self):
+        '''Parses all the sections that are not loaded yet (lazy mode)'''
+        for owner in [self] + list(self.dict_molname_mol.values()):
+            pending = owner.__dict__.get('_pending', {})
+            for sec in self.lazy_sections:
+                if sec in pending:
+                    self._load(owner, sec)
+
+
+    # kinds of terms with parameter types : (type table, number of atoms)
+    param_sections = {
+        'bonds'      : ('bondtypes', 2),
+        'angles'     : ('angletypes', 3),
+        'dihedrals'  : ('dihedraltypes', 4),
+        'impropers'  : ('impropertypes', 4),
+        'constraints': ('constrainttypes', 2),
+    }
 
-                    pair = blocks.InteractionType('gromacs')
-                    if fu == 1:
-                        if curr_sec=='pairtypes':
-                            pair.atype1 = ai
-                            pair.atype2 = aj
-                            v, w = list(map(float, fields[3:5]))
-                            pair.gromacs = {'param': {'lje':None, 'ljl':None, 'lje14':w, 'ljl14':v}, 'func':fu }
 
-                            self.pairtypes.append(pair)
-                            _add_info(self, curr_sec, self.pairtypes)
+    def get_parameters(self, mol, kind, panic_on_missing_param=True):
+        """ Assigns parameters to all the terms of a kind of a moleculetype.
+
+        The parameters given on the term lines are used as they are, the other
+        terms are looked up in the type tables by the bonded types of their
+        atoms (X wildcards, reversed keys, multi-term dihedrals as grompp).
+        The lookup is done once for each distinct combination of types and
+        the result is cached for the moleculetype.
+
+        Args:
+            mol  : blocks.Molecule, a moleculetype of this topology
+            kind : 'bonds', 'angles', 'dihedrals', 'impropers' or 'constraints'
+            panic_on_missing_param : raise ValueError for a term without
+                           parameters, otherwise its parameters are nan
+
+        Returns:
+            dict of arrays with one row for each parameter set:
+                term   : (m,) index of the term in mol.<kind> - a multi-term
+                         dihedral (func 9) has several rows
+                func   : (m,) function type
+                params : (m, p) parameters in the order of the topology
+                         lines, like (b0, kb) for bonds; nan padded
+
+        """
+
+        key = (mol.name, kind)
+        if key in self._resolved:
+            return self._resolved[key]
+
+        table, natoms = self.param_sections[kind]
+        terms = getattr(mol, kind)
+        if isinstance(terms, blocks.TermArray):
+            indices, func, params = terms.indices, terms.func, terms.params
+        else:
+            indices = build_index_array(mol, kind) if len(terms) else np.zeros((0, natoms), np.int64)
+            func    = np.array([t.gromacs['func'] for t in terms], dtype=np.int64)
+            params  = np.zeros((len(terms), 0))
+
+        # terms with the parameters on their line
+        explicit = ~np.all(np.isnan(params), axis=1)
+        rows     = [tuple(p) for p in params[explicit]]
+        start    = np.zeros(len(func), np.int64)
+        count    = np.ones(len(func), np.int64)
+        start[explicit] = np.arange(len(rows))
+
+        # the other terms - one lookup for each distinct (types, func)
+        lookup = np.flatnonzero(~explicit)
+        if len(lookup):
+            index = self._param_index(kind)
+            bond_types = dict((at.atype, at.bond_type) for at in self.atomtypes)
+            names, codes = np.unique([bond_types.get(a.atomtype, a.atomtype) for a in mol.atoms],
+                                     return_inverse=True)
+            names = names.tolist()
+
+            keys = np.column_stack((codes.reshape(-1)[indices[lookup]], func[lookup]))
+            uniq, inverse = np.unique(keys, axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+
+            ustart = np.zeros(len(uniq), np.int64)
+            ucount = np.zeros(len(uniq), np.int64)
+            for u, row in enumerate(uniq.tolist()):
+                types = tuple(names[c] for c in row[:-1])
+                values = index.get_parameter(types, row[-1])
+                if len(values) == 0:
+                    if panic_on_missing_param:
+                        t = lookup[np.flatnonzero(inverse == u)[0]]
+                        raise ValueError('no parameters for %s (func %d) of %s: atoms %s, types %s' % (
+                            kind, row[-1], mol.name, ' '.join(str(i+1) for i in indices[t]), ' '.join(types)))
+                    self.lgr.error('no parameters for %s (func %d) of %s: types %s' % (
+                        kind, row[-1], mol.name, ' '.join(types)))
+                    values = [()]
+
+                ustart[u] = len(rows)
+                ucount[u] = len(values)
+                rows.extend(values)
+
+            start[lookup] = ustart[inverse]
+            count[lookup] = ucount[inverse]
+
+        width = max([params.shape[1]] + [len(r) for r in rows])
+        values = np.full((len(rows), width), np.nan)
+        for i, r in enumerate(rows):
+            values[i, :len(r)] = r
+
+        # the rows of each term, in the order of the terms
+        term = np.repeat(np.arange(len(func)), count)
+        offset = np.arange(len(term)) - np.repeat(np.cumsum(count) - count, count)
+
+        result = {
+            'term'  : term,
+            'func'  : func[term],
+            'params': values[np.repeat(start, count) + offset],
+        }
+        self._resolved[key] = result
+        return result
 
-                        elif curr_sec == 'pairs':
-                            ai, aj = list( map(int, [ai,aj]) )
-                            pair.atom1 = mol.atoms[ai-1]
-                            pair.atom2 = mol.atoms[aj-1]
-                            pair.gromacs['func'] = fu
 
-                            mol.pairs.append(pair)
-                            _add_info(mol, curr_sec, mol.pairs)
+    def _param_index(self, kind):
+        # hash index over the type table of a kind of terms
+        if kind not in self._par_index:
+            table, natoms = self.param_sections[kind]
+            if kind == 'dihedrals':
+                index = GroParType(table, natoms, wildcards=True, reversible=(1, 3, 4, 9), multi=(9,))
+            elif kind == 'impropers':
+                index = GroParType(table, natoms, wildcards=True, reversible=(1, 3, 4, 9))
+            else:
+                index = GroParType(table, natoms)
 
-                        else:
-                            raise ValueError
+            for t in getattr(self, table):
+                types = tuple(getattr(t, 'atype%d' % (j+1)) for j in range(natoms))
+                for values in self._type_values(t):
+                    index.add_parameter(types, t.gromacs['func'], values)
 
-                    else:
-                        raise NotImplementedError('%s with functiontype %d is not supported' % (curr_sec,fu))
-
-
-                elif curr_sec in ('bondtypes', 'bonds'):
-                    '''
-                    section     #at     fu      #param
-                    ----------------------------------
-                    bonds       2       1       2
-                    bonds       2       2       2
-                    bonds       2       3       3
-                    bonds       2       4       2
-                    bonds       2       5       ??
-                    bonds       2       6       2
-                    bonds       2       7       2
-                    bonds       2       8       ??
-                    bonds       2       9       ??
-                    bonds       2       10      4
-                    '''
-
-                    ai, aj = fields[:2]
-                    fu     = int(fields[2])
-                    assert fu in (1,2,3,4,5,6,7,8,9,10)
-
-                    if fu != 1:
-                        raise NotImplementedError('function %d is not yet supported' % fu)
-
-                    bond = blocks.BondType('gromacs')
-
-                    if fu == 1:
-                        if curr_sec == 'bondtypes':
-                            bond.atype1 = ai
-                            bond.atype2 = aj
-                            b0, kb = list(map(float, fields[3:5]))
-
-                            bond.gromacs = {'param':{'kb':kb, 'b0':b0}, 'func':fu}
-
-                            self.bondtypes.append(bond)
-                            _add_info(self, curr_sec, self.bondtypes)
-
-                        elif curr_sec == 'bonds':
-                            ai, aj = list(map(int, [ai, aj]))
-                            bond.atom1 = mol.atoms[ai-1]
-                            bond.atom2 = mol.atoms[aj-1]
-                            bond.gromacs['func'] = fu
-
-                            mol.bonds.append(bond)
-                            _add_info(mol, curr_sec, mol.bonds)
+            self._par_index[kind] = index
 
-                    else:
-                        raise NotImplementedError
-
-                elif curr_sec in ('angletypes', 'angles'):
-                    '''
-                    section     #at     fu      #param
-                    ----------------------------------
-                    angles      3       1       2
-                    angles      3       2       2
-                    angles      3       3       3
-                    angles      3       4       4
-                    angles      3       5       4
-                    angles      3       6       6
-                    angles      3       8       ??
-                    '''
-
-                    ai, aj , ak = fields[:3]
-                    fu          = int(fields[3])
-                    assert fu in (1,2,3,4,5,6,8)  # no 7
-
-                    if fu not in (1,5):
-                        raise NotImplementedError('function %d is not yet supported' % fu)
-
-                    ang = blocks.AngleType('gromacs')
-                    if fu == 1:
-                        if curr_sec == 'angletypes':
-                            ang.atype1 = ai
-                            ang.atype2 = aj
-                            ang.atype3 = ak
-
-                            tetha0, ktetha = list(map(float, fields[4:6]))
-                            ang.gromacs = {'param':{'ktetha':ktetha, 'tetha0':tetha0, 'kub':None, 's0':None}, 'func':fu}
-
-                            self.angletypes.append(ang)
-                            _add_info(self, curr_sec, self.angletypes)
-
-                        elif curr_sec == 'angles':
-                            ai, aj, ak = list(map(int, [ai, aj, ak]))
-                            ang.atom1 = mol.atoms[ai-1]
-                            ang.atom2 = mol.atoms[aj-1]
-                            ang.atom3 = mol.atoms[ak-1]
-                            ang.gromacs['func'] = fu
-
-                            mol.angles.append(ang)
-                            _add_info(mol, curr_sec, mol.angles)
-
-                        else:
-                            raise ValueError
-
-                    elif fu == 5:
-                        if curr_sec == 'angletypes':
-                            ang.atype1 = ai
-                            ang.atype2 = aj
-                            ang.atype3 = ak
-                            tetha0, ktetha, s0, kub = list(map(float, fields[4:8]))
-
-                            ang.gromacs = {'param':{'ktetha':ktetha, 'tetha0':tetha0, 'kub':kub, 's0':s0}, 'func':fu}
-
-                            self.angletypes.append(ang)
-                            _add_info(self, curr_sec, self.angletypes)
-
-                        elif curr_sec == 'angles':
-                            ai, aj, ak = list(map(int, [ai, aj, ak]))
-                            ang.atom1 = mol.atoms[ai-1]
-                            ang.atom2 = mol.atoms[aj-1]
-                            ang.atom3 = mol.atoms[ak-1]
-                            ang.gromacs['func'] = fu
-
-                            mol.angles.append(ang)
-                            _add_info(mol, curr_sec, mol.angles)
-
-                        else:
-                            raise ValueError
+        return self._par_index[kind]
 
-                    else:
-                        raise NotImplementedError
-
-
-                elif curr_sec in  ('dihedraltypes', 'dihedrals'):
-                    '''
-                    section     #at     fu      #param
-                    ----------------------------------
-                    dihedrals   4       1       3
-                    dihedrals   4       2       2
-                    dihedrals   4       3       6
-                    dihedrals   4       4       3
-                    dihedrals   4       5       4
-                    dihedrals   4       8       ??
-                    dihedrals   4       9       3
-                    '''
-
-                    if curr_sec == 'dihedraltypes' and len(fields) == 6:
-                        # in oplsaa - quartz parameters
-                        fields.insert(2, 'X')
-                        fields.insert(0, 'X')
-
-                    ai, aj, ak, am = fields[:4]
-                    fu = int(fields[4])
-                    assert fu in (1,2,3,4,5,8,9)
-
-                    if fu not in (1,2,3,4,9):
-                        raise NotImplementedError('function %d is not yet supported' % fu)
-
-                    dih = blocks.DihedralType('gromacs')
-                    imp = blocks.ImproperType('gromacs')
-
-                    if fu in (1,3,9):
-                        if curr_sec == 'dihedraltypes':
-                            dih.atype1 = ai
-                            dih.atype2 = aj
-                            dih.atype3 = ak
-                            dih.atype4 = am
-
-                            if fu == 1:
-                                delta, kchi, n = list(map(float, fields[5:8]))
-                                dih.gromacs['param'].append({'kchi':kchi, 'n':n, 'delta':delta})
-                            elif fu == 3:
-                                c0, c1, c2, c3, c4, c5 = list(map(float, fields[5:11]))
-                                m = dict(c0=c0, c1=c1, c2=c2, c3=c3, c4=c4, c5=c5)
-                                dih.gromacs['param'].append(m)
-                            elif fu == 9:
-                                delta, kchi, n = list(map(float, fields[5:8]))
-                                dih.gromacs['param'].append({'kchi':kchi, 'n':n, 'delta':delta})
-                            else:
-                                raise ValueError
-
-                            dih.gromacs['func'] = fu
-                            self.dihedraltypes.append(dih)
-                            _add_info(self, curr_sec, self.dihedraltypes)
-
-                        elif curr_sec == 'dihedrals':
-                            ai, aj, ak, am = list(map(int, fields[:4]))
-                            dih.atom1 = mol.atoms[ai-1]
-                            dih.atom2 = mol.atoms[aj-1]
-                            dih.atom3 = mol.atoms[ak-1]
-                            dih.atom4 = mol.atoms[am-1]
-                            dih.gromacs['func'] = fu
-
-                            if fu == 1:
-                                pass
-                            elif fu == 3:
-                                pass
-                            elif fu == 9:
-                                pass
-                            else:
-                                raise ValueError
-
-                            mol.dihedrals.append(dih)
-                            _add_info(mol, curr_sec, mol.dihedrals)
-
-                        else:
-                            raise ValueError
-
-                    elif fu in (2,4):
-                        if curr_sec == 'dihedraltypes':
-                            imp.atype1 = ai
-                            imp.atype2 = aj
-                            imp.atype3 = ak
-                            imp.atype4 = am
-
-                            if fu == 2:
-                                psi0 , kpsi = list(map(float, fields[5:7]))
-                                imp.gromacs['param'].append({'kpsi':kpsi, 'psi0': psi0})
-                            elif fu == 4:
-                                psi0 , kpsi, n = list(map(float, fields[5:8]))
-                                imp.gromacs['param'].append({'kpsi':kpsi, 'psi0': psi0, 'n':n})
-                            else:
-                                raise ValueError
-
-                            imp.gromacs['func'] = fu
-                            self.impropertypes.append(imp)
-                            _add_info(self, curr_sec, self.impropertypes)
-
-                        elif curr_sec == 'dihedrals':
-                            ai, aj, ak, am = list(map(int, fields[:4]))
-                            imp.atom1 = mol.atoms[ai-1]
-                            imp.atom2 = mol.atoms[aj-1]
-                            imp.atom3 = mol.atoms[ak-1]
-                            imp.atom4 = mol.atoms[am-1]
-                            imp.gromacs['func'] = fu
-
-                            if fu == 2:
-                                pass
-                            elif fu == 4:
-                                pass
-                            else:
-                                raise ValueError
-
-                            mol.impropers.append(imp)
-                            _add_info(mol, curr_sec, mol.impropers)
-
-                        else:
-                            raise ValueError
 
-                    else:
-                        raise NotImplementedError
+    @staticmethod
+    def _type_values(t):
+        # the parameters of a type, in the order of the topology line
+        p, fu = t.gromacs['param'], t.gromacs['func']
+        if isinstance(t, blocks.BondType):
+            return [(p['b0'], p['kb'])]
+        elif isinstance(t, blocks.ConstraintType):
+            return [(p['b0'],)]
+        elif isinstance(t, blocks.AngleType):
+            if fu == 5:
+                return [(p['tetha0'], p['ktetha'], p['s0'], p['kub'])]
+            return [(p['tetha0'], p['ktetha'])]
+        elif isinstance(t, blocks.DihedralType):
+            if fu == 3:
+                return [tuple(m['c%d' % i] for i in range(6)) for m in p]
+            return [(m['delta'], m['kchi'], m['n']) for m in p]
+        elif isinstance(t, blocks.ImproperType):
+            if fu == 4:
+                return [(m['psi0'], m['kpsi'], m['n']) for m in p]
+            return [(m['psi0'], m['kpsi']) for m in p]
+        raise NotImplementedError('no parameters for %s' % type(t).__name__)
 
 
-                elif curr_sec in ('cmaptypes', 'cmap'):
+    @staticmethod
+    def _add_info(sys_or_mol, section, container):
+        # like (mol, 'atomtypes', mol.atomtypes)
+        if sys_or_mol.information.get(section, False) is False:
+            sys_or_mol.information[section] = container
+
+
+    def _finish_moleculetype(self):
+        # converts the collected lines of the bonded terms to arrays
+        mol = self._mol
+        for sec, lines in self._rows.items():
+            if len(lines) == 0:
+                continue
+
+            natoms, funcs = self.term_sections[sec]
+            indices, func, params = self._lines_to_arrays(lines, natoms, sec)
+
+            bad = ~np.isin(func, funcs)
+            if np.any(bad):
+                raise NotImplementedError('%s with function type %d is not yet supported' % (
+                    sec, func[bad][0]))
+
+            if np.any(indices < 0) or np.any(indices >= len(mol.atoms)):
+                raise ValueError('atom index out of range in [ %s ] of %s' % (sec, mol.name))
+
+            def _add_terms(attr, cls, selection=None, atom_names=None):
+                if selection is not None:
+                    if not np.any(selection):
+                        return
+                    terms = (indices[selection], func[selection], params[selection])
+                else:
+                    terms = (indices, func, params)
+
+                if atom_names is None:
+                    atom_names = tuple('atom%d' % (j+1) for j in range(natoms))
+
+                arr = blocks.TermArray(cls, 'gromacs', mol.atoms, atom_names, *terms)
+                setattr(mol, attr, arr)
+                self._add_info(mol, sec, arr)
+
+            if sec == 'pairs':
+                _add_terms('pairs', blocks.InteractionType)
+            elif sec == 'bonds':
+                _add_terms('bonds', blocks.BondType)
+            elif sec == 'angles':
+                _add_terms('angles', blocks.AngleType)
+            elif sec == 'dihedrals':
+                # propers and impropers are in the same section
+                improper = (func == 2) | (func == 4)
+                _add_terms('dihedrals', blocks.DihedralType, ~improper)
+                _add_terms('impropers', blocks.ImproperType, improper)
+            elif sec == 'cmap':
+                _add_terms('cmaps', blocks.CMapType, atom_names=('atom1', 'atom2', 'atom3', 'atom4', 'atom8'))
+            elif sec == 'constraints':
+                _add_terms('constraints', blocks.ConstraintType)
+
+        self._rows = {}
 
-                    cmap = blocks.CMapType('gromacs')
-                    if curr_sec == 'cmaptypes':
-                        cmap_lines.append(line)
-                        _add_info(self, curr_sec, self.cmaptypes)
-                    else:
-                        ai, aj, ak, am, an = list(map(int, fields[:5]))
-                        fu = int(fields[5])
-                        assert fu == 1
-                        cmap.atom1 = mol.atoms[ai-1]
-                        cmap.atom2 = mol.atoms[aj-1]
-                        cmap.atom3 = mol.atoms[ak-1]
-                        cmap.atom4 = mol.atoms[am-1]
-                        cmap.atom8 = mol.atoms[an-1]
-                        cmap.gromacs['func'] = fu
-
-                        mol.cmaps.append(cmap)
-                        _add_info(mol, curr_sec, mol.cmaps)
-
-
-                elif curr_sec == 'settles':
-                    '''
-                    section     #at     fu      #param
-                    ----------------------------------
-                    '''
-
-                    assert len(fields) == 4
-                    ai = int(fields[0])
-                    fu = int(fields[1])
-                    assert fu == 1
-
-                    settle = blocks.SettleType('gromacs')
-                    settle.atom = mol.atoms[ai-1]
-                    settle.dOH = float(fields[2])
-                    settle.dHH = float(fields[3])
-
-                    mol.settles.append(settle)
-                    _add_info(mol, curr_sec, mol.settles)
-
-                elif curr_sec in ('exclusions',):
-                    ai = int(fields[0])
-                    other = list(map(int, fields[1:]))
-
-                    exc = blocks.Exclusion()
-                    exc.main_atom  = mol.atoms[ai-1]
-                    exc.other_atoms= [mol.atoms[k-1] for k in other]
-
-                    mol.exclusions.append(exc)
-                    _add_info(mol, curr_sec, mol.exclusions)
-
-
-                elif curr_sec in ('constrainttypes', 'constraints'):
-                    '''
-                    section     #at     fu      #param
-                    ----------------------------------
-                    constraints 2       1       1
-                    constraints 2       2       1
-                    '''
-
-                    ai, aj = fields[:2]
-                    fu = int(fields[2])
-                    assert fu in (1,2)
-
-                    cons = blocks.ConstraintType('gromacs')
-
-                    # TODO: what's different between 1 and 2
-                    if fu == 1 or fu == 2:
-                        if curr_sec == 'constrainttypes':
-                            cons.atype1 = ai
-                            cons.atype2 = aj
-                            b0 = float(fields[3])
-                            cons.gromacs = {'param':{'b0':b0}, 'func': fu}
-
-                            self.constrainttypes.append(cons)
-                            _add_info(self, curr_sec, self.constrainttypes)
-
-                        elif curr_sec == 'constraints':
-                            ai, aj = list(map(int, fields[:2]))
-                            cons.atom1 = mol.atoms[ai-1]
-                            cons.atom2 = mol.atoms[aj-1]
-                            cons.gromacs['func'] = fu
-
-                            mol.constraints.append(cons)
-                            _add_info(mol, curr_sec, mol.constraints)
-
-                        else:
-                            raise ValueError
-                    else:
-                        raise ValueError
 
-                elif curr_sec in ('position_restraints',
-                                  'distance_restraints',
-                                  'dihedral_restraints',
-                                  'orientation_restraints',
-                                  'angle_restraints',
-                                  'angle_restraints_z'):
-                    pass
+    @staticmethod
+    def _count_fields(text, nlines):
+        # number of fields in each line - counted on the bytes of the text
+        data  = np.frombuffer(text.encode('utf-8'), dtype=np.uint8)
+        space = (data == 32) | (data == 9) | (data == 10)
+        first = ~space
+        first[1:] &= space[:-1]
+        return np.bincount(np.cumsum(data == 10)[first], minlength=nlines)
 
 
-                elif curr_sec in ('implicit_genborn_params',):
-                    '''
-                    attype   sar     st      pi      gbr      hct
-                    '''
-                    pass
+    @staticmethod
+    def _lines_to_arrays(lines, natoms, sec):
+        text = '\n'.join(lines)
+        nfields = GroTop._count_fields(text, len(lines))
 
-                elif curr_sec == 'system':
-                    assert len(fields) == 1
-                    self.name = fields[0]
+        if np.any(nfields < natoms + 1):
+            i = np.flatnonzero(nfields < natoms + 1)[0]
+            raise ValueError('not enough fields in [ %s ]: %s' % (sec, lines[i]))
 
+        values = np.array(text.split(), dtype=np.float64)
+        starts = np.concatenate(([0], np.cumsum(nfields)[:-1]))
 
-                elif curr_sec == 'molecules':
-                    assert len(fields) == 2
-                    mname, nmol = fields[0], int(fields[1])
+        cols = values[starts[:, None] + np.arange(natoms + 1)].astype(np.int64)
+        indices = cols[:, :natoms] - 1
+        func    = cols[:, natoms]
 
-                    # if the number of a molecule is more than 1, add copies to system.molecules
-                    for i in range(nmol):
-                        self.molecules.append(self.dict_molname_mol[mname])
+        # optional parameters on the lines - nan if missing
+        nparams = nfields - natoms - 1
+        params = np.full((len(lines), nparams.max()), np.nan)
+        for p in range(params.shape[1]):
+            has = nparams > p
+            params[has, p] = values[starts[has] + natoms + 1 + p]
 
-                else:
-                    print('Uknown section in topology: %s' % curr_sec)
+        return indices, func, params
+
+
+    def _defaults_line(self, fields, line):
+        '''
+        # ; nbfunc        comb-rule       gen-pairs       fudgeLJ fudgeQQ
+        #1               2               yes             0.5     0.8333
+        '''
+
+        assert len(fields) == 5
+
+        self.defaults['nbfunc']    = fields[0]
+        self.defaults['comb-rule'] = int(fields[1])
+        self.defaults['gen-pairs'] = fields[2]
+        self.defaults['fudgeLJ']   = float(fields[3])
+        self.defaults['fudgeQQ']   = float(fields[4])
+
+
+    def _atomtypes_line(self, fields, line):
+        '''
+        # ;name               at.num    mass         charge    ptype  sigma   epsilon
+        # ; name  bond_type   at.num    mass         charge    ptype  sigma    epsilon
+        '''
+
+        if len(fields) not in (7,8):
+            print('skipping atomtype line with neither 7 or 8 fields: \n %s' % line)
+            return
+
+        shift = 0 if len(fields) == 7 else 1
+        at = blocks.AtomType('gromacs')
+        at.atype = fields[0]
+        at.bond_type = fields[1] if shift else fields[0]   # the type used for the bonded parameters
+        at.mass  = float(fields[2+shift])
+        at.charge= float(fields[3+shift])
+
+        particletype = fields[4+shift]
+        assert particletype in ('A', 'S', 'V', 'D')
+        if particletype not in ('A',):
+            print('warning: non-atom particletype: "%s"' % line)
+
+        sig = float(fields[5+shift])
+        eps = float(fields[6+shift])
+
+        at.gromacs= {'param': {'lje':eps, 'ljl':sig, 'lje14':None, 'ljl14':None} }
+
+        self.atomtypes.append(at)
+        self._add_info(self, 'atomtypes', self.atomtypes)
+
+
+    def _moleculetype_line(self, fields, line):
+        # extend system.molecules
+        assert len(fields) == 2
+
+        self._finish_moleculetype()
+
+        mol = _LazyMolecule(self) if self.lazy else blocks.Molecule()
+
+        mol.name = fields[0]
+        mol.exclusion_numb = int(fields[1])
+
+        self.dict_molname_mol[mol.name] = mol
+        self._mol = mol
+
+
+    def _atoms_section(self, lines):
+        '''
+        #id    at_type     res_nr  residu_name at_name  cg_nr  charge   mass  typeB    chargeB      massB
+        # 1       OC          1       OH          O1       1      -1.32
+        '''
+
+        mol = self._mol
+        if len(lines) == 0:
+            return
+
+        text = '\n'.join(lines)
+        nfields = self._count_fields(text, len(lines))
+        n = nfields[0]
+
+        if n >= 7 and np.all(nfields == n):
+            # the same fields on all the lines: converted by columns
+            fields = text.split()
+            columns = [list(map(int, fields[0::n])), fields[1::n], list(map(int, fields[2::n])),
+                       fields[3::n], fields[4::n], list(map(float, fields[6::n]))]
+            names = ['number', 'atomtype', 'resnumb', 'resname', 'name', 'charge']
+            # fields[5] is the charge group
+            if n >= 8:
+                columns.append(list(map(float, fields[7::n])))
+                names.append('mass')
+
+            for values in zip(*columns):
+                atom = blocks.Atom()
+                atom.__dict__.update(zip(names, values))
+                mol.atoms.append(atom)
+
+        else:
+            for line in lines:
+                fields = line.split()
+
+                atom         = blocks.Atom()
+                atom.number  = int(fields[0])
+                atom.atomtype= fields[1]
+                atom.resnumb = int(fields[2])
+                atom.resname = fields[3]
+                atom.name    = fields[4]
+                atom.charge  = float(fields[6])
+
+                if len(fields) >= 8:
+                    atom.mass = float(fields[7])
+
+                mol.atoms.append(atom)
+
+        self._add_info(mol, 'atoms', mol.atoms)
+
+
+    def _pairtypes_line(self, fields, line):
+        '''
+        section     #at     fu      #param
+        ---------------------------------
+        pairs       2       1       V,W
+        pairs       2       2       fudgeQQ, qi, qj, V, W
+        pairs_nb    2       1       qi, qj, V, W
+
+        '''
+
+        ai, aj = fields[:2]
+        fu     = int(fields[2])
+        assert fu in (1,2)
+
+        if fu != 1:
+            raise NotImplementedError('pairtypes with functiontype %d is not supported' % fu)
+
+        pair = blocks.InteractionType('gromacs')
+        pair.atype1 = ai
+        pair.atype2 = aj
+        v, w = list(map(float, fields[3:5]))
+        pair.gromacs = {'param': {'lje':None, 'ljl':None, 'lje14':w, 'ljl14':v}, 'func':fu }
+
+        self.pairtypes.append(pair)
+        self._add_info(self, 'pairtypes', self.pairtypes)
+
+
+    def _pairs_nb_line(self, fields, line):
+        raise NotImplementedError('pairs_nb is not supported')
+
+
+    def _bondtypes_line(self, fields, line):
+        '''
+        section     #at     fu      #param
+        ----------------------------------
+        bonds       2       1       2
+        bonds       2       2       2
+        bonds       2       3       3
+        bonds       2       4       2
+        bonds       2       5       ??
+        bonds       2       6       2
+        bonds       2       7       2
+        bonds       2       8       ??
+        bonds       2       9       ??
+        bonds       2       10      4
+        '''
+
+        ai, aj = fields[:2]
+        fu     = int(fields[2])
+        assert fu in (1,2,3,4,5,6,7,8,9,10)
+
+        if fu != 1:
+            raise NotImplementedError('function %d is not yet supported' % fu)
+
+        bond = blocks.BondType('gromacs')
+        bond.atype1 = ai
+        bond.atype2 = aj
+        b0, kb = list(map(float, fields[3:5]))
+
+        bond.gromacs = {'param':{'kb':kb, 'b0':b0}, 'func':fu}
+
+        self.bondtypes.append(bond)
+        self._add_info(self, 'bondtypes', self.bondtypes)
+
+
+    def _angletypes_line(self, fields, line):
+        '''
+        section     #at     fu      #param
+        ----------------------------------
+        angles      3       1       2
+        angles      3       2       2
+        angles      3       3       3
+        angles      3       4       4
+        angles      3       5       4
+        angles      3       6       6
+        angles      3       8       ??
+        '''
+
+        ai, aj , ak = fields[:3]
+        fu          = int(fields[3])
+        assert fu in (1,2,3,4,5,6,8)  # no 7
+
+        if fu not in (1,5):
+            raise NotImplementedError('function %d is not yet supported' % fu)
+
+        ang = blocks.AngleType('gromacs')
+        ang.atype1 = ai
+        ang.atype2 = aj
+        ang.atype3 = ak
+
+        if fu == 1:
+            tetha0, ktetha = list(map(float, fields[4:6]))
+            ang.gromacs = {'param':{'ktetha':ktetha, 'tetha0':tetha0, 'kub':None, 's0':None}, 'func':fu}
+        else:
+            tetha0, ktetha, s0, kub = list(map(float, fields[4:8]))
+            ang.gromacs = {'param':{'ktetha':ktetha, 'tetha0':tetha0, 'kub':kub, 's0':s0}, 'func':fu}
+
+        self.angletypes.append(ang)
+        self._add_info(self, 'angletypes', self.angletypes)
+
+
+    def _dihedraltypes_line(self, fields, line):
+        '''
+        section     #at     fu      #param
+        ----------------------------------
+        dihedrals   4       1       3
+        dihedrals   4       2       2
+        dihedrals   4       3       6
+        dihedrals   4       4       3
+        dihedrals   4       5       4
+        dihedrals   4       8       ??
+        dihedrals   4       9       3
+        '''
+
+        if len(fields) == 6:
+            # in oplsaa - quartz parameters
+            fields.insert(2, 'X')
+            fields.insert(0, 'X')
+
+        ai, aj, ak, am = fields[:4]
+        fu = int(fields[4])
+        assert fu in (1,2,3,4,5,8,9)
+
+        if fu not in (1,2,3,4,9):
+            raise NotImplementedError('function %d is not yet supported' % fu)
+
+        if fu in (1,3,9):
+            dih = blocks.DihedralType('gromacs')
+            dih.atype1 = ai
+            dih.atype2 = aj
+            dih.atype3 = ak
+            dih.atype4 = am
+
+            if fu in (1, 9):
+                delta, kchi, n = list(map(float, fields[5:8]))
+                dih.gromacs['param'].append({'kchi':kchi, 'n':n, 'delta':delta})
+            else:
+                c0, c1, c2, c3, c4, c5 = list(map(float, fields[5:11]))
+                m = dict(c0=c0, c1=c1, c2=c2, c3=c3, c4=c4, c5=c5)
+                dih.gromacs['param'].append(m)
+
+            dih.gromacs['func'] = fu
+            self.dihedraltypes.append(dih)
+            self._add_info(self, 'dihedraltypes', self.dihedraltypes)
+
+        else:
+            imp = blocks.ImproperType('gromacs')
+            imp.atype1 = ai
+            imp.atype2 = aj
+            imp.atype3 = ak
+            imp.atype4 = am
+
+            if fu == 2:
+                psi0 , kpsi = list(map(float, fields[5:7]))
+                imp.gromacs['param'].append({'kpsi':kpsi, 'psi0': psi0})
+            else:
+                psi0 , kpsi, n = list(map(float, fields[5:8]))
+                imp.gromacs['param'].append({'kpsi':kpsi, 'psi0': psi0, 'n':n})
+
+            imp.gromacs['func'] = fu
+            self.impropertypes.append(imp)
+            self._add_info(self, 'dihedraltypes', self.impropertypes)
+
+
+    def _cmaptypes_line(self, fields, line):
+        # the cmap grids are not parsed
+        self._add_info(self, 'cmaptypes', self.cmaptypes)
+
+
+    def _constrainttypes_line(self, fields, line):
+        '''
+        section     #at     fu      #param
+        ----------------------------------
+        constraints 2       1       1
+        constraints 2       2       1
+        '''
+
+        ai, aj = fields[:2]
+        fu = int(fields[2])
+        assert fu in (1,2)
+
+        # TODO: what's different between 1 and 2
+        cons = blocks.ConstraintType('gromacs')
+        cons.atype1 = ai
+        cons.atype2 = aj
+        b0 = float(fields[3])
+        cons.gromacs = {'param':{'b0':b0}, 'func': fu}
+
+        self.constrainttypes.append(cons)
+        self._add_info(self, 'constrainttypes', self.constrainttypes)
+
+
+    def _settles_line(self, fields, line):
+        '''
+        section     #at     fu      #param
+        ----------------------------------
+        '''
+
+        assert len(fields) == 4
+        ai = int(fields[0])
+        fu = int(fields[1])
+        assert fu == 1
+
+        mol = self._mol
+        settle = blocks.SettleType('gromacs')
+        settle.atom = mol.atoms[ai-1]
+        settle.dOH = float(fields[2])
+        settle.dHH = float(fields[3])
+
+        mol.settles.append(settle)
+        self._add_info(mol, 'settles', mol.settles)
+
+
+    def _exclusions_line(self, fields, line):
+        ai = int(fields[0])
+        other = list(map(int, fields[1:]))
+
+        mol = self._mol
+        exc = blocks.Exclusion()
+        exc.main_atom  = mol.atoms[ai-1]
+        exc.other_atoms= [mol.atoms[k-1] for k in other]
+
+        mol.exclusions.append(exc)
+        self._add_info(mol, 'exclusions', mol.exclusions)
+
+
+    def _system_line(self, fields, line):
+        assert len(fields) == 1
+        self.name = fields[0]
+
+
+    def _molecules_line(self, fields, line):
+        assert len(fields) == 2
+        mname, nmol = fields[0], int(fields[1])
+
+        # copies are not stored, only (molecule, count) blocks
+        self.molecules.add(self.dict_molname_mol[mname], nmol)
 
 
 
@@ -620,6 +1004,8 @@ class SystemToGroTop(object):
         'atoms'        : '{:6d} {:>10s} {:6d} {:6s} {:6s} {:6d} {:11.4f} {:11.4f} \n',
         'bondtypes'    : '{:5s}  {:5s}  {:1d}  {:6.4f}  {:6.1f}\n',
         'bonds'        : '{:3d}  {:3d}   {:1d}\n',
+        'constraints'  : '{:3d}  {:3d}   {:1d}    {:8.5f}\n',
+        'settles'      : '{:3d}   {:1d}    {:8.5f}    {:8.5f}\n',
         'pairtypes'    : '{:6s} {:6s}   {:d}    {:14.12f}     {:14.12f}    \n',
         'pairs'        : '{:3d} {:3d}   {:1d}\n',
         'angletypes'   : '{:6s} {:6s} {:6s} {:1d}    {:8.4f}    {:10.5f}    {:9.5f}    {:11.5f}\n',
@@ -651,15 +1037,50 @@ class SystemToGroTop(object):
     itptemplate += "[ dihedrals ]    \n*IMPROPERS*    \n"
     itptemplate += "[ cmap ]        \n*CMAPS*    \n"
 
+    # only added when some of the bonds are constrained
+    constrtemplate = ""
+    constrtemplate += "[ constraints ]  \n*CONSTRAINTS*  \n"
+    constrtemplate += "[ settles ]      \n*SETTLES*      \n"
+
+    # only added with constraints or explicit exclusions
+    excltemplate = "[ exclusions ]   \n*EXCLUSIONS*   \n"
+
 
 
 
-    def __init__(self, psfsystem):
+    def __init__(self, psfsystem, hmr_mass=None, constraints=None, grofile=None, model=0,
+                 nrexcl=3, exclusions=None):
+        """ Writes top.top and one itp file per molecule of psfsystem.
+
+        Args:
+            psfsystem : a System with parameters (see CharmmPar.add_params_to_system)
+            hmr_mass  : float or None, if given the hydrogen masses are repartitioned
+                        to this value (e.g. 3.024 for 4 fs time steps)
+            constraints : None, 'h-bonds' or 'all-bonds', the bonds written as
+                        [ constraints ] (b0 from the bond types); water molecules
+                        are written with [ settles ] if not None
+            grofile   : str or None, if given the coordinates of the atoms are
+                        also written to this gro file (see write_gro)
+            model     : int, the model (or frame) of the coordinates for grofile
+            nrexcl    : int, the nrexcl of [ moleculetype ]
+            exclusions: int or None, if given the atoms up to this many bonds
+                        apart are also written as explicit [ exclusions ]
+                        (see utils.exclusion_lists)
+
+        """
+        assert constraints in (None, 'h-bonds', 'all-bonds')
+
         self.lgr = logging.getLogger('mainapp.grotop.SystemToGroTop')
         self.lgr.debug(">> entering SystemToGroTop")
 
         self.system   = psfsystem
+        self.hmr_mass = hmr_mass
+        self.constraints = constraints
+        self.nrexcl      = nrexcl
+        self.exclusions  = exclusions
         self.assemble_topology()
+        if grofile is not None:
+            self.write_gro(grofile, model)
 
         self.lgr.debug("<< leaving SystemToGroTop")
 
@@ -695,16 +1116,17 @@ class SystemToGroTop(object):
         top = top.replace('*IMPROPERTYPES*', ''.join( self._make_impropertypes(self.system)) )
         top = top.replace('*CMAPTYPES*',     ''.join( self._make_cmaptypes(self.system)) )
 
-        for i, m in enumerate(self.system.molecules):
+        moltypes, molblocks = self._molecule_blocks()
+        for i, m in enumerate(moltypes):
             molname = 'mol_%02d' % (i+1)
             top += '#include "itp_%s.itp" \n' % molname
 
         top += '\n[system]  \nConvertedSystem\n\n'
         top += '[molecules] \n'
 
-        for i, m in enumerate(self.system.molecules):
+        for i, count in molblocks:
             molname = 'mol_%02d' % (i+1)
-            top += '%s     1\n' % molname
+            top += '%s     %d\n' % (molname, count)
         top += '\n'
 
         with open('top.top', 'w') as f:
@@ -716,14 +1138,30 @@ class SystemToGroTop(object):
         self.lgr.debug("generating atom/pair/bond/angle/dihedral/improper for the itp files")
 
 
-        for i,m in enumerate(self.system.molecules):
+        for i,m in enumerate(moltypes):
             molname = 'mol_%02d' % (i+1)
+
+            masses = None
+            if self.hmr_mass is not None:
+                masses = self._repartition_masses(m, molname)
+
+            constrained, waters = self._find_constraints(m)
+            settled = set(a for w in waters for a in w)
+
             itp = self.itptemplate
+            if self.constraints is not None:
+                itp += self.constrtemplate
+                itp = itp.replace('*CONSTRAINTS*', ''.join( self._make_constraints(m, constrained)) )
+                itp = itp.replace('*SETTLES*',     ''.join( self._make_settles(waters)) )
+            if self.constraints is not None or self.exclusions is not None:
+                itp += self.excltemplate
+                itp = itp.replace('*EXCLUSIONS*',  ''.join( self._make_exclusions(m, waters)) )
+
             itp = itp.replace('*MOLECULETYPE*',  ''.join( self._make_moleculetype(m, molname))  )
-            itp = itp.replace('*ATOMS*',         ''.join( self._make_atoms(m))  )
-            itp = itp.replace('*BONDS*',         ''.join( self._make_bonds(m))  )
+            itp = itp.replace('*ATOMS*',         ''.join( self._make_atoms(m, masses))  )
+            itp = itp.replace('*BONDS*',         ''.join( self._make_bonds(m, constrained, settled))  )
             itp = itp.replace('*PAIRS*',         ''.join( self._make_pairs(m))  )
-            itp = itp.replace('*ANGLES*',        ''.join( self._make_angles(m)) )
+            itp = itp.replace('*ANGLES*',        ''.join( self._make_angles(m, settled)) )
             itp = itp.replace('*DIHEDRALS*',     ''.join( self._make_dihedrals(m)) )
             itp = itp.replace('*IMPROPERS*',     ''.join( self._make_impropers(m)) )
             itp = itp.replace('*CMAPS*',         ''.join( self._make_cmaps(m)) )
@@ -736,6 +1174,145 @@ class SystemToGroTop(object):
 
 
 
+    def _molecule_blocks(self):
+        # the molecules written as itp files and the (index in them, count) of
+        # the [ molecules ] section: from the molecule_blocks of the system
+        # (see PSFSystem.split_psf) or else each molecule once
+        molblocks = getattr(self.system, 'molecule_blocks', None)
+        if molblocks is None:
+            return list(self.system.molecules), [(i, 1) for i in range(len(self.system.molecules))]
+
+        moltypes = []
+        index = {}
+        result = []
+        for m, count in molblocks.iter_blocks():
+            if m not in index:
+                index[m] = len(moltypes)
+                moltypes.append(m)
+            result.append((index[m], count))
+        return moltypes, result
+
+
+    def write_gro(self, grofile, model=0, padding=1.0):
+        """ Writes the coordinates of the system as a gro file.
+
+        The atoms are in the order of the itp files and have the same residue
+        numbers (wrapped at 100000). The coordinates are converted from A to nm;
+        the box comes from the unit cells of the system, as (a, b, c, alpha,
+        beta, gamma) rows like the ones of PSFSystem.add_dcdfile. Without unit
+        cells the box is the extent of the coordinates plus padding, so that
+        the outermost atoms are not on top of their periodic images.
+
+        Args:
+            grofile : str, path to the gro file
+            model   : int, the model (or frame) in atom.coords
+            padding : float, nm added to the extent in each direction when the
+                      system has no unit cells
+
+        """
+
+        atoms = [a for m in self.system.molecules for a in m.atoms]
+        if len(atoms) == 0 or len(atoms[0].coords) <= model:
+            raise ValueError("the atoms of the system have no coordinates for model %d" % model)
+
+        coords = np.array([a.coords[model] for a in atoms], dtype=np.float64) / 10.0
+
+        cells = getattr(self.system, 'cells', None)
+        if cells is not None:
+            box = box_vectors(cells[model])
+        else:
+            self.lgr.warning("the system has no unit cell - the box is the extent of the coordinates "
+                             "plus %.2f nm, set system.cells for the real box" % padding)
+            box = list(coords.max(axis=0) - coords.min(axis=0) + padding)
+
+        residues = [a.residue for a in atoms]
+        write_gro(grofile, coords,
+                  [r.number for r in residues],
+                  [r.name for r in residues],
+                  [a.name for a in atoms], box)
+
+        self.lgr.debug('writing %s finished' % grofile)
+
+
+    def _repartition_masses(self, m, molname):
+        masses, before, after = repartition_hydrogen_mass(m, self.hmr_mass)
+
+        self.lgr.debug("hmr for %s: total mass %.4f -> %.4f" % (molname, before, after))
+        if abs(after - before) > 1e-6 * max(before, 1.0):
+            raise ValueError("hydrogen mass repartitioning changed the total mass of %s: %.6f -> %.6f" % (
+                molname, before, after))
+
+        return masses
+
+
+    def _find_constraints(self, m):
+        # returns a boolean array for the bonds of m that become constraints
+        # and a list of (O, H, H) atoms for the water molecules that become settles
+        if self.constraints is None:
+            return np.zeros(len(m.bonds), dtype=bool), []
+
+        bonds = build_index_array(m, 'bonds')
+
+        waters = []
+        for res in m.residues:
+            if res.name not in water_resnames or len(res.atoms) != 3:
+                continue
+            hydrogen = is_hydrogen([a.mass for a in res.atoms])
+            # settles need the oxygen followed by the two hydrogens
+            if list(hydrogen) == [False, True, True]:
+                waters.append(tuple(res.atoms))
+
+        in_water = np.zeros(len(m.atoms), dtype=bool)
+        index = dict((atom, i) for i, atom in enumerate(m.atoms))
+        for w in waters:
+            in_water[[index[a] for a in w]] = True
+
+        if self.constraints == 'all-bonds':
+            constrained = np.ones(len(bonds), dtype=bool)
+        else:
+            hydrogen = is_hydrogen([a.mass for a in m.atoms])
+            constrained = hydrogen[bonds].any(axis=1)
+
+        constrained &= ~in_water[bonds].any(axis=1)
+        return constrained, waters
+
+    def _bond_lengths(self):
+        # b0 (nm) for the atom type pairs of the assigned bond types
+        if not hasattr(self, '_b0'):
+            self._b0 = {}
+            for bond in self.system.bondtypes:
+                bond.convert('gromacs')
+                b0 = bond.gromacs['param']['b0']
+                self._b0[(bond.atype1, bond.atype2)] = b0
+                self._b0[(bond.atype2, bond.atype1)] = b0
+
+        return self._b0
+
+    def _get_b0(self, at1, at2):
+        b0 = self._bond_lengths().get((at1, at2))
+        if b0 is None:
+            raise ValueError('no bond type for constraint %s-%s' % (at1, at2))
+        return b0
+
+    def _water_geometry(self, water):
+        # dOH and dHH (nm) of a water from its bond (and angle) types
+        o, h1, h2 = [a.get_atomtype() for a in water]
+        doh = self._get_b0(o, h1)
+
+        dhh = self._bond_lengths().get((h1, h2))
+        if dhh is None:
+            for ang in self.system.angletypes:
+                if (ang.atype1, ang.atype2, ang.atype3) in ((h1, o, h2), (h2, o, h1)):
+                    ang.convert('gromacs')
+                    tetha0 = ang.gromacs['param']['tetha0']
+                    dhh = 2 * doh * math.sin(math.radians(tetha0) / 2.0)
+                    break
+            else:
+                raise ValueError('no H-H bond or H-O-H angle type for water %s' % h1)
+
+        return doh, dhh
+
+
     def _make_atomtypes(self,m):
         def get_prot(at):
             # TODO improve this
@@ -938,17 +1515,18 @@ class SystemToGroTop(object):
         return result
 
     def _make_moleculetype(self,m, molname):
-        return ['; Name \t\t  nrexcl \n %s    3 \n' % molname]
+        return ['; Name \t\t  nrexcl \n %s    %d \n' % (molname, self.nrexcl)]
 
-    def _make_atoms(self,m):
+    def _make_atoms(self,m, masses=None):
         result = []
         #i = 1
-        for atom in m.atoms:
+        for i, atom in enumerate(m.atoms):
             numb = cgnr = atom.number
             atype = atom.get_atomtype()
             assert atype!= False and hasattr(atom, 'charge') and hasattr(atom, 'mass')
+            mass = atom.mass if masses is None else masses[i]
             line = self.formats['atoms'].format(
-                    numb, atype, atom.residue.number, atom.residue.name, atom.name, cgnr, atom.charge, atom.mass)
+                    numb, atype, atom.residue.number, atom.residue.name, atom.name, cgnr, atom.charge, mass)
             result.append(line)
 
         result.insert(0,'; %5d atoms\n' % len(result))
@@ -969,9 +1547,13 @@ class SystemToGroTop(object):
         return result
 
 
-    def _make_bonds(self,m):
+    def _make_bonds(self,m, constrained=None, settled=()):
         result = []
-        for bond in m.bonds:
+        for i, bond in enumerate(m.bonds):
+            if constrained is not None and constrained[i]:
+                continue
+            if bond.atom1 in settled:
+                continue
             fu = 1
             line = self.formats['bonds'].format(bond.atom1.number, bond.atom2.number, fu)
             result.append(line)
@@ -979,9 +1561,56 @@ class SystemToGroTop(object):
         result.insert(0,'; %5d bonds\n' % len(result))
         return result
 
-    def _make_angles(self,m):
+    def _make_constraints(self, m, constrained):
+        result = []
+        for i in np.flatnonzero(constrained):
+            bond = m.bonds[i]
+            fu = 1
+            b0 = self._get_b0(bond.atom1.get_atomtype(), bond.atom2.get_atomtype())
+            line = self.formats['constraints'].format(bond.atom1.number, bond.atom2.number, fu, b0)
+            result.append(line)
+
+        result.insert(0,'; %5d constraints\n' % len(result))
+        return result
+
+    def _make_settles(self, waters):
+        result = []
+        for water in waters:
+            fu = 1
+            doh, dhh = self._water_geometry(water)
+            line = self.formats['settles'].format(water[0].number, fu, doh, dhh)
+            result.append(line)
+
+        result.insert(0,'; %5d settles\n' % len(result))
+        return result
+
+    def _make_exclusions(self, m, waters):
+        # the atoms up to self.exclusions bonds apart, one line per atom, and
+        # the settled waters, which have no bonds
+        result = []
+        if self.exclusions is not None:
+            offsets, neighbors = bond_graph(build_index_array(m, 'bonds'), len(m.atoms))
+            excl_offsets, excluded = exclusion_lists(offsets, neighbors, self.exclusions)
+
+            numbers = [a.number for a in m.atoms]
+            excluded = excluded.tolist()
+            bounds = excl_offsets.tolist()
+            for i in np.flatnonzero(np.diff(excl_offsets)).tolist():
+                others = excluded[bounds[i]:bounds[i+1]]
+                result.append(''.join('%5d ' % numbers[k] for k in [i] + others).rstrip() + '\n')
+
+        for o, h1, h2 in waters:
+            result.append('%5d %5d %5d\n' % (o.number, h1.number, h2.number))
+            result.append('%5d %5d\n' % (h1.number, h2.number))
+
+        result.insert(0,'; %5d exclusions\n' % len(result))
+        return result
+
+    def _make_angles(self,m, settled=()):
         result = []
         for ang in m.angles:
+            if ang.atom2 in settled:
+                continue
             fu = 5
             line = self.formats['angles'].format(ang.atom1.number, ang.atom2.number, ang.atom3.number, fu)
             result.append(line)
@@ -0,0 +1,63 @@
+"""
+NAMD binary coordinate and velocity files (.coor, .vel and restart files).
+
+The file is a 4-byte atom count followed by one (x, y, z) triple of 8-byte
+floats for each atom, in the byte order of the machine that wrote it. The
+triples are memory-mapped, so reading a file does not copy it.
+
+"""
+
+import os
+import struct
+import logging
+import numpy as np
+
+module_logger = logging.getLogger('mainapp.namdbin')
+
+
+
+def read_namdbin(fname, natoms=None):
+    """ Memory-maps a NAMD binary coordinate or velocity file.
+
+    Args:
+        fname  : str, path to the file
+        natoms : int, optional, the expected number of atoms
+
+    Returns:
+        read-only (natoms, 3) float64 array backed by the file (A for
+        coordinates, NAMD units for velocities)
+
+    """
+
+    if not os.path.exists(fname):
+        raise IOError("the NAMD binary file '%s' doesn't exist" % fname)
+
+    size = os.path.getsize(fname)
+    with open(fname, 'rb') as f:
+        head = f.read(4)
+    if len(head) < 4:
+        raise ValueError("%s is not a NAMD binary file: it has %d bytes" % (fname, size))
+
+    # the byte order is the one for which the count matches the file size
+    for order in ('<', '>'):
+        n = struct.unpack(order + 'i', head)[0]
+        if n >= 0 and 4 + 24 * n == size:
+            break
+    else:
+        raise ValueError("%s is not a NAMD binary file: %d bytes don't match an atom count" % (fname, size))
+
+    if natoms is not None and n != natoms:
+        raise ValueError("%s has %d atoms, expecting %d" % (fname, n, natoms))
+
+    module_logger.debug("%d atoms in %s" % (n, fname))
+    if n == 0:
+        return np.zeros((0, 3))
+    return np.memmap(fname, dtype=order + 'f8', mode='r', offset=4, shape=(n, 3))
+
+
+def write_namdbin(fname, coords):
+    '''Writes an (natoms, 3) array as a NAMD binary file, in the byte order of this machine'''
+    coords = np.ascontiguousarray(coords, dtype=np.float64)
+    with open(fname, 'wb') as f:
+        f.write(struct.pack('i', len(coords)))
+        f.write(coords.tobytes())
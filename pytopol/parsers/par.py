@@ -1,5 +1,6 @@
 
 
+import itertools
 from collections import defaultdict
 import logging
 
@@ -149,3 +150,95 @@ class ParType(object):
         else:
             return self.get_parameter( (key[0], 'X', 'X', key[3]) )
 
+
+
+class GroParType(object):
+    '''
+    GROMACS parameter types (like [ bondtypes ] or [ dihedraltypes ]) hashed by
+    the function type and the bonded atom types:
+
+            self._data = { (func, atype1, atype2, ...) : [order, [ (values) ]] }
+
+    where order is the position of the first line of the key in the topology
+    and values are the parameters in the order of the line.
+
+    A key matches forward or reversed (only forward for the function types not
+    in reversible). With wildcards, an 'X' type matches any atom type and, like
+    in grompp, the type with most non-wildcard matches is used - the first one
+    in the topology for equal numbers. Consecutive lines of the function types
+    in multi with the same key are the terms of a multi-term dihedral, as in
+    grompp; a key that comes again later replaces the earlier parameters,
+    with a warning.
+    '''
+
+    wildcard = 'X'
+
+    def __init__(self, name='', natoms=2, wildcards=False, reversible=None, multi=()):
+        self.name       = name
+        self.natoms     = natoms
+        self.wildcards  = wildcards
+        self.reversible = reversible    # function types, None for all
+        self.multi      = multi
+
+        self._data  = {}
+        self._cache = {}
+        self._last  = None    # the key of the previous parameter
+
+        # the positions that are replaced by wildcards, by number of wildcards
+        self._patterns = [()]
+        if wildcards:
+            self._patterns = sorted(itertools.chain.from_iterable(
+                itertools.combinations(range(natoms), n) for n in range(natoms+1)), key=len)
+
+        self.lgr = logging.getLogger('mainapp.par.GroParType')
+
+
+    def __len__(self):
+        return len(self._data)
+
+
+    def add_parameter(self, key, func, value):
+        key = (func,) + tuple(key)
+        value = tuple(value)
+        self._cache = {}
+
+        if key not in self._data:
+            self._data[key] = [len(self._data), [value]]
+        elif func in self.multi and key == self._last:
+            self._data[key][1].append(value)
+        elif self._data[key][1] != [value]:
+            self.lgr.warning('overwritten: %s -> key: %s' % (self.name, key))
+            self.lgr.warning('  from: %s, to: %s' % (self._data[key][1], value))
+            self._data[key][1] = [value]
+
+        self._last = key
+
+
+    def get_parameter(self, key, func):
+        '''Returns the list of value tuples for the atom types in key ([] if not found)'''
+        key = (func,) + tuple(key)
+        if key in self._cache:
+            return self._cache[key]
+
+        keys = [key[1:]]
+        if self.reversible is None or func in self.reversible:
+            keys.append(key[:0:-1])
+
+        best = None
+        nwild = 0
+        for pattern in self._patterns:
+            if best is not None and len(pattern) > nwild:
+                break
+            nwild = len(pattern)
+
+            for k in keys:
+                k = list(k)
+                for i in pattern:
+                    k[i] = self.wildcard
+                found = self._data.get((func,) + tuple(k))
+                if found is not None and (best is None or found[0] < best[0]):
+                    best = found
+
+        result = best[1] if best is not None else []
+        self._cache[key] = result
+        return result
@@ -1,23 +1,128 @@
 
 from pytopol.parsers import blocks
-from pytopol.parsers.utils import build_res_chain
-import os, logging, time
+from pytopol.parsers.utils import build_res_chains
+import os, mmap, logging, time
+import numpy as np
 
 
 
 module_logger = logging.getLogger('mainapp.pdb')
 
+# the fixed columns of ATOM/HETATM records, up to the coordinates
+_record_fields = np.dtype([
+    ('flag',    'S6'),      #  1-6
+    ('serial',  'S5'),      #  7-11
+    ('_1',      'S1'),
+    ('name',    'S4'),      # 13-16
+    ('altloc',  'S1'),      # 17
+    ('resname', 'S4'),      # 18-21
+    ('chain',   'S1'),      # 22
+    ('resnumb', 'S4'),      # 23-26
+    ('_2',      'S4'),      # 27-30, insertion code
+    ('x',       'S8'),      # 31-38
+    ('y',       'S8'),      # 39-46
+    ('z',       'S8'),      # 47-54
+])
+
+
+
+def read_atom_records(buf):
+    """ The ATOM/HETATM records of a pdb file as fixed-width fields.
+
+    The lines are found from the newlines of the whole buffer, and the first
+    54 columns of the records are gathered into one (nrecords, 54) byte
+    array, so that each column is a field of a structured array and can be
+    converted with a single astype.
+
+    Args:
+        buf : bytes, content of a pdb file (or of a part of it)
+
+    Returns:
+        (records, sizes): structured array of byte strings with one row per
+        record (flag, serial, name, altloc, resname, chain, resnumb, x, y,
+        z), and the number of records in each model (split by ENDMDL)
+
+    """
+
+    width = _record_fields.itemsize
+    data  = np.frombuffer(buf, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=_record_fields), []
+
+    # the lines, without their \r\n
+    newlines = np.flatnonzero(data == 10)
+    starts = np.concatenate([[0], newlines + 1])
+    ends   = np.append(newlines, len(data))
+    if starts[-1] == len(data):
+        starts, ends = starts[:-1], ends[:-1]
+    ends = ends - (data[np.maximum(ends - 1, 0)] == 13)
+
+    # space-padded after the end, so that the gathers of the last line stay in the buffer
+    data = np.concatenate([data, np.full(width, 32, dtype=np.uint8)])
+    lengths = ends - starts
+
+    def _columns(lines, n):
+        # the first n columns of the lines, as an (nlines, n) array
+        if uniform:
+            out = table[lines, :n]
+        else:
+            out = data[starts[lines, None] + np.arange(n)]
+        short = lengths[lines] < n
+        if np.any(short):
+            out[short] = np.where(np.arange(n) >= lengths[lines][short, None], 32, out[short])
+        return out
+
+    # lines of the same length (the usual 80 columns) are rows of a strided view
+    step = starts[1] - starts[0] if len(starts) > 1 else 0
+    uniform = step > 0 and np.all(np.diff(starts) == step) and len(data) >= starts[-1] + width
+    if uniform:
+        table = np.lib.stride_tricks.as_strided(data, shape=(len(starts), width), strides=(step, 1))
+
+    head = np.ascontiguousarray(_columns(np.arange(len(starts)), 8))
+    head[:, 6:] = 32
+    head = head.view('<u8').ravel()
+
+    keys = dict((k, np.frombuffer(k.ljust(8), dtype='<u8')[0]) for k in (b'ATOM', b'HETATM', b'ENDMDL'))
+    atom4 = np.frombuffer(b'ATOM', dtype='<u4')[0]
+    is_atom = (head & 0xffffffff) == atom4
+    is_end  = head == keys[b'ENDMDL']
+    selected = np.flatnonzero(is_atom | (head == keys[b'HETATM']) | is_end)
+
+    rows = np.ascontiguousarray(_columns(selected, width)).view(_record_fields).ravel()
+
+    end = is_end[selected]
+    model = np.cumsum(end)[~end]
+    sizes = np.bincount(model, minlength=int(end.sum())) if len(model) else np.zeros(0, dtype=np.int64)
+    return rows[~end], sizes.tolist()
+
+
+def record_coords(records, dtype=np.float64):
+    '''Returns the (nrecords, 3) coordinates of the records of read_atom_records'''
+    xyz = np.stack([records['x'], records['y'], records['z']], axis=-1)
+    return xyz.astype(dtype)
+
+
+def _strings(field):
+    # a field of byte strings as a list of stripped str
+    return np.char.strip(field).astype(str).tolist()
+
 
 
 class PDBSystem(object):
 
-    def __init__(self, pdbfile, guess_mols=False):
+    def __init__(self, pdbfile, guess_mols=False, dtype=np.float64):
         """ PDB parser.
 
+        Args:
+            dtype : numpy.float64 or numpy.float32, type of the coordinates
+
         Attributes:
             pdbfile : str, path to the pdb file
             molecules: tuple Molecules
             atoms : tuple of Atoms
+            coords : (nmodels, natoms, 3) array of the coordinates of all the
+                     models; the coords of each atom is an (nmodels, 3) view
+                     into it
             lgt : logging.Logger
 
         """
@@ -29,12 +134,13 @@ class PDBSystem(object):
         self.pdbfile = pdbfile
         self.atoms   = tuple([])
         self.molecules = tuple([])
+        self.coords  = np.zeros((0, 0, 3), dtype=dtype)
 
-        self._parse(self.pdbfile, guess_mols)
+        self._parse(self.pdbfile, guess_mols, dtype)
 
         self.lgr.debug("<< leaving PDBsystem")
 
-    def _parse(self, pdbfile, guess_mols):
+    def _parse(self, pdbfile, guess_mols, dtype):
         self.lgr.debug("parsing pdb file: %s" % pdbfile)
 
         t1 = time.time()
@@ -43,76 +149,69 @@ class PDBSystem(object):
             self.lgr.error("the pdbfile doesn't exist")
             return
 
-        _first_model_finished = False
-        atoms     = []
-        molecules = []
-        _i = 0   # a counter for atom index
-        _alt_loc_warning = False
-
-        # read the file and create atoms list
-        M = blocks.Molecule()
-        molecules.append(M)
-        with open(pdbfile) as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith('ENDMDL'):
-                    _first_model_finished = True   # set by first ENDMDL
-                    _i = 0   # reset _i
-
-                if _first_model_finished:
-                    # just read the coordinates
-                    if line.startswith(('ATOM', 'HETATM')):
-                        c = list(map(float, (line[30:38], line[38:46], line[46:54])))
-                        atoms[_i].coords.append(c)
-                        _i += 1
-                else:
-                    if line.startswith(('ATOM', 'HETATM')):
-                        a = blocks.Atom()
-                        a.flag   = line[0:6].strip()
-                        a.number = self.conv_atom_number(line[6:11])
-                        a.name   = line[12:16].strip()
-                        a.altloc = line[16].strip()
-                        if a.altloc != '' and _alt_loc_warning is False:
-                            _alt_loc_warning = True
-                        a.resname= line[17:21].strip()
-                        a.chain  = line[21].strip()
-                        a.resnumb= int(line[22:26])
-                        c = list(map(float, (line[30:38], line[38:46], line[46:54])))
-                        a.coords = [tuple(c)]  # a list of (x,y,z) tuples, each tuple for one model
-
-                        #TODO occup, bfactor, ...
-
-                        if guess_mols:
-                            if len(atoms) > 0:
-                                if line.startswith('HETATM'):
-                                    if a.resname != atoms[-1].resname or a.resnumb != atoms[-1].resnumb:
-                                        M = blocks.Molecule()
-                                        molecules.append(M)
-                                else: # ATOM
-                                    if atoms[-1].flag == 'HETATM':
-                                        M = blocks.Molecule()
-                                        molecules.append(M)
-
-                        # record a in the local atoms and M.atoms
-                        atoms.append(a)
-                        M.atoms.append(a)
-
-        if len(atoms) == 0:
+        with open(pdbfile, 'rb') as f:
+            records, sizes = read_atom_records(f.read())
+
+        if len(records) == 0:
             self.lgr.warning("no atoms were found in the pdb file")
             return
 
+        # the atoms come from the first model, the other models only have coordinates
+        natoms = sizes[0]
+
+        # make sure all the models have the same atoms
+        for k, n in enumerate(sizes):
+            if n != natoms:
+                raise ValueError("model %d has %d atoms, the first model has %d" % (k+1, n, natoms))
+
+        first  = records[:natoms]
+        flags    = _strings(first['flag'])
+        resnames = _strings(first['resname'])
+        chains   = _strings(first['chain'])
+        altlocs  = _strings(first['altloc'])
+        resnumbs = first['resnumb'].astype(np.int64)
+        try:
+            numbers = first['serial'].astype(np.int64).tolist()
+        except ValueError:
+            numbers = [self.conv_atom_number(n) for n in first['serial'].tolist()]
+
+        self.coords = record_coords(records, dtype).reshape(len(sizes), natoms, 3)
+
+        # the atoms from the columns, each with an (nmodels, 3) view of the coordinates
+        #TODO occup, bfactor, ...
+        keys = ('flag', 'number', 'name', 'altloc', 'resname', 'chain', 'resnumb', 'coords')
+        columns = (flags, numbers, _strings(first['name']), altlocs, resnames, chains,
+                   resnumbs.tolist(), self.coords.swapaxes(0, 1))
+
+        atoms = []
+        for values in zip(*columns):
+            a = blocks.Atom()
+            a.__dict__.update(zip(keys, values))
+            atoms.append(a)
+
         self.atoms = tuple(atoms)
 
-        if _alt_loc_warning:
+        if any(altlocs):
             self.lgr.warning("there are atom records with altloc flags - fix this")
 
-        # make sure all the atomic coordinates are the same length
-        for a in atoms:
-            assert len(a.coords) == len(atoms[0].coords)
+        # a new molecule at each HETATM residue and at the first ATOM after a HETATM
+        bounds = [0, natoms]
+        if guess_mols:
+            het = np.array(flags) == 'HETATM'
+            names = np.array(resnames, dtype=object)
+            new_res = (names[1:] != names[:-1]) | (resnumbs[1:] != resnumbs[:-1])
+            new_mol = np.where(het[1:], new_res, het[:-1])
+            bounds = [0] + (np.flatnonzero(new_mol) + 1).tolist() + [natoms]
+
+        molecules = []
+        for i, j in zip(bounds[:-1], bounds[1:]):
+            M = blocks.Molecule()
+            M.atoms = atoms[i:j]
+            molecules.append(M)
 
         # build residue and chains
-        for m in molecules:
-            build_res_chain(m)
+        build_res_chains(molecules, (np.array(resnames, dtype=object), resnumbs,
+                                     np.array(chains, dtype=object)))
 
         self.molecules = tuple(molecules)
 
@@ -134,6 +233,137 @@ class PDBSystem(object):
 
 
 
+class PDBFrames(object):
+
+    def __init__(self, pdbfile, dtype=np.float64):
+        """ Lazy reader of the models of a multi-model pdb file.
+
+        The first scan only records where each model starts and ends in the
+        file; the coordinates of a model are decoded when it is accessed.
+        A file without MODEL records has one frame.
+
+            frames = PDBFrames('ensemble.pdb')
+            frames[500]           # (natoms, 3) array of the model 501
+            frames[10:100:10]     # (9, natoms, 3) array
+            for x in frames: ...  # one model at a time
+
+        Args:
+            pdbfile : str, path to the pdb file
+            dtype   : numpy.float64 or numpy.float32, type of the coordinates
+
+        Attributes:
+            offsets : (nmodels, 2) array, the byte range of each model
+            natoms  : int, number of atoms in the first model
+
+        """
+
+        self.lgr = logging.getLogger('mainapp.pdb.PDBFrames')
+
+        if not os.path.exists(pdbfile):
+            raise IOError("the pdb file '%s' doesn't exist" % pdbfile)
+
+        self.pdbfile = pdbfile
+        self.dtype   = dtype
+        self.offsets = self._scan(pdbfile)
+        self.natoms  = len(self._read(0)) if len(self.offsets) else 0
+
+        self.lgr.debug("%d models in %s" % (len(self.offsets), pdbfile))
+
+
+    def _scan(self, pdbfile):
+        size = os.path.getsize(pdbfile)
+        if size == 0:
+            return np.zeros((0, 2), dtype=np.int64)
+
+        with open(pdbfile, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                starts = np.array(self._find_records(buf, b'MODEL'), dtype=np.int64)
+                ends = np.array(self._find_records(buf, b'ENDMDL'), dtype=np.int64)
+            finally:
+                buf.close()
+
+        if len(starts) == 0:
+            return np.array([[0, size]], dtype=np.int64)
+
+        # a model ends at its ENDMDL, or at the next MODEL or the end of the file
+        nxt = np.append(starts[1:], size)
+        k = np.searchsorted(ends, starts)
+        end = np.where(k < len(ends), ends[np.minimum(k, len(ends) - 1)], size)
+        return np.stack([starts, np.minimum(end, nxt)], axis=1)
+
+
+    @staticmethod
+    def _find_records(buf, name):
+        # offsets of the lines that start with name
+        found = [0] if buf[:len(name)] == name else []
+        k = buf.find(b'\n' + name)
+        while k >= 0:
+            found.append(k + 1)
+            k = buf.find(b'\n' + name, k + 1)
+        return found
+
+
+    def _decode(self, buf):
+        # the coordinates of the ATOM/HETATM records of a model
+        records, sizes = read_atom_records(buf)
+        return record_coords(records, self.dtype)
+
+
+    def _read(self, i, f=None):
+        # decodes model i, from the open file f or by opening the file
+        if f is None:
+            with open(self.pdbfile, 'rb') as f:
+                return self._read(i, f)
+        start, stop = self.offsets[i]
+        f.seek(start)
+        return self._decode(f.read(stop - start))
+
+
+    def _checked(self, i, x):
+        if len(x) != self.natoms:
+            raise ValueError("model %d has %d atoms, the first model has %d" % (i+1, len(x), self.natoms))
+        return x
+
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            indices = range(*key.indices(len(self)))
+            out = np.empty((len(indices), self.natoms, 3), dtype=self.dtype)
+            with open(self.pdbfile, 'rb') as f:
+                for k, i in enumerate(indices):
+                    out[k] = self._checked(i, self._read(i, f))
+            return out
+
+        i = int(key)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("model %d out of range (%d models)" % (key, len(self)))
+        return self._checked(i, self._read(i))
+
+
+    def __iter__(self):
+        with open(self.pdbfile, 'rb') as f:
+            for i in range(len(self)):
+                yield self._checked(i, self._read(i, f))
+
+
+    def batches(self, batch_size=16):
+        '''Yields the models as (nframes, natoms, 3) stacks, like rescore.pdb_frames'''
+        for start in range(0, len(self), batch_size):
+            yield self[start:start + batch_size]
+
+
+    def __repr__(self):
+        return "PDBFrames with %d models of %d atoms" % (len(self), self.natoms)
+
+
+
 
 
 
@@ -3,13 +3,17 @@ This module provides tools for working with PSF files.
 
 """
 
-from pytopol.parsers.utils import build_res_chain, build_pairs
-from pytopol.parsers.pdb import PDBSystem
+from pytopol.parsers.utils import build_res_chain, build_res_chains, build_pairs, build_index_array, connected_components
+from pytopol.parsers.utils import term_natoms, atom_columns, fingerprint_arrays
+from pytopol.parsers.pdb import read_atom_records, record_coords
+from pytopol.parsers.namdbin import read_namdbin
+from pytopol.parsers.dcd import DCDFrames
 from pytopol.parsers import blocks
 
 import os
 import logging
 import time
+import numpy as np
 
 # create logger
 module_logger = logging.getLogger('mainapp.psf')
@@ -55,18 +59,160 @@ class PSFSystem(blocks.System):
 
 
 
-    def add_pdbfile(self, pdbfile, mol):
-        """ add coordinates form a pdb file to the system."""
+    def add_pdbfile(self, pdbfile, mol, check_names=True):
+        """ add coordinates form a pdb file to the system.
 
-        pdb = PDBSystem(pdbfile, guess_mols=False)
+        Only the ATOM/HETATM columns of the pdb file are decoded (no Atom
+        objects are built): self.coords is the (nmodels, natoms, 3) array of
+        all the models and the coords of each atom of mol is a view into it.
 
-        if len(pdb.atoms) == len(mol.atoms):
-            for i, atom in enumerate(mol.atoms):
-                atom.coords = pdb.atoms[i].coords
-            self.lgr.debug("coordinates from pdb file were added")
-        else:
+        Args:
+            pdbfile     : str, path to the pdb file
+            mol         : Molecule, its atoms are in the order of the pdb file
+            check_names : bool, check that the atom names, residue names and
+                          residue numbers of the pdb file match the ones of mol
+
+        Returns:
+            True if the coordinates were added
+
+        """
+
+        if not os.path.exists(pdbfile):
+            self.lgr.error("the pdb file '%s' doesn't exist" % pdbfile)
+            return False
+
+        with open(pdbfile, 'rb') as f:
+            records, sizes = read_atom_records(f.read())
+
+        natoms = len(mol.atoms)
+        if len(sizes) == 0 or any(n != natoms for n in sizes):
             self.lgr.error("the number of atoms in the pdb and psf files doesn't match: %6d vs %6d" % (
-                len(pdb.atoms), len(mol.atoms)))
+                sizes[0] if sizes else 0, natoms))
+            return False
+
+        if check_names and not self._check_pdb_records(records[:natoms], mol):
+            return False
+
+        self._attach_coords(mol, record_coords(records).reshape(len(sizes), natoms, 3))
+        self.lgr.debug("coordinates from pdb file were added")
+        return True
+
+
+    def _check_pdb_records(self, records, mol):
+        # compares the pdb records with the atoms of mol and logs the first mismatches
+        # (pdb columns are 4 characters wide and the residue numbers have 4 digits)
+        pdb_names    = np.char.strip(records['name']).astype(str)
+        pdb_resnames = np.char.strip(records['resname']).astype(str)
+        try:
+            pdb_resnumbs = records['resnumb'].astype(np.int64)
+        except ValueError:
+            self.lgr.error("the residue numbers of the pdb file are not integers")
+            return False
+
+        psf_names    = np.array([a.name[:4] for a in mol.atoms], dtype=str)
+        psf_resnames = np.array([a.resname[:4] for a in mol.atoms], dtype=str)
+        psf_resnumbs = np.array([a.resnumb for a in mol.atoms], dtype=np.int64)
+
+        bad = (pdb_names != psf_names) | (pdb_resnames != psf_resnames) | \
+              (pdb_resnumbs % 10000 != psf_resnumbs % 10000)
+        if not np.any(bad):
+            return True
+
+        rows = np.flatnonzero(bad)
+        msg = "%d atoms of the pdb file don't match the psf file, the first ones are:" % len(rows)
+        for i in rows[:5]:
+            msg += "\n  atom %6d: pdb %4s %4s %5d  psf %4s %4s %5d" % (i + 1,
+                pdb_names[i], pdb_resnames[i], pdb_resnumbs[i],
+                mol.atoms[i].name, mol.atoms[i].resname, mol.atoms[i].resnumb)
+        self.lgr.error(msg)
+        return False
+
+
+    def _attach_coords(self, mol, coords):
+        # coords (nmodels, natoms, 3) become the coordinates of the system and the atoms of mol
+        self.coords = coords
+        for i, atom in enumerate(mol.atoms):
+            atom.coords = coords[:, i]
+
+
+    def add_coorfile(self, coorfile, mol):
+        """ add coordinates from a NAMD binary coordinate file (.coor) to the system.
+
+        The file is memory-mapped: self.coords is a read-only (1, natoms, 3)
+        view of it and the coords of each atom of mol is a (1, 3) view.
+
+        Returns:
+            True if the coordinates were added
+
+        """
+
+        coords = self._add_namdbin(coorfile, mol, 'coor')
+        if coords is None:
+            return False
+
+        self._attach_coords(mol, coords[None])
+        self.lgr.debug("coordinates from namd binary file were added")
+        return True
+
+
+    def add_velfile(self, velfile, mol):
+        """ add velocities from a NAMD binary velocity file (.vel) to the system.
+
+        self.velocities is a read-only (natoms, 3) view of the memory-mapped
+        file (in NAMD units) and the velocities of each atom of mol is a (3,) view.
+
+        Returns:
+            True if the velocities were added
+
+        """
+
+        velocities = self._add_namdbin(velfile, mol, 'vel')
+        if velocities is None:
+            return False
+
+        self.velocities = velocities
+        for i, atom in enumerate(mol.atoms):
+            atom.velocities = velocities[i]
+        self.lgr.debug("velocities from namd binary file were added")
+        return True
+
+
+    def add_dcdfile(self, dcdfile, mol):
+        """ add the frames of a DCD trajectory to the system.
+
+        self.coords is the (nframes, natoms, 3) memory-mapped view of all the
+        frames (a copy if the trajectory has fixed atoms), the coords of each
+        atom of mol is an (nframes, 3) view into it and self.cells has the unit
+        cells, if any, as (a, b, c, alpha, beta, gamma) rows (reordered from
+        the A, gamma, B, beta, alpha, C of the dcd file). The DCDFrames reader
+        is kept as self.trajectory.
+
+        Returns:
+            True if the frames were added
+
+        """
+
+        frames = DCDFrames(dcdfile)
+        if frames.natoms != len(mol.atoms):
+            self.lgr.error("the number of atoms in the dcd and psf files doesn't match: %6d vs %6d" % (
+                frames.natoms, len(mol.atoms)))
+            return False
+
+        self.trajectory = frames
+        self.cells = None if frames.cells is None else frames.cells[:, [0, 2, 5, 4, 3, 1]]
+        self._attach_coords(mol, frames[:])
+        self.lgr.debug("%d frames from dcd file were added" % len(frames))
+        return True
+
+
+    def _add_namdbin(self, fname, mol, what):
+        # the memory-mapped array of fname, or None if the atoms don't match
+        data = read_namdbin(fname)
+        if len(data) != len(mol.atoms):
+            self.lgr.error("the number of atoms in the %s and psf files doesn't match: %6d vs %6d" % (
+                what, len(data), len(mol.atoms)))
+            return None
+        return data
 
 
 
@@ -160,23 +306,39 @@ class PSFSystem(blocks.System):
 
 
 
-    def split_psf(self):
+    def split_psf(self, mode='segments'):
         """Convert a psf Molecule to multiple Molecules.
 
-        Using this function only makes sense if the segments in the PSF file
-            are not covalently bond (usually this the case).
+        With mode 'segments', there is one Molecule per chain (segment) name.
+        Using this only makes sense if the segments in the PSF file are not
+        covalently bond (usually this the case).
+
+        With mode 'connectivity', the Molecules are the connected components
+        of the bonds (see utils.connected_components), whatever the segment
+        names - like the waters of a single segment. The molecules with the
+        same topology (utils.topology_fingerprint) are grouped:
+        self.molecule_blocks has one Molecule for each run of identical
+        molecules and its count. The molecules are in the order of their
+        first atom; if the atoms of a molecule are interleaved with others
+        in the psf file, they are reordered and self.atom_order has the psf
+        index of each atom in the order of the molecules (the coordinates
+        of the psf order, like self.coords, are coords[..., self.atom_order, :]).
 
         Args:
-           temp_mol : a psf Molecule instance
+           mode : 'segments' or 'connectivity'
 
         Returns:
-           list of Molecules or False
+           None, or False on error
 
         """
 
+        assert mode in ('segments', 'connectivity')
         assert len(self.molecules) == 1
         temp_mol = self.molecules[0]
 
+        if mode == 'connectivity':
+            return self._split_connectivity(temp_mol)
+
         self.lgr.debug("converting psf to multiple molecules based on chains")
 
         unique_chains = set([chain.name for chain in temp_mol.chains])
@@ -266,6 +428,84 @@ class PSFSystem(blocks.System):
         self.molecules = tuple(molecules)
 
 
+    # the terms moved to the molecules
+    split_kinds = ('bonds', 'angles', 'dihedrals', 'impropers', 'cmaps', 'pairs')
+
+    def _split_connectivity(self, temp_mol):
+        natoms = len(temp_mol.atoms)
+        labels = connected_components(build_index_array(temp_mol, 'bonds'), natoms)
+        nmols = labels[-1] + 1 if natoms else 0
+        self.lgr.debug("converting psf to %d molecules based on the bonds" % nmols)
+
+        # the atoms sorted by molecule, in the psf order in each molecule
+        order = np.argsort(labels, kind='stable')
+        self.atom_order = order
+        atoms = temp_mol.atoms
+        position = None
+        if np.any(np.diff(labels) < 0):
+            self.lgr.debug("reordering the atoms of the interleaved molecules")
+            atoms = [atoms[i] for i in order.tolist()]
+            labels = labels[order]
+            position = np.empty(natoms, dtype=np.int64)
+            position[order] = np.arange(natoms)
+        offsets = np.searchsorted(labels, np.arange(nmols + 1))
+
+        # the terms sorted by molecule, with the atom indices in the molecule
+        terms = {}
+        for kind in self.split_kinds:
+            objects = list(getattr(temp_mol, kind))
+            indices = build_index_array(temp_mol, kind)
+            if position is not None:
+                indices = position[indices]
+            mol = labels[indices]
+            if np.any(mol != mol[:, :1]):
+                self.lgr.error("some %s join atoms of different molecules" % kind)
+                return False
+
+            order = np.argsort(mol[:, 0], kind='stable')
+            bounds = np.searchsorted(mol[order, 0], np.arange(nmols + 1)).tolist()
+            local = indices[order] - offsets[mol[order, 0]][:, None]
+            terms[kind] = ([objects[k] for k in order.tolist()], bounds, local)
+
+        # identical molecules have the same topology fingerprint, computed
+        # from slices of the columns of all the atoms
+        columns = atom_columns(atoms)
+        offsets = offsets.tolist()
+        kinds = sorted(term_natoms)
+        no_terms = dict((kind, np.zeros((0, term_natoms[kind]), np.int64)) for kind in kinds)
+
+        def _fingerprint_of(k):
+            s, e = offsets[k], offsets[k+1]
+            mol_terms = []
+            for kind in kinds:
+                if kind in terms:
+                    objects, b, local = terms[kind]
+                    mol_terms.append((kind, local[b[k]:b[k+1]]))
+                else:
+                    mol_terms.append((kind, no_terms[kind]))
+            return fingerprint_arrays(*[c[s:e] for c in columns] + [mol_terms])
+
+        molecules = []
+        moltypes = {}
+        self.molecule_blocks = blocks.MoleculeBlocks()
+        for k in range(nmols):
+            m = blocks.Molecule()
+            m.atoms = list(atoms[offsets[k]:offsets[k+1]])
+            for kind in self.split_kinds:
+                objects, b, _ = terms[kind]
+                setattr(m, kind, objects[b[k]:b[k+1]])
+
+            m.renumber_atoms()
+            molecules.append(m)
+
+            self.molecule_blocks.add(moltypes.setdefault(_fingerprint_of(k), m), 1)
+
+        build_res_chains(molecules)
+
+        self.lgr.debug("%d molecules of %d kinds" % (nmols, len(moltypes)))
+        self.molecules = tuple(molecules)
+
+
 
     def _find_psf_format(self, first_line):
         """Find the PSF format.
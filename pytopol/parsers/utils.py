@@ -1,82 +1,514 @@
 import logging
+import hashlib
+import numpy as np
 from pytopol.parsers import blocks
 
 lgr = logging.getLogger('mainapp.utils')
 
 
+# number of atoms in each kind of term of a Molecule
+term_natoms = {
+    'bonds': 2, 'pairs': 2, 'constraints': 2,
+    'angles': 3,
+    'dihedrals': 4, 'impropers': 4,
+    'cmaps': 8,
+}
+
+water_resnames = ('TIP3', 'TIP4', 'TIP5', 'SPC', 'SPCE', 'SOL', 'WAT', 'HOH')
+
+
+def build_index_array(m, kind):
+    # returns the zero-based atom indices of the terms in m.<kind> as an (n, k) array
+    terms = getattr(m, kind)
+    if isinstance(terms, blocks.TermArray):
+        return terms.indices
+
+    k = term_natoms[kind]
+    index = dict((atom, i) for i, atom in enumerate(m.atoms))
+    names = ['atom%d' % (j+1) for j in range(k)]
+
+    flat = [index[getattr(t, name)] for t in terms for name in names]
+    return np.array(flat, dtype=np.int64).reshape(len(terms), k)
+
+
+def _sorted_unique(keys):
+    # sorted distinct values of an int array
+    keys = np.sort(keys)
+    return keys[np.concatenate([[True], keys[1:] != keys[:-1]])] if len(keys) else keys
+
+
+def _sorted_isin(keys, table):
+    # which keys are in the sorted array table
+    if not len(table):
+        return np.zeros(len(keys), dtype=bool)
+    i = np.minimum(np.searchsorted(table, keys), len(table) - 1)
+    return table[i] == keys
+
+
+def bond_graph(bonds, natoms):
+    """ Compressed sparse row adjacency of a bond index array.
+
+    Args:
+        bonds  : (n, 2) zero-based atom indices (like build_index_array(m, 'bonds')),
+                 repeated bonds are counted once
+        natoms : int, number of atoms
+
+    Returns:
+        (offsets, neighbors): the bonded neighbors of atom i are
+        neighbors[offsets[i]:offsets[i+1]], in increasing order
+
+    """
+
+    bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+    bonds = bonds[bonds[:, 0] != bonds[:, 1]]
+    keys = _sorted_unique(np.concatenate([bonds[:, 0] * natoms + bonds[:, 1],
+                                          bonds[:, 1] * natoms + bonds[:, 0]]))
+    src = keys // natoms
+    offsets = np.zeros(natoms + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=natoms), out=offsets[1:])
+    return offsets, keys % natoms
+
+
+def _expand(counts):
+    # for groups with the given counts: the group of each element and its rank in the group
+    group = np.repeat(np.arange(len(counts)), counts)
+    rank = np.arange(len(group)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return group, rank
+
+
+def graph_angles(offsets, neighbors):
+    '''Returns the (n, 3) angles i-j-k (i < k) of a bond graph, for each pair of neighbors of each atom'''
+    slot = np.arange(len(neighbors))
+    center = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+    # each neighbor slot pairs with the following slots of the same atom
+    first, rank = _expand(offsets[center + 1] - slot - 1)
+    second = first + 1 + rank
+    return np.stack([neighbors[first], center[first], neighbors[second]], axis=1)
+
+
+def graph_dihedrals(offsets, neighbors):
+    '''Returns the (n, 4) proper dihedrals i-j-k-l of a bond graph, one for each path of 3 bonds'''
+    degree = np.diff(offsets)
+    center = np.repeat(np.arange(len(degree)), degree)
+    j, k = center, neighbors
+    central = j < k
+    j, k = j[central], k[central]
+
+    # all the neighbors of j times all the neighbors of k, without the central bond and 3-rings
+    bond, rank = _expand(degree[j] * degree[k])
+    dk = degree[k][bond]
+    i = neighbors[offsets[j][bond] + rank // dk]
+    l = neighbors[offsets[k][bond] + rank % dk]
+    j, k = j[bond], k[bond]
+
+    keep = (i != k) & (l != j) & (i != l)
+    return np.stack([i[keep], j[keep], k[keep], l[keep]], axis=1)
+
+
+def pairs_14(dihedrals, bonds, angles, natoms):
+    """ The 1-4 pairs of the dihedrals.
+
+    The pairs are canonical int64 keys (min * natoms + max), so the 1-2 and
+    1-3 pairs (in rings) and the repeated pairs are removed with sorted-array
+    set operations.
+
+    Returns:
+        (n, 2) zero-based atom indices, the first one is the smaller
+
+    """
+
+    def _keys(a, b):
+        return np.minimum(a, b) * natoms + np.maximum(a, b)
+
+    dihedrals = np.asarray(dihedrals, dtype=np.int64).reshape(-1, 4)
+    bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+    angles = np.asarray(angles, dtype=np.int64).reshape(-1, 3)
+
+    keys = _sorted_unique(_keys(dihedrals[:, 0], dihedrals[:, 3]))
+    close = np.sort(np.concatenate([_keys(bonds[:, 0], bonds[:, 1]), _keys(angles[:, 0], angles[:, 2])]))
+    keys = keys[~_sorted_isin(keys, close)]
+    return np.stack([keys // natoms, keys % natoms], axis=1)
+
+
+def connected_components(bonds, natoms):
+    """ The molecules of a bond graph, by union-find over the bond array.
+
+    All the bonds are hooked at once (the larger root points to the smaller
+    one) and the paths are then compressed by pointer jumping, until no bond
+    joins two roots; each pass takes linear time and few passes are needed.
+
+    Args:
+        bonds  : (n, 2) zero-based atom indices
+        natoms : int, number of atoms
+
+    Returns:
+        (natoms,) int array, the component of each atom, numbered in the
+        order of the first atom of the components
+
+    """
+
+    bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+    parent = np.arange(natoms, dtype=np.int64)
+    while True:
+        a, b = parent[bonds[:, 0]], parent[bonds[:, 1]]
+        joined = a != b
+        if not np.any(joined):
+            break
+        a, b = a[joined], b[joined]
+        np.minimum.at(parent, np.maximum(a, b), np.minimum(a, b))
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+
+    # the roots are the smallest atoms of the components
+    roots = parent == np.arange(natoms)
+    return np.cumsum(roots)[parent] - 1
+
+
+def _term_format(m, default='gromacs'):
+    # 'charmm' or 'gromacs', the format of the first bonded terms of a molecule
+    for kind in ('bonds', 'angles', 'dihedrals', 'impropers', 'pairs'):
+        terms = getattr(m, kind)
+        if len(terms):
+            return terms.format if isinstance(terms, blocks.TermArray) else terms[0].format
+    return default
+
+
+def generate_terms(m, funcs=None, format=None, force=False):
+    """ Angles, proper dihedrals and 1-4 pairs of a molecule from its bonds.
+
+    For molecules that only have bonds (like topologies assembled from
+    fragments), m.angles, m.dihedrals and m.pairs are set to TermArrays of
+    all the terms of the bond graph. A molecule that already has angles,
+    dihedrals or pairs is left as it is, unless force is given.
+
+    Args:
+        m      : Molecule with atoms and bonds
+        funcs  : dict of term kind : GROMACS function type, default
+                 {'angles': 5, 'dihedrals': 9, 'pairs': 1} (CHARMM)
+        format : 'charmm' or 'gromacs', default is the format of the bonds
+        force  : bool, replace the existing angles, dihedrals and pairs
+
+    Returns:
+        the number of (angles, dihedrals, pairs) of the molecule
+
+    """
+
+    kinds = ('angles', 'dihedrals', 'pairs')
+    if not force and any(len(getattr(m, kind)) for kind in kinds):
+        lgr.info('the molecule already has angles, dihedrals or pairs - not generating them')
+        return tuple(len(getattr(m, kind)) for kind in kinds)
+
+    format = format or _term_format(m)
+    assert format in ('charmm', 'gromacs')
+
+    funcs = dict({'angles': 5, 'dihedrals': 9, 'pairs': 1}, **(funcs or {}))
+    natoms = len(m.atoms)
+    bonds = build_index_array(m, 'bonds')
+
+    offsets, neighbors = bond_graph(bonds, natoms)
+    terms = {
+        'angles'   : graph_angles(offsets, neighbors),
+        'dihedrals': graph_dihedrals(offsets, neighbors),
+    }
+    terms['pairs'] = pairs_14(terms['dihedrals'], bonds, terms['angles'], natoms)
+
+    classes = {'angles': blocks.AngleType, 'dihedrals': blocks.DihedralType, 'pairs': blocks.InteractionType}
+    for kind, indices in terms.items():
+        k = indices.shape[1]
+        arr = blocks.TermArray(classes[kind], format, m.atoms, tuple('atom%d' % (j+1) for j in range(k)),
+                               indices, np.full(len(indices), funcs[kind], dtype=np.int64),
+                               np.zeros((len(indices), 0)))
+        setattr(m, kind, arr)
+
+    lgr.debug('generated %d angles, %d dihedrals and %d pairs from %d bonds' % (
+        len(terms['angles']), len(terms['dihedrals']), len(terms['pairs']), len(bonds)))
+    return len(terms['angles']), len(terms['dihedrals']), len(terms['pairs'])
+
+
+def exclusion_lists(offsets, neighbors, nrexcl):
+    """ The atoms up to nrexcl bonds apart, as in the nrexcl of [ moleculetype ].
+
+    The breadth-first search runs from all the atoms at once: each step
+    expands the (source, atom) pairs of the frontier to the neighbors of the
+    atoms. A neighbor of an atom at distance d is at distance d-1, d or d+1,
+    so only the pairs of the last two levels (sorted int64 keys) are removed,
+    and the cost grows with the number of excluded pairs.
+
+    Args:
+        offsets, neighbors : the bond graph (see bond_graph)
+        nrexcl : int, number of bonds
+
+    Returns:
+        (excl_offsets, excluded): the atoms excluded by atom i with a larger
+        index are excluded[excl_offsets[i]:excl_offsets[i+1]], in increasing order
+
+    """
+
+    natoms = len(offsets) - 1
+    degree = np.diff(offsets)
+
+    source = atom = np.arange(natoms, dtype=np.int64)
+    levels = [np.zeros(0, dtype=np.int64), source * natoms + source]
+    for step in range(nrexcl):
+        pair, rank = _expand(degree[atom])
+        keys = _sorted_unique(source[pair] * natoms + neighbors[offsets[atom][pair] + rank])
+        keys = keys[~(_sorted_isin(keys, levels[-1]) | _sorted_isin(keys, levels[-2]))]
+        if not len(keys):
+            break
+        levels.append(keys)
+        source, atom = keys // natoms, keys % natoms
+
+    keys = np.sort(np.concatenate(levels[2:])) if len(levels) > 2 else levels[0]
+    i, j = keys // natoms, keys % natoms
+    keep = i < j
+    excl_offsets = np.zeros(natoms + 1, dtype=np.int64)
+    np.cumsum(np.bincount(i[keep], minlength=natoms), out=excl_offsets[1:])
+    return excl_offsets, j[keep]
+
+
+def build_exclusions(m, nrexcl):
+    """ Fills m.exclusions with the atoms up to nrexcl bonds apart.
+
+    One blocks.Exclusion for each atom that excludes atoms after it (see
+    exclusion_lists), in place of the exclusions m already has.
+
+    Returns:
+        (excl_offsets, excluded) of exclusion_lists
+
+    """
+
+    offsets, neighbors = bond_graph(build_index_array(m, 'bonds'), len(m.atoms))
+    excl_offsets, excluded = exclusion_lists(offsets, neighbors, nrexcl)
+
+    atoms = m.atoms
+    excluded_list = excluded.tolist()
+    bounds = excl_offsets.tolist()
+    m.exclusions = []
+    for i in np.flatnonzero(np.diff(excl_offsets)).tolist():
+        ex = blocks.Exclusion()
+        ex.main_atom = atoms[i]
+        ex.other_atoms = [atoms[k] for k in excluded_list[bounds[i]:bounds[i+1]]]
+        m.exclusions.append(ex)
+
+    return excl_offsets, excluded
+
+
+def fingerprint_arrays(names, types, resnames, charges, masses, terms):
+    '''The topology_fingerprint of atom columns (see atom_columns) and (kind, index array) terms'''
+    h = hashlib.sha1()
+    h.update(('%d\n' % len(names)).encode('ascii'))
+    for column in (names, types, resnames):
+        h.update(('\0'.join(column) + '\n').encode('utf-8'))
+    for column in (charges, masses):
+        h.update(np.ascontiguousarray(column, dtype='<f8').tobytes())
+    for kind, indices in terms:
+        h.update(('%s %d\n' % (kind, len(indices))).encode('ascii'))
+        h.update(np.ascontiguousarray(indices, dtype='<i8').tobytes())
+    return h.hexdigest()
+
+
+def atom_columns(atoms):
+    '''Returns the names, types and residue names (lists of str), charges and masses (arrays) of the atoms'''
+    names    = [str(a.name) for a in atoms]
+    types    = [str(getattr(a, 'atomtype', '')) for a in atoms]
+    resnames = [str(getattr(a, 'resname', '')) for a in atoms]
+    charges  = np.array([getattr(a, 'charge', np.nan) for a in atoms], dtype=np.float64)
+    masses   = np.array([getattr(a, 'mass', np.nan) for a in atoms], dtype=np.float64)
+    return names, types, resnames, charges, masses
+
+
+def topology_fingerprint(obj):
+    """ A stable hash of the topology of a Molecule or a System.
+
+    It covers the names, types, residue names, charges and masses of the
+    atoms and the atom indices of all the bonded terms (bonds, pairs,
+    angles, dihedrals, impropers, cmaps and constraints), but not the
+    parameters or the objects: the same topology read twice has the same
+    fingerprint. The fingerprint of a System is the one of its run-length
+    list of molecules, so a tuple of molecules and the equivalent
+    MoleculeBlocks have the same fingerprint.
+
+    Args:
+        obj : blocks.Molecule or blocks.System
+
+    Returns:
+        str, 40 hex digits
+
+    """
+
+    if isinstance(obj, blocks.Molecule):
+        terms = [(kind, build_index_array(obj, kind)) for kind in sorted(term_natoms)]
+        return fingerprint_arrays(*(atom_columns(obj.atoms) + (terms,)))
+
+    molecules = obj.molecules
+    if isinstance(molecules, blocks.MoleculeBlocks):
+        molecules = molecules.iter_blocks()
+    else:
+        molecules = [(m, 1) for m in molecules]
+
+    cache = {}
+    runs = []
+    for m, count in molecules:
+        if m not in cache:
+            cache[m] = topology_fingerprint(m)
+        fp = cache[m]
+        if runs and runs[-1][0] == fp:
+            runs[-1][1] += count
+        else:
+            runs.append([fp, count])
+
+    return hashlib.sha1(''.join('%s %d\n' % (fp, n) for fp, n in runs).encode('ascii')).hexdigest()
+
+
+def is_hydrogen(masses):
+    # hydrogens are recognized from their mass (deuterium and virtual sites are not)
+    masses = np.asarray(masses)
+    return (masses > 0.5) & (masses < 1.5)
+
+
+def repartition_hydrogen_mass(m, hmass=3.024, skip_water=True):
+    """Hydrogen mass repartitioning.
+
+    Moves mass from the heavy atoms to their bonded hydrogens, so that every
+    hydrogen ends up with `hmass` and the total mass of the molecule is kept.
+
+    Args:
+        m          : Molecule with atoms (mass) and bonds
+        hmass      : float, target mass of the hydrogens
+        skip_water : bool, leave the water molecules untouched
+
+    Returns:
+        (masses, total_before, total_after), masses is an array of the new
+        per-atom masses in the order of m.atoms
+
+    """
+
+    masses = np.array([a.mass for a in m.atoms], dtype=np.float64)
+    new_masses = masses.copy()
+    bonds = build_index_array(m, 'bonds')
+
+    hydrogen = is_hydrogen(masses)
+    if skip_water:
+        water = np.array([a.resname in water_resnames for a in m.atoms], dtype=bool)
+        hydrogen &= ~water
+
+    # heavy atom - hydrogen bonds, oriented as (heavy, hydrogen)
+    h1 = hydrogen[bonds[:, 0]]
+    h2 = hydrogen[bonds[:, 1]]
+    xh = bonds[h1 != h2]
+    swap = hydrogen[xh[:, 0]]
+    xh[swap] = xh[swap][:, ::-1]
+
+    # each hydrogen gets its mass from one heavy atom only
+    hyd, first = np.unique(xh[:, 1], return_index=True)
+    heavy = xh[first, 0]
+
+    delta = hmass - masses[hyd]
+    new_masses[hyd] = hmass
+    np.subtract.at(new_masses, heavy, delta)
+
+    if np.any(new_masses[heavy] <= 0):
+        bad = m.atoms[heavy[new_masses[heavy] <= 0][0]]
+        raise ValueError("hydrogen mass repartitioning leaves atom %s %d with no mass" % (
+            bad.name, bad.number))
+
+    return new_masses, masses.sum(), new_masses.sum()
+
+
+def _run_starts(columns, breaks=()):
+    # indices where any of the columns differs from the previous element, and the breaks
+    n = len(columns[0])
+    new = np.zeros(n, dtype=bool)
+    if n:
+        new[0] = True
+        for c in columns:
+            new[1:] |= c[1:] != c[:-1]
+        new[breaks] = True
+    return np.flatnonzero(new)
+
+
 def build_res_chain(m):
-    # using a molecule object with atoms, builds residues and chains
-    R = None
-    residues = []
-    for i, a in enumerate(m.atoms):
-        if R is None or (a.resname  != R.name or
-                          a.resnumb != R.number or
-                          a.chain   != R.chain_name):
-            R = blocks.Residue()
-            R.name = a.resname
-            R.number = a.resnumb
-            R.chain_name  = a.chain
-            residues.append(R)
-
-        R.atoms.append(a)
-        a.residue = R
-
-    m.residues = residues
-
-    # chains
-    C = None   # current chain object
-    chains = []
-    for i, r in enumerate(m.residues):
-        if C is None or (r.chain_name != C.name):
-            C = blocks.Chain()
-            C.name = r.chain_name
-            chains.append(C)
-
-        C.residues.append(r)
-        r.chain = C
-
-    m.chains = chains
+    """ Residues and chains of a molecule from the resname, resnumb and chain of its atoms.
 
-def build_pairs(m, format):
-    assert format in ('charmm', 'gromacs', None)
-    # using a molecule with bonds, angles and dihedrals, build pairs
-    # print('building pairs with %d bonds, %d angles and %d dihedrals' % (
-    #     len(m.bonds), len(m.angles), len(m.dihedrals)))
+    A new residue starts at each atom where one of the three differs from the
+    previous atom, and a new chain where the chain name changes. m.residues
+    and m.chains become a blocks.ResidueArray and blocks.ChainArray: the
+    Residue and Chain objects (and atom.residue) are built when they are
+    first accessed.
+
+    Returns:
+        (offsets, chain_offsets): residue i has the atoms offsets[i]:offsets[i+1],
+        chain j has the residues chain_offsets[j]:chain_offsets[j+1]
 
-    _bonds = []
-    for bond in m.bonds:
-        _bonds.append((bond.atom1.number, bond.atom2.number))
+    """
 
-    _angles = []
-    for ang in m.angles:
-        _angles.append((ang.atom1.number, ang.atom3.number))
+    build_res_chains([m])
+    return m.residues.offsets, m.residues.chain_offsets
 
-    _bonds = set(_bonds)
-    _angles = set(_angles)
 
-    _pairs = set([])
-    for dih in m.dihedrals:
-        p1 = dih.atom1.number
-        p4 = dih.atom4.number
+def build_res_chains(molecules, columns=None):
+    '''build_res_chain for many molecules, comparing the columns of all their atoms at once
+    (the resname, resnumb and chain arrays of the atoms can be given as columns)'''
+    if columns is None:
+        atoms = [a for m in molecules for a in m.atoms]
+        columns = (np.array([a.resname for a in atoms], dtype=object),
+                   np.array([a.resnumb for a in atoms], dtype=np.int64),
+                   np.array([a.chain for a in atoms], dtype=object))
+    resnames, resnumbs, chains = columns
+    natoms = len(resnames)
 
-        if (p1,p4) in _bonds or (p1,p4) in _angles or \
-           (p4,p1) in _bonds or (p4,p1) in _angles:
-            continue
+    # the residues and chains don't span two molecules
+    mol_offsets = np.cumsum([0] + [len(m.atoms) for m in molecules])
+    starts = _run_starts((resnames, resnumbs, chains), mol_offsets[:-1][mol_offsets[:-1] < natoms])
+    mol_residues = np.searchsorted(starts, mol_offsets)
+    chain_names = chains[starts]
+    chain_starts = _run_starts((chain_names,), mol_residues[:-1][mol_residues[:-1] < len(starts)])
+    mol_chains = np.searchsorted(chain_starts, mol_residues)
 
-        if (p1,p4) in _pairs or (p4,p1) in _pairs:
-            continue
+    offsets = np.append(starts, natoms)
+    chain_offsets = np.append(chain_starts, len(starts))
+    names, numbers = resnames[starts], resnumbs[starts]
 
-        _pairs.add((p1,p4))
+    for k, m in enumerate(molecules):
+        r0, r1 = mol_residues[k], mol_residues[k+1]
+        c0, c1 = mol_chains[k], mol_chains[k+1]
+        m.residues = blocks.ResidueArray(m.atoms, names[r0:r1], numbers[r0:r1], chain_names[r0:r1],
+                                         offsets[r0:r1+1] - mol_offsets[k], chain_offsets[c0:c1+1] - r0)
+        m.chains = blocks.ChainArray(m.residues)
 
-        thispair = blocks.InteractionType(format)
-        thispair.atom1 = dih.atom1
-        thispair.atom2 = dih.atom4
 
-        m.pairs.append(thispair)
+def build_pairs(m, format):
+    """ The 1-4 pairs of a molecule with bonds, angles and dihedrals.
+
+    The pairs are the ends of the dihedrals which are not also the ends of a
+    bond or an angle, each pair once (see pairs_14).
 
+    Args:
+        m      : Molecule
+        format : 'charmm' or 'gromacs', the pairs are added to m.pairs (as a
+                 TermArray of InteractionType); None to only return them
 
+    Returns:
+        (n, 2) zero-based atom indices, the first one is the smaller
 
+    """
 
+    assert format in ('charmm', 'gromacs', None)
 
+    natoms = len(m.atoms)
+    pairs = pairs_14(build_index_array(m, 'dihedrals'), build_index_array(m, 'bonds'),
+                     build_index_array(m, 'angles'), natoms)
 
+    if format is not None:
+        arr = blocks.TermArray(blocks.InteractionType, format, m.atoms, ('atom1', 'atom2'),
+                               pairs, np.ones(len(pairs), dtype=np.int64), np.zeros((len(pairs), 0)))
+        if len(m.pairs):
+            m.pairs = list(m.pairs) + arr.tolist()
+        else:
+            m.pairs = arr
 
+    return pairs
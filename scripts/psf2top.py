@@ -70,6 +70,17 @@ def main():
     p.add_argument('-c', default=[None], action='store', type=str, nargs='*',
     	help='charmm parameter files')
     p.add_argument('-v', action='store_true', help='verbose output', default=False)
+    p.add_argument('--hmr', type=float, default=None,
+        help='repartition the hydrogen masses to this value (e.g. 3.024)')
+    p.add_argument('--constraints', default=None, choices=['h-bonds', 'all-bonds'],
+        help='write these bonds as constraints and the waters as settles')
+    p.add_argument('--pdb', type=str, default=None,
+        help='pdb file with the coordinates of the psf atoms')
+    p.add_argument('--gro', type=str, default=None,
+        help='also write the coordinates from --pdb to this gro file')
+    p.add_argument('--split', default='segments', choices=['segments', 'connectivity'],
+        help='the molecules are the segments or the bonded groups of atoms (identical ones are counted, '
+             'the atoms of interleaved groups are reordered)')
 
     args = p.parse_args()
 
@@ -81,10 +92,16 @@ def main():
     # read the PSF file
     psffile = args.p
     psfsys = psf.PSFSystem(psffile)
-    psfsys.split_psf()
-    if len(psfsys.molecules) == 0:
+    if args.pdb:
+        if not psfsys.add_pdbfile(args.pdb, psfsys.molecules[0]):
+            lgr.error("could not add the coordinates from %s - see above" % args.pdb)
+            return 1
+    elif args.gro:
+        lgr.error("--gro needs the coordinates from --pdb")
+        return 1
+    if psfsys.split_psf(mode=args.split) is False or len(psfsys.molecules) == 0:
         lgr.error("could not build PSF system - see above")
-        return
+        return 1
 
 
     # read all the parameter files
@@ -96,15 +113,17 @@ def main():
     par.add_params_to_system(psfsys, panic_on_missing_param=True)
 
     # convert system to gromacs format
-    grotop.SystemToGroTop(psfsys)
+    grotop.SystemToGroTop(psfsys, hmr_mass=args.hmr, constraints=args.constraints, grofile=args.gro)
     if not os.path.exists('top.top') or not os.path.exists('itp_mol_01.itp'):
     	lgr.error("could not build GROAMCS top file - see above")
+    	return 1
 
     lgr.debug('<< exiting main \n')
 
     print('Done.')
+    return 0
 
-main()
+sys.exit(main())
 
 
 
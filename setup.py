@@ -51,6 +51,7 @@ setup(
     package_dir={'pytopol': 'pytopol'},
     include_package_data=True,
     install_requires=[
+        'numpy',
     ],
     license='GPLv3',
     zip_safe=False,
@@ -0,0 +1,60 @@
+import os
+import numpy as np
+from pytopol.parsers import psf
+from pytopol.parsers.pdb import PDBSystem
+from pytopol.parsers.dcd import DCDFrames, write_dcd
+
+systems_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'systems')
+
+rng = np.random.RandomState(3)
+frames = rng.uniform(-20, 20, (7, 50, 3)).astype(np.float32)
+cells  = rng.uniform(10, 20, (7, 6))
+
+
+def test_frames_and_cells(tmpdir):
+    fname = str(tmpdir.join('t.dcd'))
+    write_dcd(fname, frames, cells)
+    dcd = DCDFrames(fname)
+    assert (len(dcd), dcd.natoms) == (7, 50)
+
+    assert np.array_equal(dcd[3], frames[3])
+    assert np.array_equal(dcd[-1], frames[6])
+    assert np.array_equal(dcd[1:6:2], frames[1:6:2])
+    assert np.array_equal(dcd[::-3], frames[::-3])
+    assert np.array_equal(np.array(list(dcd)), frames)
+    assert np.array_equal(dcd.cells, cells)
+
+    # the frames are views of the mapped file
+    assert np.shares_memory(dcd[::2], dcd._data)
+    assert not dcd[0].flags.writeable
+
+def test_fixed_atoms(tmpdir):
+    free = np.array([1, 4, 7, 30, 49])
+    moved = np.repeat(frames[:1], 7, axis=0)
+    moved[:, free] = frames[:, free]
+
+    fname = str(tmpdir.join('fixed.dcd'))
+    write_dcd(fname, moved, free=free)
+    dcd = DCDFrames(fname)
+    assert np.array_equal(dcd.free, free)
+    assert dcd.cells is None
+    assert np.array_equal(dcd[4], moved[4])
+    assert np.array_equal(dcd[::3], moved[::3])
+
+def test_psf_trajectory(tmpdir):
+    name = os.path.join(systems_dir, 'peptide', 'p4_ADLK_autopsf')
+    x = PDBSystem(name + '.pdb').coords[0]
+    traj = np.array([x + k for k in range(4)], dtype=np.float32)
+    fname = str(tmpdir.join('p4.dcd'))
+    write_dcd(fname, traj)
+
+    system = psf.PSFSystem(name + '.psf')
+    mol = system.molecules[0]
+    assert system.add_dcdfile(fname, mol) is True
+    assert system.coords.shape == (4, len(mol.atoms), 3)
+    assert np.array_equal(mol.atoms[5].coords[2], traj[2, 5])
+
+    short = str(tmpdir.join('short.dcd'))
+    write_dcd(short, traj[:, 1:])
+    assert system.add_dcdfile(short, mol) is False
+    assert system.coords.shape == (4, len(mol.atoms), 3)
@@ -0,0 +1,234 @@
+import os
+import copy
+import numpy as np
+from pytopol.parsers import grotop, psf, charmmpar
+from pytopol.parsers.pdb import PDBSystem
+from pytopol.energy import bonded, nonbonded, cmap, rescore, forces
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'top')
+systems_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'systems')
+
+top = grotop.GroTop(os.path.join(data_dir, 'ad_wat.top'))
+natoms = top.molecules.total('atoms')
+
+rng = np.random.RandomState(7)
+coords = rng.uniform(0, 3.0, (natoms, 3))
+
+
+def test_geometry():
+    x = np.array([[1.0, 0, 0], [0, 0, 0], [0, 1.0, 0], [0, 1.0, 1.0]])
+    idx = np.array([[0, 1, 2, 3]])
+    assert np.allclose(bonded.distances(x, idx[:, :2]), 1.0)
+    assert np.allclose(bonded.angles(x, idx[:, :3]), np.pi / 2)
+    assert np.allclose(bonded.dihedrals(x, idx), -np.pi / 2)
+    assert np.allclose(bonded.dihedrals(x * [1, 1, -1], idx), np.pi / 2)
+
+def test_grotop_terms():
+    terms = bonded.terms_from_grotop(top)
+    assert len(terms.bonds['indices']) == 3 * 24
+    assert len(terms.dihedrals['indices']) == 3 * 56
+
+    # bonds of the first molecule, one by one
+    ad = top.dict_molname_mol['AD']
+    bonds = top.get_parameters(ad, 'bonds')['params']
+    ref = 0.0
+    for (i, j), (b0, kb) in zip(ad.bonds.indices, bonds):
+        ref += 0.5 * kb * (np.linalg.norm(coords[i] - coords[j]) - b0)**2
+
+    assert np.isclose(bonded.bond_energies(coords, terms.bonds)[:24].sum(), ref)
+
+def test_units_and_frames():
+    terms = bonded.terms_from_grotop(top)
+    e_kj   = terms.energies(coords)
+    e_kcal = terms.energies(coords, units='kcal/mol')
+    frames = terms.energies(np.array([coords, coords + 1.0]))
+    for kind in bonded.term_classes:
+        assert np.isclose(e_kj[kind], e_kcal[kind] * bonded.kcal2kj)
+        assert np.allclose(frames[kind], e_kj[kind])
+
+def _peptide():
+    # the ADLK peptide with the CHARMM27 parameters and its coordinates (A)
+    name = os.path.join(systems_dir, 'peptide', 'p4_ADLK_autopsf')
+    pep = psf.PSFSystem(name + '.psf')
+    pep.add_pdbfile(name + '.pdb', pep.molecules[0])
+    par = charmmpar.CharmmPar(os.path.join(systems_dir, 'par', 'par_all27_prot_lipid.prm'))
+    par.add_params_to_system(pep)
+    return pep, bonded.psf_coords(pep)
+
+def test_psf_terms(tmpdir, monkeypatch):
+    pep, x = _peptide()
+    terms = bonded.terms_from_psf(pep)
+    assert [len(getattr(terms, kind)['indices']) for kind in bonded.term_classes] == [65, 120, 171, 8]
+    e = terms.energies(x)
+
+    # bonds one by one, CHARMM has no 1/2 in the harmonic terms
+    bondtypes = dict(((t.atype1, t.atype2), t) for t in pep.bondtypes)
+    ref = 0.0
+    for b in pep.molecules[0].bonds:
+        key = (b.atom1.get_atomtype(), b.atom2.get_atomtype())
+        t = bondtypes.get(key) or bondtypes[key[::-1]]
+        r = np.linalg.norm(np.array(b.atom1.coords[0]) - b.atom2.coords[0])
+        ref += t.charmm['param']['kb'] * (r - t.charmm['param']['b0'])**2
+    assert abs(e['bonds'] - ref) < 1e-9 * ref
+
+    # the same system through a gromacs topology
+    monkeypatch.chdir(tmpdir)
+    grotop.SystemToGroTop(pep)
+    gmx = bonded.terms_from_grotop(grotop.GroTop('top.top'))
+    e_gmx = gmx.energies(x / 10.0, units='kcal/mol')
+    for kind in bonded.term_classes:
+        assert abs(e[kind] - e_gmx[kind]) < 1e-9 * max(1.0, abs(e[kind]))
+
+    report = forces.compare_forces(terms, gmx, x)
+    assert all(r['max_error'] < 1e-9 * max(1.0, r['max_force']) for r in report.values())
+
+def test_forces():
+    terms = bonded.terms_from_grotop(top)
+    x = coords * 0.5
+    report = forces.check_forces(terms, x, atoms=30)
+    assert sorted(report) == sorted(bonded.term_classes)
+    assert all(r['passed'] for r in report.values())
+
+    # the terms of one atom over the atoms of those terms only
+    sub, used = forces._select_terms(terms, [3])
+    a = np.searchsorted(used, 3)
+    for kind in bonded.term_classes:
+        full = getattr(terms, kind)['indices']
+        assert len(getattr(sub, kind)['indices']) == (full == 3).any(axis=1).sum()
+        assert (getattr(sub, kind)['indices'] == a).any(axis=1).all()
+    assert np.allclose(forces.forces(sub, x[used])['angles'][a], forces.forces(terms, x)['angles'][3])
+
+    # no net force from the internal coordinates
+    f = forces.forces(terms, x)
+    assert np.allclose(sum(f.values()).sum(axis=0), 0.0, atol=1e-6)
+
+    # a gromacs system against itself, in kcal/mol/A
+    assert all(r['max_error'] == 0 for r in forces.compare_forces(terms, terms, x * 10).values())
+
+def _nonbonded_reference(mol, x, cutoff, rule=2):
+    # LJ and Coulomb of all the pairs but the bonds, angles and 1-4 pairs, one by one
+    excluded = set(map(tuple, np.sort(np.concatenate(
+        [mol.bonds.indices, mol.angles.indices[:, [0, 2]], mol.pairs.indices]), axis=1).tolist()))
+    eps = dict((at.atype, at.gromacs['param']['lje']) for at in top.atomtypes)
+    sig = dict((at.atype, at.gromacs['param']['ljl']) for at in top.atomtypes)
+    lj = coul = 0.0
+    for i in range(len(x)):
+        for j in range(i+1, len(x)):
+            r = np.linalg.norm(x[i] - x[j])
+            if (i, j) in excluded or r >= cutoff:
+                continue
+            a, b = mol.atoms[i], mol.atoms[j]
+            e_ij = np.sqrt(eps[a.atomtype] * eps[b.atomtype])
+            if rule == 2:
+                s_ij = 0.5 * (sig[a.atomtype] + sig[b.atomtype])
+            else:
+                s_ij = np.sqrt(sig[a.atomtype] * sig[b.atomtype])
+            lj += 4 * e_ij * ((s_ij / r)**12 - (s_ij / r)**6)
+            coul += 138.935458 * a.charge * b.charge / r
+    return lj, coul
+
+def test_nonbonded():
+    ad = top.dict_molname_mol['AD']
+    nb = nonbonded.NonbondedTerms(ad, top.atomtypes, top.pairtypes, defaults=top.defaults)
+    assert nb.scale14 == top.defaults['fudgeQQ']
+    x = coords[:25] * 0.4
+    e = nb.energies(x, cutoff=0.9)
+    lj, coul = _nonbonded_reference(ad, x, 0.9)
+    assert np.isclose(e['lj'], lj)
+    assert np.isclose(e['coulomb'], coul)
+
+    # the excluded pairs are never evaluated, also two bonded atoms at the same place
+    for i, j in ad.bonds.indices[:3]:
+        y = x.copy()
+        for r in (0.0, 0.01):
+            y[j] = x[i] + r
+            e = nb.energies(y, cutoff=0.9)
+            lj, coul = _nonbonded_reference(ad, y, 0.9)
+            assert np.isclose(e['lj'], lj) and np.isclose(e['coulomb'], coul)
+            e = nb.energies(y, cutoff=0.9, shift=True)
+            assert np.isfinite(e['lj']) and np.isfinite(e['coulomb'])
+
+    # nrexcl 3 excludes the same pairs in a molecule without rings
+    nb3 = nonbonded.NonbondedTerms(ad, top.atomtypes, top.pairtypes, defaults=top.defaults, nrexcl=3)
+    assert np.array_equal(nb3.excluded, nb.excluded)
+    nb1 = nonbonded.NonbondedTerms(ad, top.atomtypes, top.pairtypes, nrexcl=1)
+    assert len(nb1.excluded) < len(nb.excluded)
+
+def test_nonbonded_comb_rules():
+    ad = top.dict_molname_mol['AD']
+    x = coords[:25] * 0.4
+    nb3 = nonbonded.NonbondedTerms(ad, top.atomtypes, defaults=dict(top.defaults, **{'comb-rule': 3}))
+    lj, coul = _nonbonded_reference(ad, x, 0.9, rule=3)
+    e3 = nb3.energies(x, cutoff=0.9)
+    assert np.isclose(e3['lj'], lj)
+    assert not np.isclose(e3['lj'], _nonbonded_reference(ad, x, 0.9)[0])
+
+    # rule 1 with C6 = 4 eps sig^6 and C12 = 4 eps sig^12 is the same as rule 3
+    c6c12 = copy.deepcopy(top.atomtypes)
+    for at in c6c12:
+        e, s = at.gromacs['param']['lje'], at.gromacs['param']['ljl']
+        at.gromacs['param']['lje'], at.gromacs['param']['ljl'] = 4 * e * s**12, 4 * e * s**6
+    nb1 = nonbonded.NonbondedTerms(ad, c6c12, defaults=dict(top.defaults, **{'comb-rule': 1}))
+    e1 = nb1.energies(x, cutoff=0.9)
+    for kind in ('lj', 'coulomb', 'lj14', 'coulomb14'):
+        assert np.isclose(e1[kind], e3[kind])
+
+    for defaults in ({'comb-rule': 4}, {'comb-rule': 2, 'gen-pairs': 'no'}):
+        try:
+            nonbonded.NonbondedTerms(ad, top.atomtypes, defaults=defaults)
+            assert False
+        except ValueError:
+            pass
+
+def test_neighbor_pairs():
+    x = rng.uniform(0, 5.0, (2000, 3))
+    found = set()
+    for i, j, r2 in nonbonded.neighbor_pairs(x, 0.8):
+        found.update(zip(np.minimum(i, j).tolist(), np.maximum(i, j).tolist()))
+
+    d = np.sqrt(((x[:, None, :] - x[None, :, :])**2).sum(axis=2))
+    i, j = np.nonzero(np.triu(d < 0.8, 1))
+    assert found == set(zip(i.tolist(), j.tolist()))
+
+def test_cmap_interpolation():
+    phi = np.radians(np.arange(-180, 180, 15.0))
+    P, Q = np.meshgrid(phi, phi, indexing='ij')
+    f = lambda p, q: np.cos(p) + 0.5 * np.sin(2 * q) + 0.3 * np.cos(p - q)
+
+    coeffs = cmap.cmap_coefficients(f(P, Q).ravel())
+    assert cmap.cmap_coefficients(f(P, Q)) is coeffs        # cached
+    assert np.allclose(cmap.cmap_energies(P, Q, coeffs), f(P, Q))
+
+    p, q = rng.uniform(-np.pi, np.pi, (2, 500))
+    assert np.allclose(cmap.cmap_energies(p, q, coeffs), f(p, q), atol=1e-3)
+
+def test_cmap_forces():
+    pep, x = _peptide()
+    terms = cmap.CMapTerms(pep)
+    assert len(terms.indices) == 2
+
+    for frame in (x, x + np.random.RandomState(3).normal(0, 0.3, x.shape)):
+        report = forces.check_forces(terms, frame, atoms=terms.indices.ravel())
+        assert list(report) == ['cmaps'] and report['cmaps']['passed']
+        assert report['cmaps']['max_force'] > 0.1
+
+        f = forces.forces(terms, frame)['cmaps']
+        assert np.allclose(f.sum(axis=0), 0.0, atol=1e-10)
+        # only the atoms of the cross-terms
+        assert not np.any(np.delete(f, terms.indices.ravel(), axis=0))
+
+def test_rescore():
+    pdb = PDBSystem(os.path.join(data_dir, '..', 'pdb', '2M0Z.pdb'))
+    batches = list(rescore.pdb_frames(pdb, batch_size=8))
+    assert [len(b) for b in batches] == [8, 8, 4]
+    assert np.allclose(batches[1][0, 0], pdb.atoms[0].coords[8])
+
+    # the frames in A, the terms in nm
+    terms = [bonded.terms_from_grotop(top)]
+    frames = [coords[None] * 10 + k for k in range(5)]
+    table = rescore.rescore(iter(frames), terms, units='kJ/mol', workers=2)
+    assert np.all(table['frame'] == np.arange(5))
+    e = terms[0].energies(coords)
+    for kind in bonded.term_classes:
+        assert np.allclose(table[kind], e[kind])
+    assert np.allclose(table['total'], sum(e.values()))
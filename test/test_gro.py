@@ -0,0 +1,37 @@
+import numpy as np
+from pytopol.parsers import gro
+
+
+def _text(chars):
+    return [r.tobytes().decode('ascii') for r in chars]
+
+def test_format_fixed():
+    rng = np.random.RandomState(5)
+    values = np.concatenate([rng.uniform(-999, 9999, 2000),
+                             np.round(rng.uniform(-999, 999, 2000), 3) / 10,
+                             [0.0, -0.0004, 0.0005, 9999.999, -999.999]])
+    assert _text(gro.format_fixed(values, 8, 3)) == ['%8.3f' % x for x in values]
+    assert _text(gro.format_fixed([0, 7, 99999, -42], 5)) == ['%5d' % x for x in [0, 7, 99999, -42]]
+
+    try:
+        gro.format_fixed([10000.0], 8, 3)
+        assert False
+    except ValueError:
+        pass
+
+def test_write_gro(tmpdir):
+    coords = np.array([[0.1234, -1.5, 2.0], [10.0, 0.0, -0.25]])
+    fname = str(tmpdir.join('conf.gro'))
+    gro.write_gro(fname, coords, [1, 100001], ['TIP3', 'LONGNAME'], ['OH2', 'H1'], [3, 3, 3],
+                  title='test', chunk_size=1)
+    lines = open(fname).read().splitlines()
+    assert lines[:2] == ['test', '    2']
+    assert lines[2] == '    1TIP3   OH2    1   0.123  -1.500   2.000'
+    assert lines[3] == '    1LONGN   H1    2  10.000   0.000  -0.250'
+    assert lines[4] == '   3.00000   3.00000   3.00000'
+
+def test_box_vectors():
+    assert np.allclose(gro.box_vectors([30, 40, 50, 90, 90, 90]), [3, 4, 5])
+    # a rhombic dodecahedron (xy-square), as written by gmx
+    box = gro.box_vectors([50, 50, 50, 60, 60, 90])
+    assert np.allclose(box, [5, 5, 5 * np.sqrt(0.5), 0, 0, 0, 0, 2.5, 2.5])
@@ -0,0 +1,191 @@
+
+import os
+import numpy as np
+from pytopol.parsers import blocks, grotop, cpp, par
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'top')
+
+top = grotop.GroTop(os.path.join(data_dir, 'ad_wat.top'))
+
+
+def test_moleculetypes():
+    assert sorted(top.dict_molname_mol.keys()) == ['AD', 'SOL']
+    assert len(top.dict_molname_mol['AD'].atoms) == 25
+    assert len(top.dict_molname_mol['AD'].bonds) == 24
+
+def test_molecule_blocks():
+    ad  = top.dict_molname_mol['AD']
+    sol = top.dict_molname_mol['SOL']
+
+    # consecutive SOL lines are merged into one block
+    assert [(m.name, n) for m, n in top.molecules.iter_blocks()] == [('AD', 1), ('SOL', 1000), ('AD', 2)]
+    assert len(top.molecules) == 1003
+    assert top.molecules[0] is ad
+    assert top.molecules[500] is sol
+    assert top.molecules[-1] is ad
+    assert len(list(top.molecules)) == 1003
+
+    # indexing by the cumulative counts of many blocks
+    mols = [blocks.Molecule() for k in range(3)]
+    many = blocks.MoleculeBlocks()
+    expanded = []
+    for k in range(300):
+        many.add(mols[k % 3], k % 4)
+        expanded += [mols[k % 3]] * (k % 4)
+    many.add(mols[2], 2)
+    expanded += [mols[2]] * 2
+    assert len(many) == len(expanded)
+    assert all(many[i] is m for i, m in enumerate(expanded))
+    assert many[-1] is mols[2] and many[-len(expanded)] is expanded[0]
+    assert many[10:200:7] == tuple(expanded[10:200:7])
+    for i in (len(expanded), -len(expanded) - 1):
+        try:
+            many[i]
+            assert False
+        except IndexError:
+            pass
+
+def test_molecule_totals():
+    assert top.molecules.total('atoms') == 3 * 25 + 1000 * 3
+    assert top.molecules.total('bonds') == 3 * 24
+    offsets = [off for m, off in top.molecules.iter_offsets()]
+    assert offsets[:3] == [0, 25, 28]
+
+def test_preprocessor():
+    cpp.Preprocessor.clear_cache()
+    inc = grotop.GroTop(os.path.join(data_dir, 'ad_wat_inc.top'), include_dirs=[os.path.join(data_dir, 'ff')])
+    assert str(inc) == str(top)
+    assert inc.bondtypes[0].gromacs == top.bondtypes[0].gromacs   # from the gb_1 macro
+    assert len(inc.dict_molname_mol['SOL'].settles) == 1
+    assert len(cpp.Preprocessor.cache) == 5
+
+    flex = grotop.GroTop(os.path.join(data_dir, 'ad_wat_inc.top'), include_dirs=[os.path.join(data_dir, 'ff')],
+                         defines={'FLEXIBLE': ''})
+    assert len(flex.dict_molname_mol['SOL'].settles) == 0
+    assert len(flex.dict_molname_mol['SOL'].bonds) == 2
+    # the included files were read from the cache
+    assert len(cpp.Preprocessor.cache) == 5
+
+def test_section_cache():
+    grotop.GroTop.clear_cache()
+    args = (os.path.join(data_dir, 'ad_wat_inc.top'),)
+    kwargs = {'include_dirs': [os.path.join(data_dir, 'ff')]}
+    first = grotop.GroTop(*args, **kwargs)
+    ncached = len(grotop.GroTop.section_cache)
+    assert ncached > 0
+
+    # the force field types are parsed once, each topology gets its own copies
+    second = grotop.GroTop(*args, **kwargs)
+    assert len(grotop.GroTop.section_cache) == ncached
+    assert second.bondtypes[0] is not first.bondtypes[0]
+    assert second.bondtypes[0].gromacs == first.bondtypes[0].gromacs
+    assert second.dihedraltypes[0].gromacs == first.dihedraltypes[0].gromacs
+    assert len(second.dihedraltypes) == len(first.dihedraltypes)
+    assert len(second.impropertypes) == len(first.impropertypes)
+    assert str(second) == str(first)
+
+    # editing the types of one topology doesn't change the others
+    first.bondtypes[0].gromacs['param']['b0'] = 1.0
+    first.dihedraltypes[0].gromacs['param'][0]['kchi'] = 1.0
+    third = grotop.GroTop(*args, **kwargs)
+    assert third.bondtypes[0].gromacs == second.bondtypes[0].gromacs
+    assert third.dihedraltypes[0].gromacs == second.dihedraltypes[0].gromacs
+
+    # other defines give other lines for the sections
+    flex = grotop.GroTop(*args, defines={'FLEXIBLE': ''}, **kwargs)
+    assert flex.bondtypes[0].gromacs == second.bondtypes[0].gromacs
+
+    # the least recently used sections are dropped
+    size = grotop.GroTop.section_cache_size
+    try:
+        grotop.GroTop.section_cache_size = 2
+        grotop.GroTop.clear_cache()
+        grotop.GroTop(*args, **kwargs)
+        assert len(grotop.GroTop.section_cache) == 2
+    finally:
+        grotop.GroTop.section_cache_size = size
+        grotop.GroTop.clear_cache()
+
+def test_include_spacing(tmpdir):
+    # '# include' with spaces after the '#' is a valid directive
+    text = open(os.path.join(data_dir, 'ad_wat_inc.top')).read()
+    text = text.replace('#include "ff/', '# include "').replace('#include <', '#  include <')
+    assert '# include "forcefield.itp"' in text
+    fname = str(tmpdir.join('spaced.top'))
+    with open(fname, 'w') as f:
+        f.write(text)
+
+    spaced = grotop.GroTop(fname, include_dirs=[data_dir, os.path.join(data_dir, 'ff')])
+    assert str(spaced) == str(top)
+
+def test_term_arrays():
+    ad = top.dict_molname_mol['AD']
+    assert ad.bonds.indices.shape == (24, 2)
+    assert ad.angles.func.tolist() == [5] * 42
+    assert set(ad.dihedrals.func.tolist()) == set([9])
+    assert set(ad.impropers.func.tolist()) == set([2])
+
+    b = ad.bonds[3]
+    assert b is ad.bonds[3]
+    assert b.atom1 is ad.atoms[ad.bonds.indices[3, 0]]
+    assert b.gromacs['func'] == 1
+
+def test_lazy():
+    lazy = grotop.GroTop(os.path.join(data_dir, 'ad_wat.top'), lazy=True)
+    ad = lazy.dict_molname_mol['AD']
+    assert 'bonds' in ad._pending and 'atoms' in ad._pending
+
+    assert len(ad.atoms) == 25
+    assert 'atoms' not in ad._pending and 'bonds' in ad._pending
+    assert lazy.molecules.total('atoms') == top.molecules.total('atoms')
+
+    assert ad.bonds.indices.tolist() == top.dict_molname_mol['AD'].bonds.indices.tolist()
+    assert len(lazy.bondtypes) == len(top.bondtypes)
+    assert str(lazy) == str(top)
+
+def test_parameters():
+    ad = top.dict_molname_mol['AD']
+    dih = top.get_parameters(ad, 'dihedrals')
+    assert len(np.unique(dih['term'])) == 55
+    assert len(dih['term']) == 56      # CT1-C-NH1-CT1 has two terms
+    assert dih['params'].shape == (56, 3)
+    assert not np.any(np.isnan(dih['params']))
+    assert top.get_parameters(ad, 'dihedrals') is dih
+
+    bonds = top.get_parameters(ad, 'bonds')
+    assert np.all(bonds['term'] == np.arange(24))
+    assert np.allclose(bonds['params'][0], (0.148, 167360.0))
+
+def test_parameter_wildcards():
+    index = par.GroParType('dihedraltypes', 4, wildcards=True, reversible=(9,), multi=(9,))
+    index.add_parameter(('X', 'CT1', 'C', 'X'), 9, (0.0, 1.0, 3))
+    index.add_parameter(('X', 'CT1', 'C', 'O'), 9, (0.0, 2.0, 1))
+    index.add_parameter(('X', 'CT1', 'C', 'O'), 9, (180.0, 3.0, 2))
+    index.add_parameter(('O', 'C', 'CT1', 'X'), 2, (0.0, 4.0))
+
+    assert index.get_parameter(('HB', 'CT1', 'C', 'NH1'), 9) == [(0.0, 1.0, 3)]
+    assert index.get_parameter(('O', 'C', 'CT1', 'HB'), 9) == [(0.0, 2.0, 1), (180.0, 3.0, 2)]
+    assert index.get_parameter(('O', 'C', 'CT1', 'HB'), 2) == [(0.0, 4.0)]
+    assert index.get_parameter(('HB', 'CT1', 'C', 'O'), 2) == []
+
+    # only consecutive lines are merged, a key that comes again replaces the terms
+    index.add_parameter(('X', 'CT1', 'C', 'O'), 9, (0.0, 5.0, 3))
+    index.add_parameter(('X', 'CT1', 'C', 'O'), 9, (0.0, 6.0, 4))
+    assert index.get_parameter(('O', 'C', 'CT1', 'HB'), 9) == [(0.0, 5.0, 3), (0.0, 6.0, 4)]
+    index.add_parameter(('X', 'CT1', 'C', 'X'), 9, (0.0, 1.0, 3))
+    assert index.get_parameter(('HB', 'CT1', 'C', 'NH1'), 9) == [(0.0, 1.0, 3)]
+
+def test_atoms_section(tmpdir):
+    fname = str(tmpdir.join('mixed.top'))
+    with open(fname, 'w') as f:
+        f.write('[ moleculetype ]\nM  3\n[ atoms ] ; comment\n')
+        f.write('  1  OT  1  TIP3  OH2  1  -0.834  15.9994 ; with mass\n')
+        f.write('  2  HT  1  TIP3  H1   2   0.417\n')
+    mol = grotop.GroTop(fname).dict_molname_mol['M']
+    assert [a.name for a in mol.atoms] == ['OH2', 'H1']
+    assert mol.atoms[0].mass == 15.9994 and not hasattr(mol.atoms[1], 'mass')
+
+    ad = top.dict_molname_mol['AD']
+    assert [(a.number, a.resnumb) for a in ad.atoms[:2]] == [(1, 2), (2, 2)]
+    assert abs(sum(a.charge for a in ad.atoms) + 1.0) < 1e-6
+    assert all(isinstance(a.mass, float) for a in ad.atoms)
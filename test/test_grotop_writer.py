@@ -0,0 +1,193 @@
+import os
+import math
+import numpy as np
+from pytopol.parsers import blocks, psf, grotop, utils
+from pytopol.parsers.pdb import PDBSystem
+from pytopol.parsers.dcd import write_dcd
+
+systems_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'systems')
+
+
+def _writer(system, constraints=None, nrexcl=3, exclusions=None):
+    # a SystemToGroTop that has not written anything yet
+    w = object.__new__(grotop.SystemToGroTop)
+    w.lgr = grotop.logging.getLogger('mainapp.grotop.SystemToGroTop')
+    w.system = system
+    w.hmr_mass = None
+    w.constraints = constraints
+    w.nrexcl = nrexcl
+    w.exclusions = exclusions
+    return w
+
+def _bondtype(at1, at2, b0, kb=250000.0):
+    bt = blocks.BondType('gromacs')
+    bt.atype1, bt.atype2 = at1, at2
+    bt.gromacs['param']['b0'] = b0
+    bt.gromacs['param']['kb'] = kb
+    bt.gromacs['func'] = 1
+    return bt
+
+def _angletype(at1, at2, at3, tetha0, ktetha=300.0):
+    at = blocks.AngleType('gromacs')
+    at.atype1, at.atype2, at.atype3 = at1, at2, at3
+    at.gromacs['param'].update({'tetha0': tetha0, 'ktetha': ktetha, 'kub': 0.0, 's0': 0.0})
+    at.gromacs['func'] = 5
+    return at
+
+def _water_system():
+    wat = psf.PSFSystem(os.path.join(systems_dir, 'other', 'wat_autopsf.psf'))
+    wat.bondtypes = [_bondtype('OT', 'HT', 0.09572)]
+    wat.angletypes = [_angletype('HT', 'OT', 'HT', 104.52)]
+    return wat
+
+
+def test_find_constraints_selection():
+    pep = psf.PSFSystem(os.path.join(systems_dir, 'peptide', 'p4_ADLK_autopsf.psf'))
+    m = pep.molecules[0]
+    bonds = utils.build_index_array(m, 'bonds')
+    hydrogen = utils.is_hydrogen([a.mass for a in m.atoms])
+
+    constrained, waters = _writer(pep)._find_constraints(m)
+    assert not constrained.any() and waters == []
+
+    constrained, waters = _writer(pep, 'h-bonds')._find_constraints(m)
+    assert constrained.tolist() == hydrogen[bonds].any(axis=1).tolist()
+    assert 0 < constrained.sum() < len(bonds)
+    assert waters == []
+
+    constrained, waters = _writer(pep, 'all-bonds')._find_constraints(m)
+    assert constrained.all() and waters == []
+
+def test_find_constraints_waters():
+    wat = _water_system()
+    m = wat.molecules[0]
+    w = _writer(wat, 'all-bonds')
+    constrained, waters = w._find_constraints(m)
+
+    tip3 = [r for r in m.residues if r.name == 'TIP3']
+    assert len(waters) == len(tip3) == 1244
+    assert [a.name for a in waters[0]] == ['OH2', 'H1', 'H2']
+    # all the bonds are in the settled waters
+    assert not constrained.any()
+
+    settled = set(a for wt in waters for a in wt)
+    assert w._make_bonds(m, constrained, settled) == [';     0 bonds\n']
+    assert w._make_angles(m, settled) == [';     0 angles\n']
+    assert len(w._make_angles(m)) == len(m.angles) + 1
+
+def test_make_constraints_settles():
+    pep = psf.PSFSystem(os.path.join(systems_dir, 'peptide', 'p4_ADLK_autopsf.psf'))
+    m = pep.molecules[0]
+    pairs = set(tuple(sorted((b.atom1.get_atomtype(), b.atom2.get_atomtype()))) for b in m.bonds)
+    pep.bondtypes = [_bondtype(at1, at2, 0.1 + 0.001 * i) for i, (at1, at2) in enumerate(sorted(pairs))]
+    b0 = dict(((bt.atype1, bt.atype2), bt.gromacs['param']['b0']) for bt in pep.bondtypes)
+
+    w = _writer(pep, 'h-bonds')
+    constrained, waters = w._find_constraints(m)
+    lines = w._make_constraints(m, constrained)
+    assert lines[0] == '; %5d constraints\n' % constrained.sum()
+    for line, i in zip(lines[1:], np.flatnonzero(constrained)):
+        bond = m.bonds[i]
+        key = tuple(sorted((bond.atom1.get_atomtype(), bond.atom2.get_atomtype())))
+        fields = line.split()
+        assert [int(x) for x in fields[:3]] == [bond.atom1.number, bond.atom2.number, 1]
+        assert abs(float(fields[3]) - b0[key]) < 1e-5
+
+    wat = _water_system()
+    w = _writer(wat, 'h-bonds')
+    constrained, waters = w._find_constraints(wat.molecules[0])
+    lines = w._make_settles(waters)
+    assert len(lines) == 1245
+    fields = lines[1].split()
+    assert [int(x) for x in fields[:2]] == [waters[0][0].number, 1]
+    dhh = 2 * 0.09572 * math.sin(math.radians(104.52) / 2.0)
+    assert abs(float(fields[2]) - 0.09572) < 1e-5
+    assert abs(float(fields[3]) - dhh) < 1e-5
+
+    # without a H-H bond or H-O-H angle type there is no dHH
+    wat.angletypes = []
+    try:
+        _writer(wat, 'h-bonds')._make_settles(waters)
+        assert False
+    except ValueError:
+        pass
+
+def _gro_atoms(lines):
+    # (resnumb, resname, name, number) of the atom lines of a gro file
+    return [(int(l[:5]), l[5:10].strip(), l[10:15].strip(), int(l[15:20])) for l in lines[2:-1]]
+
+def test_write_gro(tmpdir, monkeypatch):
+    name = os.path.join(systems_dir, 'other', 'wat_autopsf')
+    wat = _water_system()
+    atoms = wat.molecules[0].atoms
+    x = PDBSystem(name + '.pdb').coords[0]
+
+    # a rectangular and a triclinic cell (rhombic dodecahedron), in the dcd
+    # order A, gamma, B, beta, alpha, C
+    cells = np.array([[30.0, 90.0, 40.0, 90.0, 90.0, 50.0],
+                      [50.0, 90.0, 50.0, 60.0, 60.0, 50.0]])
+    fname = str(tmpdir.join('wat.dcd'))
+    write_dcd(fname, np.array([x, x + 1.0], dtype=np.float32), cells)
+    wat.add_dcdfile(fname, wat.molecules[0])
+    assert wat.cells.tolist() == [[30, 40, 50, 90, 90, 90], [50, 50, 50, 60, 60, 90]]
+
+    monkeypatch.chdir(tmpdir)
+    grotop.SystemToGroTop(wat, grofile='conf.gro')
+    lines = open('conf.gro').read().splitlines()
+    assert lines[1] == ' %4d' % len(atoms)
+    assert _gro_atoms(lines) == [(a.resnumb, a.resname, a.name, a.number) for a in atoms]
+    assert lines[2][:20] == '    5TIP3   OH2    1'
+    assert np.allclose([float(v) for v in lines[2][20:].split()], np.round(x[0] / 10, 3))
+    assert np.allclose([float(v) for v in lines[-1].split()], [3, 4, 5])
+
+    grotop.SystemToGroTop(wat, grofile='tric.gro', model=1)
+    lines = open('tric.gro').read().splitlines()
+    assert np.allclose([float(v) for v in lines[2][20:].split()], np.round(x[0] / 10 + 0.1, 3))
+    assert np.allclose([float(v) for v in lines[-1].split()], [5, 5, 5 * np.sqrt(0.5), 0, 0, 0, 0, 2.5, 2.5],
+                       atol=1e-5)
+
+    # no unit cells: the extent of the coordinates plus the padding
+    wat.cells = None
+    grotop.SystemToGroTop(wat, grofile='nobox.gro')
+    lines = open('nobox.gro').read().splitlines()
+    extent = (x.max(axis=0) - x.min(axis=0)) / 10
+    assert np.allclose([float(v) for v in lines[-1].split()], extent + 1.0, atol=1e-4)
+
+def test_moleculetype_exclusions(tmpdir, monkeypatch):
+    pep = psf.PSFSystem(os.path.join(systems_dir, 'peptide', 'p4_ADLK_autopsf.psf'))
+    m = pep.molecules[0]
+    assert _writer(pep, nrexcl=5)._make_moleculetype(m, 'mol_01') == ['; Name \t\t  nrexcl \n mol_01    5 \n']
+
+    # the atoms up to 3 bonds apart, from a plain breadth-first search
+    neighbors = dict((a, set()) for a in m.atoms)
+    for b in m.bonds:
+        neighbors[b.atom1].add(b.atom2)
+        neighbors[b.atom2].add(b.atom1)
+    expected = []
+    for a in m.atoms:
+        seen, shell = set([a]), set([a])
+        for k in range(3):
+            shell = set(n for s in shell for n in neighbors[s]) - seen
+            seen |= shell
+        later = sorted(x.number for x in seen if x.number > a.number)
+        if later:
+            expected.append([a.number] + later)
+
+    lines = _writer(pep, exclusions=3)._make_exclusions(m, [])
+    assert lines[0] == '; %5d exclusions\n' % len(expected)
+    assert [[int(x) for x in line.split()] for line in lines[1:]] == expected
+
+    # with settles, the explicit lists are followed by the lines of the waters
+    wat = _water_system()
+    w = _writer(wat, 'h-bonds', nrexcl=2, exclusions=2)
+    constrained, waters = w._find_constraints(wat.molecules[0])
+    lines = w._make_exclusions(wat.molecules[0], waters)
+    assert lines[0] == '; %5d exclusions\n' % (4 * 1244)
+    assert lines[1:3] == ['    1     2     3\n', '    2     3\n']
+    assert lines[2*1244 + 1:2*1244 + 3] == ['    1     2     3\n', '    2     3\n']
+
+    monkeypatch.chdir(tmpdir)
+    grotop.SystemToGroTop(wat, constraints='h-bonds', nrexcl=2, exclusions=2)
+    itp = open('itp_mol_01.itp').read()
+    assert '[ moleculetype ] \n; Name \t\t  nrexcl \n mol_01    2 \n' in itp
+    assert '[ exclusions ]   \n' + ''.join(lines) in itp
@@ -0,0 +1,53 @@
+import os
+import numpy as np
+from pytopol.parsers import psf
+from pytopol.parsers.pdb import PDBSystem
+from pytopol.parsers.namdbin import read_namdbin, write_namdbin
+
+systems_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'systems')
+
+
+def test_coor_and_vel(tmpdir):
+    name = os.path.join(systems_dir, 'peptide', 'p4_ADLK_autopsf')
+    coords = PDBSystem(name + '.pdb').coords[0]
+    coorfile = str(tmpdir.join('p4.coor'))
+    write_namdbin(coorfile, coords)
+    assert os.path.getsize(coorfile) == 4 + 24 * len(coords)
+
+    data = read_namdbin(coorfile, natoms=len(coords))
+    assert isinstance(data, np.memmap)
+    assert np.array_equal(data, coords)
+
+    # big-endian files are detected from the atom count
+    swapped = str(tmpdir.join('p4_be.coor'))
+    with open(swapped, 'wb') as f:
+        f.write(np.array([len(coords)], dtype='>i4').tobytes())
+        f.write(coords.astype('>f8').tobytes())
+    assert np.array_equal(read_namdbin(swapped), coords)
+
+    system = psf.PSFSystem(name + '.psf')
+    mol = system.molecules[0]
+    assert system.add_coorfile(coorfile, mol) is True
+    assert system.add_velfile(coorfile, mol) is True
+    assert system.coords.shape == (1, len(coords), 3)
+    assert np.shares_memory(mol.atoms[7].coords, system.coords)
+    assert np.array_equal(mol.atoms[7].coords[0], coords[7])
+    assert np.array_equal(mol.atoms[7].velocities, coords[7])
+
+    # the atoms don't match
+    short = str(tmpdir.join('short.coor'))
+    write_namdbin(short, coords[:-1])
+    assert system.add_coorfile(short, mol) is False
+    assert system.add_velfile(short, mol) is False
+    assert np.array_equal(mol.atoms[7].coords[0], coords[7])
+
+def test_wrong_size(tmpdir):
+    fname = str(tmpdir.join('bad.coor'))
+    write_namdbin(fname, np.zeros((10, 3)))
+    with open(fname, 'ab') as f:
+        f.write(b'\0' * 8)
+    try:
+        read_namdbin(fname)
+        assert False
+    except ValueError:
+        pass
@@ -0,0 +1,99 @@
+import os
+import numpy as np
+from pytopol.parsers import pdb, psf
+from pytopol.parsers.pdb import PDBSystem, PDBFrames
+
+pdb_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'pdb')
+systems_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'systems')
+
+
+def test_models_array():
+    pdb = PDBSystem(os.path.join(pdb_dir, '2M0Z.pdb'))
+    assert pdb.coords.shape == (20, 1468, 3)
+    assert pdb.coords.dtype == np.float64
+
+    # the atom coords are views of the system array
+    a = pdb.atoms[5]
+    assert a.coords.shape == (20, 3)
+    assert np.shares_memory(a.coords, pdb.coords)
+    pdb.coords[3, 5] = 0.0
+    assert np.all(a.coords[3] == 0.0)
+
+def test_guess_mols():
+    pdb = PDBSystem(os.path.join(pdb_dir, '2M0Z.pdb'), guess_mols=True)
+    # the protein and the crosslinker (HETATM 33B)
+    assert [(len(m.atoms), m.atoms[0].flag) for m in pdb.molecules] == [(1426, 'ATOM'), (42, 'HETATM')]
+    assert [r.name for r in pdb.molecules[1].residues] == ['33B']
+    assert pdb.molecules[1].atoms[0] is pdb.atoms[1426]
+    assert len(PDBSystem(os.path.join(pdb_dir, '2M0Z.pdb')).molecules) == 1
+
+def test_atom_residue():
+    pdb = PDBSystem(os.path.join(systems_dir, 'peptide', 'p2_AD_autopsf.pdb'))
+    # built on the first access of atom.residue
+    residue = pdb.atoms[0].residue
+    assert (residue.name, residue.number) == ('ALA', 2)
+    assert residue is pdb.molecules[0].residues[0]
+    assert pdb.atoms[-1].residue is pdb.molecules[0].residues[-1]
+
+    # altlocs is a list of its own, made on first access
+    atom = pdb.atoms[0]
+    assert 'altlocs' not in atom.__dict__
+    atom.altlocs.append(('B', (0.0, 0.0, 0.0), 0.5, 0.0))
+    assert len(atom.altlocs) == 1 and pdb.atoms[1].altlocs == []
+
+def test_single_model_float32():
+    pdb = PDBSystem(os.path.join(pdb_dir, 'popc.pdb'), dtype=np.float32)
+    assert pdb.coords.shape == (1, len(pdb.atoms), 3)
+    assert pdb.coords.dtype == np.float32
+    assert len(pdb.atoms[0].coords) == 1
+
+def test_lazy_frames():
+    fname = os.path.join(pdb_dir, '2M0Z.pdb')
+    pdb = PDBSystem(fname)
+    frames = PDBFrames(fname)
+    assert len(frames) == 20
+    assert frames.natoms == 1468
+
+    assert np.array_equal(frames[7], pdb.coords[7])
+    assert np.array_equal(frames[-1], pdb.coords[19])
+    assert np.array_equal(frames[2:15:6], pdb.coords[2:15:6])
+    assert np.array_equal(np.array(list(frames)), pdb.coords)
+    assert [len(b) for b in frames.batches(8)] == [8, 8, 4]
+
+    # no MODEL records: one frame
+    assert len(PDBFrames(os.path.join(pdb_dir, 'popc.pdb'))) == 1
+
+def test_atom_records():
+    buf = (b'REMARK short\r\n'
+           b'ATOM      1  N   ALA A   1      11.104   6.134  -6.504\r\n'
+           b'HETATM    2  O   HOH W   2      -1.500  10.000   0.250  1.00  0.00           O\r\n'
+           b'TER\r\n'
+           b'ENDMDL\r\n'
+           b'ATOM      1  N   ALA A   1       1.000   2.000   3.000\r\n'
+           b'HETATM    2  O   HOH W   2       4.000   5.000   6.000')
+    records, sizes = pdb.read_atom_records(buf)
+    assert sizes == [2, 2]
+    assert np.char.strip(records['flag']).tolist() == [b'ATOM', b'HETATM'] * 2
+    assert records['name'][1].strip() == b'O'
+    assert records['resnumb'].astype(int).tolist() == [1, 2, 1, 2]
+    assert np.allclose(pdb.record_coords(records)[:2], [[11.104, 6.134, -6.504], [-1.5, 10.0, 0.25]])
+    assert np.allclose(pdb.record_coords(records)[3], [4, 5, 6])
+
+def test_add_pdbfile(tmpdir):
+    name = os.path.join(systems_dir, 'peptide', 'p4_ADLK_autopsf')
+    system = psf.PSFSystem(name + '.psf')
+    mol = system.molecules[0]
+    assert system.add_pdbfile(name + '.pdb', mol)
+    assert np.array_equal(system.coords, PDBSystem(name + '.pdb').coords)
+    assert np.shares_memory(mol.atoms[10].coords, system.coords)
+
+    # two atoms swapped
+    lines = open(name + '.pdb').read().splitlines(True)
+    rows = [i for i, l in enumerate(lines) if l.startswith('ATOM')]
+    lines[rows[3]], lines[rows[4]] = lines[rows[4]], lines[rows[3]]
+    swapped = str(tmpdir.join('swapped.pdb'))
+    open(swapped, 'w').write(''.join(lines))
+
+    system = psf.PSFSystem(name + '.psf')
+    assert not system.add_pdbfile(swapped, system.molecules[0])
+    assert system.add_pdbfile(swapped, system.molecules[0], check_names=False)
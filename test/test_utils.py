@@ -0,0 +1,254 @@
+
+import os
+import numpy as np
+from pytopol.parsers import blocks, psf, utils
+
+systems_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'systems')
+
+popc = psf.PSFSystem(os.path.join(systems_dir, 'membrane', 'popc_autopsf.psf'))
+popc_mol = popc.molecules[0]
+
+
+def test_build_index_array():
+    bonds = utils.build_index_array(popc_mol, 'bonds')
+    assert bonds.shape == (len(popc_mol.bonds), 2)
+    b = popc_mol.bonds[10]
+    assert popc_mol.atoms[bonds[10, 0]] is b.atom1
+    assert popc_mol.atoms[bonds[10, 1]] is b.atom2
+
+def test_hmr_keeps_total_mass():
+    masses, before, after = utils.repartition_hydrogen_mass(popc_mol, 3.024)
+    assert abs(before - after) < 1e-6
+    hydrogen = utils.is_hydrogen([a.mass for a in popc_mol.atoms])
+    assert np.allclose(masses[hydrogen], 3.024)
+    assert np.all(masses > 0)
+
+def test_bond_graph_terms():
+    mol = psf.PSFSystem(os.path.join(systems_dir, 'membrane', 'popc_autopsf.psf')).molecules[0]
+    natoms = len(mol.atoms)
+    bonds = utils.build_index_array(mol, 'bonds')
+
+    offsets, neighbors = utils.bond_graph(bonds, natoms)
+    assert offsets[-1] == 2 * len(bonds)
+    assert neighbors[offsets[0]:offsets[1]].tolist() == sorted(set(
+        j for b in bonds.tolist() for i, j in (b, b[::-1]) if i == 0))
+
+    def _canonical(rows):
+        return set(min(tuple(r), tuple(r[::-1])) for r in rows.tolist())
+
+    angles = utils.graph_angles(offsets, neighbors)
+    dihedrals = utils.graph_dihedrals(offsets, neighbors)
+    assert _canonical(angles) == _canonical(utils.build_index_array(mol, 'angles'))
+    assert _canonical(dihedrals) == _canonical(utils.build_index_array(mol, 'dihedrals'))
+    assert len(_canonical(dihedrals)) == len(dihedrals)
+
+    pairs = utils.pairs_14(dihedrals, bonds, angles, natoms)
+    assert np.all(pairs[:, 0] < pairs[:, 1])
+    assert _canonical(pairs) == set((min(d[0], d[3]), max(d[0], d[3])) for d in dihedrals.tolist())
+
+    # the explicit terms of the psf are kept, unless forced
+    explicit = (len(mol.angles), len(mol.dihedrals), len(mol.pairs))
+    dihedral = mol.dihedrals[0]
+    assert utils.generate_terms(mol) == explicit
+    assert mol.dihedrals[0] is dihedral
+
+    mol.angles, mol.dihedrals, mol.pairs = [], [], []
+    assert utils.generate_terms(mol) == (len(angles), len(dihedrals), len(pairs))
+    assert mol.dihedrals[0].atom2 is mol.atoms[dihedrals[0, 1]]
+    assert mol.dihedrals.format == mol.bonds[0].format == 'charmm'
+    assert np.all(mol.pairs.func == 1)
+
+    mol.dihedrals = [dihedral]
+    assert utils.generate_terms(mol, format='gromacs', force=True) == (len(angles), len(dihedrals), len(pairs))
+    assert mol.pairs.format == 'gromacs'
+
+def test_bond_graph_ring():
+    # cyclopentane carbons: the 1-4 pairs of a 5-ring are its 1-3 pairs
+    ring = np.array([[i, (i+1) % 5] for i in range(5)])
+    offsets, neighbors = utils.bond_graph(np.vstack([ring, ring[:, ::-1]]), 5)
+    assert np.diff(offsets).tolist() == [2] * 5
+    angles = utils.graph_angles(offsets, neighbors)
+    dihedrals = utils.graph_dihedrals(offsets, neighbors)
+    assert (len(angles), len(dihedrals)) == (5, 5)
+    assert len(utils.pairs_14(dihedrals, ring, angles, 5)) == 0
+
+def test_build_pairs():
+    # the dihedral ends minus the bonded and angle ends, as the old set-based loop did
+    close = set(frozenset((t.atom1, t.atom2)) for t in popc_mol.bonds)
+    close |= set(frozenset((t.atom1, t.atom3)) for t in popc_mol.angles)
+    expected = set(frozenset((d.atom1, d.atom4)) for d in popc_mol.dihedrals) - close
+
+    pairs = utils.build_pairs(popc_mol, None)
+    assert set(frozenset((popc_mol.atoms[i], popc_mol.atoms[j])) for i, j in pairs.tolist()) == expected
+    assert len(pairs) == len(popc_mol.pairs) == len(expected)
+    assert popc_mol.pairs[0].atom1 is popc_mol.atoms[pairs[0, 0]]
+
+def test_build_res_chain():
+    m = blocks.Molecule()
+    for resname, resnumb, chain in [('ALA', 1, 'A')] * 3 + [('GLY', 2, 'A')] * 2 + \
+                                   [('GLY', 2, 'B'), ('HOH', 1, 'W'), ('HOH', 1, 'W'), ('HOH', 2, 'W')]:
+        a = blocks.Atom()
+        a.resname, a.resnumb, a.chain = resname, resnumb, chain
+        m.atoms.append(a)
+
+    offsets, chain_offsets = utils.build_res_chain(m)
+    assert offsets.tolist() == [0, 3, 5, 6, 8, 9]
+    assert chain_offsets.tolist() == [0, 2, 3, 5]
+    assert m.residues.atom_residues().tolist() == [0, 0, 0, 1, 1, 2, 3, 3, 4]
+
+    # the objects are built on the first access
+    assert m.residues._objects is None
+    assert len(m.residues) == 5 and len(m.chains) == 3
+    assert [c.name for c in m.chains] == ['A', 'B', 'W']
+    assert m.residues[3].atoms == m.atoms[6:8]
+    assert m.atoms[4].residue.number == 2 and m.atoms[4].residue.chain is m.chains[0]
+
+    # atom.residue alone builds the residues, and follows a rebuild
+    fresh = psf.PSFSystem(os.path.join(systems_dir, 'membrane', 'popc_autopsf.psf')).molecules[0]
+    assert fresh.atoms[10].residue is fresh.residues[0]
+    old = fresh.atoms[10].residue
+    utils.build_res_chain(fresh)
+    assert fresh.atoms[10].residue is not old and fresh.atoms[10].residue is fresh.residues[0]
+    try:
+        blocks.Atom().residue
+        assert False
+    except AttributeError:
+        pass
+
+def test_exclusion_lists():
+    natoms = len(popc_mol.atoms)
+    bonds = utils.build_index_array(popc_mol, 'bonds')
+    angles = utils.build_index_array(popc_mol, 'angles')
+    dihedrals = utils.build_index_array(popc_mol, 'dihedrals')
+    offsets, neighbors = utils.bond_graph(bonds, natoms)
+
+    def _pairs(excl_offsets, excluded):
+        i = np.repeat(np.arange(natoms), np.diff(excl_offsets))
+        assert np.all(i < excluded)
+        return set(zip(i.tolist(), excluded.tolist()))
+
+    def _ends(a):
+        return set((min(x, y), max(x, y)) for x, y in a[:, [0, -1]].tolist())
+
+    assert _pairs(*utils.exclusion_lists(offsets, neighbors, 0)) == set()
+    assert _pairs(*utils.exclusion_lists(offsets, neighbors, 1)) == _ends(bonds)
+    assert _pairs(*utils.exclusion_lists(offsets, neighbors, 2)) == _ends(bonds) | _ends(angles)
+    excl3 = _pairs(*utils.exclusion_lists(offsets, neighbors, 3))
+    assert excl3 == _ends(bonds) | _ends(angles) | _ends(dihedrals)
+
+    # a 5-ring: all the atoms are within 2 bonds
+    ring = np.array([[i, (i+1) % 5] for i in range(5)])
+    excl_offsets, excluded = utils.exclusion_lists(*utils.bond_graph(ring, 5), nrexcl=3)
+    assert excl_offsets.tolist() == [0, 4, 7, 9, 10, 10]
+    assert excluded.tolist() == [1, 2, 3, 4, 2, 3, 4, 3, 4, 4]
+
+def test_build_exclusions():
+    mol = psf.PSFSystem(os.path.join(systems_dir, 'membrane', 'popc_autopsf.psf')).molecules[0]
+    excl_offsets, excluded = utils.build_exclusions(mol, 2)
+    assert sum(len(ex.other_atoms) for ex in mol.exclusions) == len(excluded)
+    ex = mol.exclusions[0]
+    assert ex.main_atom is mol.atoms[0]
+    assert [mol.atoms.index(a) for a in ex.other_atoms] == excluded[excl_offsets[0]:excl_offsets[1]].tolist()
+
+def test_connected_components():
+    bonds = np.array([[5, 6], [0, 2], [2, 1], [7, 9], [9, 8], [3, 4], [1, 0]])
+    assert utils.connected_components(bonds, 11).tolist() == [0, 0, 0, 1, 1, 2, 2, 3, 3, 3, 4]
+    chain = np.random.RandomState(3).permutation(np.stack([np.arange(999), np.arange(1, 1000)], axis=1))
+    assert np.all(utils.connected_components(chain, 1000) == 0)
+
+def test_split_connectivity():
+    # the waters and the ions are in one segment each
+    system = psf.PSFSystem(os.path.join(systems_dir, 'other', 'wat_autopsf.psf'))
+    natoms, nbonds = len(system.molecules[0].atoms), len(system.molecules[0].bonds)
+    assert system.split_psf(mode='connectivity') is None
+
+    assert len(system.molecules) == 1248
+    assert [(m.residues[0].name, n) for m, n in system.molecule_blocks.iter_blocks()] == [
+        ('TIP3', 1244), ('SOD', 2), ('CLA', 2)]
+    assert sum(len(m.atoms) for m in system.molecules) == natoms
+    assert sum(len(m.bonds) for m in system.molecules) == nbonds
+
+    water = system.molecules[100]
+    assert [a.number for a in water.atoms] == [1, 2, 3]
+    assert all(b.atom1 in water.atoms and b.atom2 in water.atoms for b in water.bonds)
+    assert water.residues[0].atoms[0].residue is water.residues[0] and water.chains[0].name == 'W1'
+
+def _interleaved_psf(fname, order):
+    # the water psf with the atoms in the given order (psf indices), renumbered
+    lines = open(os.path.join(systems_dir, 'other', 'wat_autopsf.psf')).read().splitlines()
+    start = [i for i, l in enumerate(lines) if '!NATOM' in l][0] + 1
+    natoms = int(lines[start - 1].split()[0])
+    number = dict((old + 1, new + 1) for new, old in enumerate(order))
+
+    result = lines[:start]
+    for i in order:
+        fields = lines[start + i].split(None, 1)
+        result.append('%8d %s' % (number[int(fields[0])], fields[1]))
+    section = ''
+    for line in lines[start + natoms:]:
+        if '!' in line:
+            section = line.split('!')[1]
+            result.append(line)
+        elif section.startswith(('NBOND', 'NTHETA')) and line.strip():
+            result.append(''.join('%8d' % number[int(v)] for v in line.split()))
+        else:
+            result.append(line)
+
+    with open(fname, 'w') as f:
+        f.write('\n'.join(result) + '\n')
+
+def test_split_interleaved(tmpdir):
+    # the ions between the oxygen and the hydrogens of the first water, and
+    # the atoms of the next two waters alternating
+    order = [0, 3732, 3733, 3734, 3735, 1, 2, 3, 6, 4, 7, 5, 8] + list(range(9, 3732))
+    fname = str(tmpdir.join('interleaved.psf'))
+    _interleaved_psf(fname, order)
+
+    ref = psf.PSFSystem(os.path.join(systems_dir, 'other', 'wat_autopsf.psf'))
+    ref.split_psf(mode='connectivity')
+    system = psf.PSFSystem(fname)
+    assert system.split_psf(mode='connectivity') is None
+
+    assert len(system.molecules) == 1248
+    assert [(m.residues[0].name, n) for m, n in system.molecule_blocks.iter_blocks()] == [
+        ('TIP3', 1), ('SOD', 2), ('CLA', 2), ('TIP3', 1243)]
+    first = system.molecules[0]
+    assert [a.name for a in first.atoms] == ['OH2', 'H1', 'H2']
+    assert all(b.atom1 in first.atoms and b.atom2 in first.atoms for b in first.bonds)
+
+    # the atoms in the order of the molecules, atom_order is their psf index
+    atoms = [a for m in system.molecules for a in m.atoms]
+    psf_atoms = psf.PSFSystem(fname).molecules[0].atoms
+    assert [(a.name, a.resnumb) for a in atoms] == [
+        (psf_atoms[i].name, psf_atoms[i].resnumb) for i in system.atom_order.tolist()]
+    assert [(a.name, a.resnumb) for a in atoms[:3] + atoms[7:]] == [
+        (a.name, a.resnumb) for m in ref.molecules for a in m.atoms if a.resname == 'TIP3']
+
+def test_topology_fingerprint():
+    name = os.path.join(systems_dir, 'other', 'wat_autopsf.psf')
+    fp = utils.topology_fingerprint(psf.PSFSystem(name).molecules[0])
+    assert len(fp) == 40 and fp == utils.topology_fingerprint(psf.PSFSystem(name).molecules[0])
+
+    # the molecules grouped by split_psf have the fingerprint of their group
+    system = psf.PSFSystem(name)
+    system.split_psf(mode='connectivity')
+    groups = [m for m, n in system.molecule_blocks.iter_blocks()]
+    assert utils.topology_fingerprint(system.molecules[500]) == utils.topology_fingerprint(groups[0])
+    assert utils.topology_fingerprint(system.molecules[-1]) == utils.topology_fingerprint(groups[2])
+    assert utils.topology_fingerprint(groups[1]) != utils.topology_fingerprint(groups[2])
+
+    # a System with all its molecules or with the blocks
+    grouped = blocks.System()
+    grouped.molecules = system.molecule_blocks
+    assert utils.topology_fingerprint(grouped) == utils.topology_fingerprint(system)
+
+    # any change of the topology
+    m = system.molecules[3]
+    before = utils.topology_fingerprint(m)
+    charge = m.atoms[1].charge
+    m.atoms[1].charge = charge + 1e-6
+    assert utils.topology_fingerprint(m) != before
+    m.atoms[1].charge = charge
+    assert utils.topology_fingerprint(m) == before
+    m.bonds = m.bonds[:1]
+    assert utils.topology_fingerprint(m) != before